@@ -0,0 +1,28 @@
+"""
+The pytest configuration of the tests of ninagram. Without pytest-django the
+test database is created here, like the Django test runner does.
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ninagram.tests.settings')
+
+
+def pytest_configure(config):
+    django.setup()
+    if config.pluginmanager.hasplugin('django'):
+        return
+
+    from django.test.runner import DiscoverRunner
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    runner.setup_test_environment()
+    config._ninagram_runner = runner
+    config._ninagram_databases = runner.setup_databases()
+
+
+def pytest_unconfigure(config):
+    runner = getattr(config, '_ninagram_runner', None)
+    if runner is not None:
+        runner.teardown_databases(config._ninagram_databases)
+        runner.teardown_test_environment()
@@ -0,0 +1,249 @@
+"""
+This module contains the asyncio support of Ninagram.
+
+When NINAGRAM['ASYNC'] is True, `generic_processor` doesn't use the worker
+pool anymore: the updates are processed by coroutines running on one event
+loop owned by the AsyncRunner. States may then define `async def` step
+methods; the synchronous ones (and every blocking call like database access or
+the Bot API) run in the executor of the loop.
+
+Like the worker pool, the runner holds at most NINAGRAM['WORKERS_QUEUE_SIZE']
+updates and applies the NINAGRAM['WORKERS_OVERFLOW'] policy past it, see
+ninagram.workers.
+
+This module needs Python 3.7 or later, it is only imported in asyncio mode.
+"""
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, RLock, Condition
+from django.conf import settings
+from loguru import logger
+from .metrics import Metrics
+from .workers import Job, BLOCK, DROP_OLDEST, REJECT, OVERFLOW_POLICIES
+
+# the language of the update being processed. It is activated in the
+# executor threads before running synchronous code.
+current_language = contextvars.ContextVar('ninagram_language', default=None)
+
+
+def _run_with_language(fn, args, kwargs):
+    lang = current_language.get()
+    if lang:
+        from django.utils import translation
+        translation.activate(lang)
+    return fn(*args, **kwargs)
+
+
+async def run_sync(fn, *args, **kwargs):
+    """
+    Run the blocking callable fn in the executor of the running loop and
+    return its result. The context variables of the caller are propagated.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(None, ctx.run, _run_with_language, fn, args, kwargs)
+
+
+async def call_maybe_async(fn, *args, **kwargs):
+    """
+    Await fn(*args, **kwargs) if fn is a coroutine function, else run it in
+    the executor.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        return await fn(*args, **kwargs)
+    return await run_sync(fn, *args, **kwargs)
+
+
+class AsyncRunner:
+    """
+    This class owns an event loop running in its own thread.
+
+    Coroutines are submitted from any thread. Like the worker pool, the
+    coroutines submitted with the same key run one after the other.
+
+    Params:
+        - workers: the size of the executor used for synchronous code
+        - queue_size: the maximum number of coroutines submitted and not done
+        - overflow: the overflow policy, see ninagram.workers.OVERFLOW_POLICIES.
+        With "drop-oldest" the oldest coroutine not started yet is cancelled.
+    """
+
+    def __init__(self, workers=8, queue_size=1000, overflow=BLOCK, name="async-runner"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(', '.join(OVERFLOW_POLICIES)))
+
+        self.name = name
+        self.queue_size = max(1, int(queue_size))
+        self.overflow = overflow
+        self.metrics = Metrics(name)
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=max(1, int(workers)),
+                                                          thread_name_prefix=name))
+        # key -> [asyncio.Lock, number of coroutines using it], only used on the loop
+        self.lanes = {}
+        self.in_flight = 0
+        # the submitting threads and the loop share the counters below
+        self.lock = RLock()
+        self.not_full = Condition(self.lock)
+        self.idle = Condition(self.lock)
+        # the coroutines submitted and not done
+        self.pending = 0
+        # Job -> future of the coroutines not started yet, the oldest first
+        self.waiting = OrderedDict()
+        self.closed = False
+        self.thread = Thread(target=self.run, name=name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro_fn, *args, key=None, on_reject=None, **kwargs):
+        """
+        Schedule coro_fn(*args, **kwargs) on the loop.
+
+        Args:
+            * coro_fn: the coroutine function to run
+            * key(optional): the lane of the coroutine
+            * on_reject(optional): called with *args if the coroutine is refused or dropped
+
+        Returns: a concurrent.futures.Future of the result, or None if the 
+        coroutine was refused
+        """
+        job = Job(coro_fn, args, kwargs, on_reject)
+        dropped = None
+        future = None
+
+        with self.lock:
+            if self.closed:
+                # the runner is shutting down, see shutdown
+                self.metrics.incr('rejected')
+                dropped = job
+            elif self.pending >= self.queue_size:
+                if self.overflow == REJECT:
+                    self.metrics.incr('rejected')
+                    dropped = job
+                elif self.overflow == DROP_OLDEST:
+                    # when every coroutine has started, the new one is accepted
+                    if self.waiting:
+                        dropped, oldest = self.waiting.popitem(last=False)
+                        oldest.cancel()
+                        self.metrics.incr('dropped')
+                else:
+                    while self.pending >= self.queue_size and not self.closed:
+                        self.not_full.wait()
+                    if self.closed:
+                        self.metrics.incr('rejected')
+                        dropped = job
+
+            if dropped is not job:
+                self.pending += 1
+                future = asyncio.run_coroutine_threadsafe(self.run_in_lane(key, job), self.loop)
+                self.waiting[job] = future
+                future.add_done_callback(lambda future, job=job: self.finished(job))
+                self.metrics.incr('submitted')
+                self.metrics.gauge('queue_depth', self.pending)
+
+        if dropped is not None:
+            logger.warning("{} queue is full, an update was refused", self.name)
+            dropped.reject()
+        return future
+
+    def finished(self, job):
+        with self.lock:
+            self.waiting.pop(job, None)
+            self.pending -= 1
+            self.metrics.gauge('queue_depth', self.pending)
+            self.not_full.notify()
+            if not self.pending:
+                self.idle.notify_all()
+    
+    def shutdown(self, timeout=None):
+        """
+        Stop accepting coroutines and wait until the submitted ones are done.
+        
+        Params:
+            - timeout: the maximum time to wait in seconds, None to wait forever
+            
+        Returns: the number of coroutines not done when the timeout is over
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            self.closed = True
+            # the callers blocked on a full queue are released
+            self.not_full.notify_all()
+            while self.pending:
+                if deadline is None:
+                    self.idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.idle.wait(remaining)
+            return self.pending
+
+    async def run_in_lane(self, key, job):
+        if key is None:
+            return await self.execute(job)
+
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+
+        try:
+            async with lane[0]:
+                return await self.execute(job)
+        finally:
+            lane[1] -= 1
+            if lane[1] == 0:
+                del self.lanes[key]
+
+    async def execute(self, job):
+        with self.lock:
+            if self.waiting.pop(job, None) is None:
+                # dropped while it was waiting for its lane
+                return None
+            
+        started = self.loop.time()
+        self.in_flight += 1
+        self.metrics.gauge('in_flight', self.in_flight)
+        try:
+            res = await job.fn(*job.args, **job.kwargs)
+            self.metrics.incr('completed')
+            return res
+        except Exception as e:
+            self.metrics.incr('failed')
+            logger.exception(str(e))
+        finally:
+            self.in_flight -= 1
+            self.metrics.gauge('in_flight', self.in_flight)
+            self.metrics.observe('run_time', self.loop.time() - started)
+
+    def stats(self):
+        """Return a snapshot of the runner metrics"""
+        return self.metrics.snapshot()
+
+
+_runner = None
+_runner_lock = Lock()
+
+
+def get_runner():
+    """
+    Return the AsyncRunner of the process, creating it from the settings at the
+    first call.
+    """
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                conf = getattr(settings, 'NINAGRAM', {})
+                _runner = AsyncRunner(workers=conf.get('WORKERS', 8),
+                                      queue_size=conf.get('WORKERS_QUEUE_SIZE', 1000),
+                                      overflow=conf.get('WORKERS_OVERFLOW', BLOCK))
+    return _runner
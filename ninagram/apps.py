@@ -21,7 +21,9 @@ class NinagramConfig(AppConfig):
                 if settings.NINAGRAM['WORKING_MODE'].lower() == "polling":
                     self.ninabot.start_polling()
                 elif settings.NINAGRAM['WORKING_MODE'].lower() == "webhook":
+                    from ninagram.views import load_webhooks
                     self.ninabot.start_webhook()
+                    load_webhooks(self.ninabot.webhooks)
                 else:
                     print("Working mode not recognised. We ignored it.")
         except Exception as e:
@@ -0,0 +1,72 @@
+"""
+This module contains an ASGI application receiving the webhook updates, for
+the async servers (uvicorn, daphne...).
+
+The updates are checked and queued like in ninagram.views.handle_webhook
+without going through the Django request handling. The other requests are
+given to the wrapped application, e.g. the ASGI application of the project:
+
+    application = WebhookApplication(get_default_application())
+"""
+import asyncio
+import re
+from .views import enqueue_update, load_webhooks
+
+WEBHOOK_RGX = re.compile(r'/webhook/(?P<token>[^/]+)/?$')
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+async def read_body(receive):
+    """Return the whole body of an http request"""
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def answer(send, status, body=b''):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class WebhookApplication:
+    """
+    ASGI 3 application answering the POST requests to the webhook urls.
+
+    Params:
+        - app(optional): the ASGI application serving the other requests
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        # the bots are ready before the first update
+        load_webhooks()
+
+    async def __call__(self, scope, receive, send):
+        match = None
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            match = WEBHOOK_RGX.search(scope['path'])
+
+        if match is None:
+            if self.app is not None:
+                return await self.app(scope, receive, send)
+            if scope['type'] == 'http':
+                await answer(send, 404)
+            return
+
+        body = await read_body(receive)
+        secret = dict(scope.get('headers', ())).get(SECRET_HEADER)
+        if secret is not None:
+            secret = secret.decode('latin-1')
+
+        # the decoding, the shared deduplication and a full queue may block,
+        # the event loop must not wait for them
+        loop = asyncio.get_event_loop()
+        status = await loop.run_in_executor(None, enqueue_update, match.group('token'),
+                                            body, secret)
+        await answer(send, status, b'OK' if status == 200 else b'')
@@ -61,13 +61,13 @@ class UserIsStaff(BaseAccess):
     """
     
     def menu(self, update:telegram.Update):
-        if update.db.user.dj.is_staff:
+        if update.db.is_staff:
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.user.dj.is_staff:
+        if update.db.is_staff:
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -81,13 +81,13 @@ class UserIsSuper(BaseAccess):
     """    
     
     def menu(self, update:telegram.Update):
-        if update.db.user.dj.is_superuser:
+        if update.db.is_superuser:
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.user.dj.is_superuser:
+        if update.db.is_superuser:
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -101,13 +101,13 @@ class ChatIsStaff(BaseAccess):
     """    
     
     def menu(self, update:telegram.Update):
-        if update.db.chat.is_staff:
+        if update.db.chat_is_staff:
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.chat.is_staff:
+        if update.db.chat_is_staff:
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -121,13 +121,13 @@ class ChatIsPrivate(BaseAccess):
     """    
         
     def menu(self, update:telegram.Update):
-        if update.db.chat.type == "private":
+        if update.db.chat_type == "private":
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.chat.type == "private":
+        if update.db.chat_type == "private":
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -141,13 +141,13 @@ class ChatIsGroup(BaseAccess):
     """    
     
     def menu(self, update:telegram.Update):
-        if update.db.chat.type == "group":
+        if update.db.chat_type == "group":
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.chat.type == "group":
+        if update.db.chat_type == "group":
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -161,13 +161,13 @@ class ChatIsSupergroup(BaseAccess):
     """    
     
     def menu(self, update:telegram.Update):
-        if update.db.chat.type == "supergroup":
+        if update.db.chat_type == "supergroup":
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.chat.type == "supergroup":
+        if update.db.chat_type == "supergroup":
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -181,13 +181,13 @@ class ChatIsChannel(BaseAccess):
     """    
         
     def menu(self, update:telegram.Update):
-        if update.db.chat.type == "channel":
+        if update.db.chat_type == "channel":
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.chat.type == "channel":
+        if update.db.chat_type == "channel":
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -201,13 +201,13 @@ class ChatIsAnyGroup(BaseAccess):
     """    
     
     def menu(self, update:telegram.Update):
-        if update.db.chat.type == "group" or update.db.chat.type == "supergroup":
+        if update.db.chat_type == "group" or update.db.chat_type == "supergroup":
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
         
     def next(self, update:telegram.Update):
-        if update.db.chat.type == "group" or update.db.chat.type == "supergroup":
+        if update.db.chat_type == "group" or update.db.chat_type == "supergroup":
             return self.get_next_success_response()
         else:
             return self.get_next_error_response()
@@ -317,7 +317,7 @@ class ChatUsernameIn(BaseAccess):
             raise TypeError("user_ids must list or tuples")
             
     def menu(self, update:telegram.Update):
-        if uupdate.effective_chat.username in self.chatnames:
+        if update.effective_chat.username in self.chatnames:
             return self.get_menu_success_response()
         else:
             return self.get_menu_error_response()
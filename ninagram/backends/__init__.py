@@ -0,0 +1,6 @@
+"""
+This package contains the storage backends used by the Runtime and the
+SimpleCache mixin.
+"""
+from .local import LocalCache, NegativeCache
+from .shared import SharedCache
@@ -0,0 +1,164 @@
+"""
+This module contains the in-process cache of model instances used by
+`Runtime.get_cache` and `Runtime.set_cache`.
+"""
+import time
+from collections import OrderedDict
+from threading import RLock
+from ninagram.metrics import Metrics
+
+
+class LocalCache:
+    """
+    An in-memory cache of model instances, grouped by model name.
+
+    Each model has its own size limit. When a model is full the least recently
+    used instance is evicted. Entries not accessed for `ttl` seconds expire,
+    based on the `last` access time stored with each entry.
+
+    Params:
+        - max_entries: the default limit of instances per model, None for no limit
+        - limits: a dict model name -> limit that overrides max_entries
+        - ttl: the idle time in seconds after which an entry expires, None to disable
+    """
+
+    def __init__(self, max_entries=50000, limits=None, ttl=None):
+        self.max_entries = max_entries
+        self.limits = limits or {}
+        self.ttl = ttl
+        self.metrics = Metrics("cache")
+        self.lock = RLock()
+        # model_name -> OrderedDict(pkid -> {'instance':..., 'last':...}), the
+        # least recently used entries come first
+        self.models = {}
+
+    def get_limit(self, model_name):
+        return self.limits.get(model_name, self.max_entries)
+
+    def is_expired(self, entry, now):
+        return self.ttl is not None and now - entry['last'] > self.ttl
+
+    def get(self, model_name, pkid):
+        """Return the cached instance or None"""
+        now = time.time()
+        with self.lock:
+            entries = self.models.get(model_name)
+            entry = entries.get(pkid) if entries is not None else None
+            if entry is None:
+                self.metrics.incr(model_name + '.misses')
+                return None
+
+            if self.is_expired(entry, now):
+                del entries[pkid]
+                self.metrics.incr(model_name + '.expired')
+                self.metrics.incr(model_name + '.misses')
+                return None
+
+            entry['last'] = now
+            entries.move_to_end(pkid)
+            self.metrics.incr(model_name + '.hits')
+            return entry['instance']
+
+    def set(self, model_name, pkid, instance):
+        """Add or replace an instance, evicting the old ones if needed"""
+        now = time.time()
+        with self.lock:
+            entries = self.models.get(model_name)
+            if entries is None:
+                entries = self.models[model_name] = OrderedDict()
+
+            entries[pkid] = {'instance': instance, 'last': now}
+            entries.move_to_end(pkid)
+
+            # the entries are ordered by last access so the expired ones are first
+            while entries and self.ttl is not None:
+                key, entry = next(iter(entries.items()))
+                if not self.is_expired(entry, now):
+                    break
+                del entries[key]
+                self.metrics.incr(model_name + '.expired')
+
+            limit = self.get_limit(model_name)
+            while limit is not None and len(entries) > limit:
+                entries.popitem(last=False)
+                self.metrics.incr(model_name + '.evictions')
+        return True
+
+    def delete(self, model_name, pkid):
+        with self.lock:
+            entries = self.models.get(model_name)
+            if entries is not None:
+                entries.pop(pkid, None)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+    def stats(self):
+        """
+        Return the statistics of the cache.
+
+        Returns: a dict model name -> {'size', 'limit', 'hits', 'misses',
+        'evictions', 'expired'}
+        """
+        counters = self.metrics.snapshot()['counters']
+        res = {}
+        with self.lock:
+            names = set(self.models) | set(key.split('.')[0] for key in counters)
+            for model_name in names:
+                res[model_name] = {
+                    'size': len(self.models.get(model_name, ())),
+                    'limit': self.get_limit(model_name),
+                }
+                for counter in ('hits', 'misses', 'evictions', 'expired'):
+                    res[model_name][counter] = counters.get(model_name + '.' + counter, 0)
+        return res
+
+
+class NegativeCache:
+    """
+    A short-lived memory of the keys known to be missing from the database, 
+    so that looking for them again doesn't cost a query. An entry expires 
+    `ttl` seconds after it was added, whatever its accesses.
+
+    Params:
+        - ttl: the lifetime of an entry in seconds
+        - max_entries: the maximum number of keys, the oldest ones are removed first
+    """
+
+    def __init__(self, ttl=5, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = RLock()
+        # (model_name, pkid) -> expiration time, the oldest entries come first
+        self.entries = OrderedDict()
+
+    def add(self, model_name, pkid):
+        if not self.ttl:
+            return
+
+        with self.lock:
+            key = (model_name, pkid)
+            self.entries[key] = time.time() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def contains(self, model_name, pkid):
+        """Return True if the key was recently found missing"""
+        with self.lock:
+            expire = self.entries.get((model_name, pkid))
+            if expire is None:
+                return False
+            if expire < time.time():
+                del self.entries[(model_name, pkid)]
+                return False
+            return True
+
+    def discard(self, model_name, pkid):
+        with self.lock:
+            self.entries.pop((model_name, pkid), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
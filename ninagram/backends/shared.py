@@ -0,0 +1,76 @@
+"""
+This module contains a cache of model instances shared between processes
+through the Django cache framework.
+
+Any cache configured in settings.CACHES can be used: Redis or memcached to
+share the instances between several workers and hosts, or the locmem and file
+based backends for a single host or the tests.
+"""
+import pickle
+from ninagram.metrics import Metrics
+
+
+class SharedCache:
+    """
+    A cache of model instances stored in a Django cache.
+
+    Params:
+        - alias: the name of the cache in settings.CACHES
+        - timeout: the lifetime of the entries in seconds, None to use the
+        default timeout of the cache
+        - prefix: the prefix of all the keys
+    """
+
+    def __init__(self, alias='default', timeout=None, prefix='ninagram'):
+        self.alias = alias
+        self.timeout = timeout
+        self.prefix = prefix
+        self.metrics = Metrics("shared-cache")
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        # caches[] returns a connection per thread
+        return caches[self.alias]
+
+    def make_key(self, model_name, pkid):
+        return "{}:{}:{}".format(self.prefix, model_name, pkid)
+
+    def serialize(self, instance):
+        """Return the bytes stored for the model instance. The related objects
+        already loaded (like TgUser.dj) are kept with it."""
+        return pickle.dumps(instance, pickle.HIGHEST_PROTOCOL)
+
+    def deserialize(self, data):
+        return pickle.loads(data)
+
+    def get(self, model_name, pkid):
+        """Return the cached instance or None"""
+        data = self.cache.get(self.make_key(model_name, pkid))
+        if data is None:
+            self.metrics.incr(model_name + '.misses')
+            return None
+
+        self.metrics.incr(model_name + '.hits')
+        return self.deserialize(data)
+
+    def set(self, model_name, pkid, instance):
+        kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+        self.cache.set(self.make_key(model_name, pkid), self.serialize(instance), **kwargs)
+        return True
+
+    def mark(self, name, key, timeout):
+        """
+        Record a key for `timeout` seconds unless it is already recorded.
+        The cache backend does it atomically, so one process only gets True.
+        """
+        return self.cache.add(self.make_key(name, key), 1, timeout=timeout)
+
+    def unmark(self, name, key):
+        self.cache.delete(self.make_key(name, key))
+
+    def delete(self, model_name, pkid):
+        self.cache.delete(self.make_key(model_name, pkid))
+
+    def stats(self):
+        return self.metrics.snapshot()['counters']
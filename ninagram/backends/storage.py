@@ -0,0 +1,157 @@
+"""
+This module contains the stores used by the Runtime to persist the data of
+the conversations, so that the in-progress forms and inputs survive a restart.
+
+A store works with whole conversations: the data of a (user_id, chat_id)
+couple serialized as bytes. The Runtime loads a conversation lazily at its
+first access and flushes the modified ones by batches.
+"""
+import pickle
+from abc import ABCMeta, abstractmethod
+from loguru import logger
+
+
+class MemoryStore:
+    """
+    The default store: nothing is persisted, the Runtime data only lives in
+    memory like it always did.
+    """
+
+    persistent = False
+
+    def load(self, user_id, chat_id):
+        return None
+
+    def save_many(self, items):
+        pass
+
+    def delete(self, user_id, chat_id):
+        pass
+
+
+class PersistentStore(MemoryStore, metaclass=ABCMeta):
+    """
+    Base class of the stores that persist the conversations, the subclasses
+    implement load_data, save_many and delete.
+    """
+
+    persistent = True
+
+    def serialize(self, states):
+        return pickle.dumps(states, pickle.HIGHEST_PROTOCOL)
+
+    def deserialize(self, data):
+        return pickle.loads(bytes(data))
+
+    def load(self, user_id, chat_id):
+        """Return the data of the conversation or None if it was never saved"""
+        data = self.load_data(user_id, chat_id)
+        if data is None:
+            return None
+
+        try:
+            return self.deserialize(data)
+        except Exception as e:
+            logger.exception(str(e))
+            return None
+
+    @abstractmethod
+    def load_data(self, user_id, chat_id):
+        """Return the serialized conversation or None if it was never saved"""
+
+    @abstractmethod
+    def save_many(self, items):
+        """
+        Save several conversations.
+
+        Params:
+            - items: a list of ((user_id, chat_id), data) where data is the
+            serialized conversation
+        """
+
+    @abstractmethod
+    def delete(self, user_id, chat_id):
+        """Delete the saved conversation"""
+
+
+class DatabaseStore(PersistentStore):
+    """
+    This store saves the conversations in the RuntimeData table. A batch is
+    written in one transaction.
+    """
+
+    def load_data(self, user_id, chat_id):
+        from ninagram.models import RuntimeData
+        return RuntimeData.objects.filter(user_id=user_id, chat_id=chat_id)\
+            .values_list('data', flat=True).first()
+
+    def save_many(self, items):
+        from django.db import transaction
+        from ninagram.models import RuntimeData
+
+        with transaction.atomic():
+            for (user_id, chat_id), data in items:
+                updated = RuntimeData.objects.filter(user_id=user_id, chat_id=chat_id)\
+                    .update(data=data)
+                if not updated:
+                    RuntimeData.objects.create(user_id=user_id, chat_id=chat_id, data=data)
+
+    def delete(self, user_id, chat_id):
+        from ninagram.models import RuntimeData
+        RuntimeData.objects.filter(user_id=user_id, chat_id=chat_id).delete()
+
+
+class CacheStore(PersistentStore):
+    """
+    This store saves the conversations in a Django cache, shared by all the
+    processes using the same cache.
+
+    Params:
+        - alias: the name of the cache in settings.CACHES
+        - timeout: the lifetime of the conversations in seconds, None for the
+        default timeout of the cache
+    """
+
+    def __init__(self, alias='default', timeout=None):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def make_key(self, user_id, chat_id):
+        return "ninagram:runtime:{}:{}".format(user_id, chat_id)
+
+    def load_data(self, user_id, chat_id):
+        return self.cache.get(self.make_key(user_id, chat_id))
+
+    def save_many(self, items):
+        kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+        self.cache.set_many({self.make_key(*key): data for key, data in items}, **kwargs)
+
+    def delete(self, user_id, chat_id):
+        self.cache.delete(self.make_key(user_id, chat_id))
+
+
+STORES = {
+    'memory': MemoryStore,
+    'database': DatabaseStore,
+    'cache': CacheStore,
+}
+
+
+def get_store(name, **kwargs):
+    """
+    Return a store instance.
+
+    Params:
+        - name: "memory", "database", "cache" or the dotted path of a store class
+        - kwargs: the arguments of the store class
+    """
+    if name in STORES:
+        return STORES[name](**kwargs)
+
+    from django.utils.module_loading import import_string
+    return import_string(name)(**kwargs)
@@ -3,13 +3,21 @@ from ninagram.handlers import *
 from telegram.ext import MessageHandler, Filters, Dispatcher, CallbackContext
 from telegram import ParseMode
 from loguru import logger
-from ninagram.states.base import get_state
+from ninagram.states.base import get_state, StateFactory
 from .models import TgUser, User
 from .runtime import Runtime
 from .middlewares import SessionMiddleware
+from .workers import get_pool, update_key
+from .cache import Saver, get_saver_pool
+from .delivery import is_delivery_enabled, get_delivery
+from .transport import make_bot
 import importlib
-from threading import Thread
+import time
+from signal import signal, SIGINT, SIGTERM, SIGABRT
+from threading import Event
 from django.shortcuts import reverse
+from django.conf import settings
+from django.utils.translation import gettext as _
     
 try:
     from django.utils import translation
@@ -18,9 +26,55 @@ except:
     CAN_TRANSLATE = False
 
 
+def reply_busy(update: telegram.Update, dispatcher:Dispatcher=None, context:CallbackContext=None):
+    """
+    This function is called when the worker pool refuses or drops an update.
+    It tells the user that the bot is busy.
+    """
+    message = settings.NINAGRAM.get('BUSY_MESSAGE', _("The bot is busy, please try again later."))
+    try:
+        if update.callback_query is not None:
+            update.callback_query.answer(message)
+        elif update.effective_message is not None:
+            update.effective_message.reply_text(message)
+    except Exception as e:
+        logger.exception(str(e))
+
+
+def post_messages(update: telegram.Update, state, all_msg, *states, contexts=()):
+    """
+    Call the post method of the state with each sent message then release the states.
+    
+    Params:
+        - contexts: (state, StateContext) couples restored first, when post 
+        doesn't run in the job that processed the update (a singleton state 
+        keeps its context in a context variable of that job)
+    """
+    for item, ctx in contexts:
+        item.set_context(ctx)
+        
+    try:
+        for msg in all_msg or ():
+            state.post(update, msg)
+    except Exception as e:
+        logger.exception(str(e))
+        
+    # the pooled states can serve the next updates
+    StateFactory.release(state, *states)
+    
+    
 def generic_processor(update: telegram.Update, dispatcher:Dispatcher, context:CallbackContext=None):
     
     def internal(update:telegram.Update, dispatcher:Dispatcher, context:CallbackContext):
+        # every state got for this update, they are released even on errors 
+        # unless post_messages was given them
+        states = []
+        
+        def load_state(name):
+            state = get_state(name, update, dispatcher, context=context)
+            states.append(state)
+            return state
+        
         try:
             if CAN_TRANSLATE:
                 try:
@@ -33,15 +87,14 @@ def generic_processor(update: telegram.Update, dispatcher:Dispatcher, context:Ca
             try:
                 sess = update.db.session
                 logger.debug("last state is {}", sess.state)
-                prev_state = get_state(sess.state, update, dispatcher, context=context)
+                prev_state = load_state(sess.state)
                 resp = prev_state.next(update)
-                state = get_state(resp.state, update, dispatcher, context=context)
+                state = load_state(resp.state)
                 if resp.step:
                     state.set_step(resp.step)
                 logger.debug("new state is {}", state)
             except Exception as e:
                 logger.exception(str(e))
-                state = get_state("START", update, dispatcher, context=context)
                 return
             
             sess.state = state.name
@@ -59,24 +112,134 @@ def generic_processor(update: telegram.Update, dispatcher:Dispatcher, context:Ca
                 logger.debug("after state is {}", sess.state)
             except Exception as e:
                 logger.exception(str(e))
-                state = get_state("START", update, dispatcher, context=context)
+                state = load_state("START")
                 resp = state.menu(update)
                 sess.state = state.name
                 sess.save_after()
                 
-            all_msg = resp.apply(update)
+            # the states given to post_messages are released by it
+            taken = tuple(states)
             
+            if is_delivery_enabled() and hasattr(resp, 'apply_queued'):
+                # the worker doesn't wait for the Bot API, post runs in the 
+                # lane of the conversation once the messages are sent. The 
+                # next update of the chat may change the step before that.
+                state.post_step = state.get_step()
+                contexts = ((prev_state, prev_state.get_context()), 
+                            (state, state.get_context()))
+                
+                def sent(all_msg):
+                    # called by a sender of the delivery, which must not wait 
+                    # for a full pool
+                    if not get_pool().submit(post_messages, update, state, all_msg, *taken, 
+                                             key=update_key(update), contexts=contexts, 
+                                             force=True):
+                        post_messages(update, state, all_msg, *taken, contexts=contexts)
+                        
+                # on a failure post gets the messages sent and the states are released
+                if resp.apply_queued(update, callback=sent, errback=sent):
+                    states.clear()
+                    return
+                
             try:
-                for msg in all_msg:
-                    state.post(update, msg)
+                all_msg = resp.apply(update)
             except Exception as e:
                 logger.exception(str(e))
+                all_msg = None
+            states.clear()
+            post_messages(update, state, all_msg, *taken)
         except Exception as e:
+            logger.exception(str(e))
+        finally:
+            StateFactory.release(*states)
+                
+    if settings.NINAGRAM.get('ASYNC', False):
+        # in asyncio mode the update is processed by a coroutine, see ninagram.aio
+        from .aio import get_runner
+        get_runner().submit(async_processor, update, dispatcher, context, key=update_key(update),
+                            on_reject=reply_busy)
+        return
+
+    # the update is processed by the worker pool, in the lane of its chat and
+    # user so that the updates of a conversation never run concurrently.
+    get_pool().submit(internal, update, dispatcher, context, key=update_key(update),
+                      on_reject=reply_busy)
+        
+
+async def async_processor(update: telegram.Update, dispatcher:Dispatcher, context:CallbackContext=None):
+    """
+    This coroutine does the same work as generic_processor but awaits the
+    states and the response. It is used when NINAGRAM['ASYNC'] is True.
+    The states are created and the session is saved in the executor, the
+    event loop never waits for the Runtime or the database.
+    """
+    from .aio import current_language, run_sync
+    
+    # every state got for this update, they are released even on errors
+    states = []
+    
+    def load_state(name, step=None):
+        state = get_state(name, update, dispatcher, context=context)
+        if step:
+            state.set_step(step)
+        return state, state.get_context()
+    
+    async def aget_state(name, step=None):
+        state, ctx = await run_sync(load_state, name, step)
+        # the context of a singleton was set in the context of the executor
+        state.set_context(ctx)
+        states.append(state)
+        return state
+    
+    try:
+        if CAN_TRANSLATE:
+            try:
+                lang = update.db.chat.lang
+                current_language.set(lang)
+                logger.debug("we are setting lang {}", lang)
+            except Exception as e:
                 logger.exception(str(e))
                 
-    t = Thread(target=internal, args=(update, dispatcher, context))
-    t.setDaemon(True)
-    t.start()
+        try:
+            sess = update.db.session
+            logger.debug("last state is {}", sess.state)
+            prev_state = await aget_state(sess.state)
+            resp = await prev_state.next_async(update)
+            state = await aget_state(resp.state, resp.step)
+            logger.debug("new state is {}", state)
+        except Exception as e:
+            logger.exception(str(e))
+            return
+        
+        sess.state = state.name
+        await run_sync(sess.save_after)
+        
+        try:
+            resp = await state.menu_async(update)
+            if state.restore_state:
+                sess.state = state.restore_state
+            else:
+                sess.state = state.name
+            await run_sync(sess.save_after, force_update=True)
+            logger.debug("after state is {}", sess.state)
+        except Exception as e:
+            logger.exception(str(e))
+            state = await aget_state("START")
+            resp = await state.menu_async(update)
+            sess.state = state.name
+            await run_sync(sess.save_after)
+            
+        all_msg = await resp.apply_async(update)
+        
+        try:
+            for msg in all_msg:
+                await state.post_async(update, msg)
+        except Exception as e:
+            logger.exception(str(e))
+    except Exception as e:
+        logger.exception(str(e))
+    finally:
+        StateFactory.release(*states)
         
 
 class Bot:
@@ -85,10 +248,6 @@ class Bot:
     It is a singleton.
     """
     
-    REQUEST_KWARGS={
-        'proxy_url': 'http://127.0.0.1:8080/',
-    }
-    
     instance = None
     
     def __new__(cls, *args, **kwargs):
@@ -105,13 +264,17 @@ class Bot:
         if len(tokens) < 1:
             return
         
+        # Bot() runs __init__ again on the singleton, there is nothing new to do
+        if getattr(self, 'initialized', False) and all(token in self.tokens for token in tokens):
+            return
+        
         self.runtime = Runtime()
         
         self.handlers = {'inline': [], 'command': [], 'text': [], 'default':[], 'add-in':[],
                          'reply':[], 'query':[], 'title':[], 'off':[], 'regex':[], 'photo':[],
                          'video':[], 'videonote':[]}        
         
-        if not hasattr(self, 'token'):
+        if not hasattr(self, 'tokens'):
             self.tokens = {}
         
         for token in tokens:
@@ -122,8 +285,8 @@ class Bot:
                 logger.warning("token is not a string. Ignoring")
                 continue
             
-            # bot = telegram.Bot(token)
-            updater = telegram.ext.Updater(token, request_kwargs=None, use_context=True)
+            # each token has its own pool of kept-alive connections, see ninagram.transport
+            updater = telegram.ext.Updater(bot=make_bot(token), use_context=True)
             dispatcher = updater.dispatcher
             job_queue = updater.job_queue
             self.tokens[token] = {'bot':updater.bot, 'updater':updater,
@@ -149,20 +312,32 @@ class Bot:
         self.install_default_callback_query_handler()
         self.install_accept_all()
         
+        if settings.NINAGRAM.get('ASYNC', False):
+            # the event loop serves the updates of polling and webhook alike
+            from .aio import get_runner
+            self.runner = get_runner()
+        
+        # the webhook looks the bot up by the token of the url
+        self.webhooks = {token: (item['bot'], item['dispatcher'])
+                         for token, item in self.tokens.items()}
+        self.initialized = True
         self.started = False
         logger.info("self.started {}", self.started)
         
+    def import_states(self):
+        """Import the modules of NINAGRAM['STATES_MODULES'] so that their states are registered"""
+        logger.info("{}", settings.NINAGRAM['STATES_MODULES'])
+        for module in settings.NINAGRAM['STATES_MODULES']:
+            logger.info("Importing {}", module)
+            importlib.import_module(module)
+            
     def start_polling(self):
         if  not hasattr(self, 'started'):
             logger.info("Can't initialize")
             return
             
         if not self.started:
-            logger.info("{}", settings.NINAGRAM['STATES_MODULES'])
-            for module in settings.NINAGRAM['STATES_MODULES']:
-                logger.info("Importing {}", module)
-                importlib.import_module(module)
-                
+            self.import_states()
             for token in self.tokens.values():
                 try:
                     token['updater'].start_polling()
@@ -177,31 +352,128 @@ class Bot:
             return
             
         if not self.started:
-            logger.info("{}", settings.NINAGRAM['STATES_MODULES'])
-            for module in settings.NINAGRAM['STATES_MODULES']:
-                logger.info("Importing {}", module)
-                importlib.import_module(module)
-                
+            self.import_states()
             for token, dict_token in self.tokens.items():
                 try:
                     url = "https://" + settings.NINAGRAM["DOMAIN"] +\
                         reverse('ninagram-webhook', kwargs={'token':token})
-                    dict_token['bot'].set_webhook(url)
+                    secret = settings.NINAGRAM.get('WEBHOOK_SECRET')
+                    if secret:
+                        # set_webhook of python-telegram-bot 12 has no secret_token
+                        bot = dict_token['bot']
+                        bot.request.post('{}/setWebhook'.format(bot.base_url),
+                                         {'url': url, 'secret_token': secret})
+                    else:
+                        dict_token['bot'].set_webhook(url)
                 except Exception as e:
                     logger.exception(str(e))
         else:
             logger.info("Already started")        
             
-    def idle(self):
+    def idle(self, stop_signals=(SIGINT, SIGTERM, SIGABRT)):
+        """
+        Block until one of the stop signals is received. The updaters of all
+        the tokens are then stopped by stop.
+        """
+        stopped = Event()
+        
+        def on_signal(signum, frame):
+            logger.info("Received signal {}", signum)
+            stopped.set()
+            
+        for sig in stop_signals:
+            signal(sig, on_signal)
+        while not stopped.wait(1):
+            pass
+            
+    def stop(self, timeout=None):
+        """
+        Stop the bot without losing its work, in this order:
+            - stop receiving updates (polling, dispatchers and job queues)
+            - finish the updates being processed
+            - write the queued instances of the Saver and the Runtime conversations
+        
+        Params:
+            - timeout: the time in seconds given to the whole shutdown 
+            (default NINAGRAM['SHUTDOWN_TIMEOUT'] or 30), None in the setting 
+            to wait forever
+            
+        Returns: a dict with the number of unfinished updates, of saved and 
+        dropped instances and of flushed conversations
+        """
+        if timeout is None:
+            timeout = settings.NINAGRAM.get('SHUTDOWN_TIMEOUT', 30)
+        deadline = None if timeout is None else time.time() + timeout
+        
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.time())
+        
+        saved = Saver.metrics.snapshot()['counters'].get('saved', 0)
+        dropped = Saver.metrics.snapshot()['counters'].get('dropped', 0)
+        
+        logger.info("Stopping the bot")
+        for token in getattr(self, 'tokens', {}).values():
+            try:
+                token['updater'].stop()
+            except Exception as e:
+                logger.exception(str(e))
+                
+        if settings.NINAGRAM.get('ASYNC', False):
+            from .aio import get_runner
+            unfinished = get_runner().shutdown(remaining())
+        else:
+            unfinished = get_pool().shutdown(remaining())
+            
+        # the delivery may exist for a broadcast even if the responses don't use it
+        if get_delivery(create=False) is not None:
+            unsent = get_delivery().shutdown(remaining())
+            if unsent:
+                logger.warning("{} messages not sent", unsent)
+            
+        for token in getattr(self, 'tokens', {}).values():
+            try:
+                token['bot'].request.stop()
+            except Exception as e:
+                logger.exception(str(e))
+                
+        waiting = get_saver_pool().drain(remaining())
         try:
-            for token in self.tokens.values():
-                try:
-                    token['updater'].idle()
-                    break
-                except Exception as e:
-                    logger.exception(str(e))
+            conversations = self.runtime.flush() if hasattr(self, 'runtime') else 0
         except Exception as e:
             logger.exception(str(e))
+            conversations = 0
+            
+        counters = Saver.metrics.snapshot()['counters']
+        report = {
+            'unfinished': unfinished,
+            'saved': counters.get('saved', 0) - saved,
+            'dropped': counters.get('dropped', 0) - dropped + waiting,
+            'conversations': conversations,
+        }
+        if unfinished or report['dropped']:
+            logger.warning("Bot stopped: {}", report)
+        else:
+            logger.info("Bot stopped: {}", report)
+        self.started = False
+        return report
+            
+    def broadcast(self, chat_ids, message, token=None, wait=True, **kwargs):
+        """
+        Send a message to a large set of chats, see ninagram.broadcast.
+        
+        Params:
+            - chat_ids: a queryset or an iterable of chat ids
+            - message: the text to send
+            - token(optional): the token of the bot sending, the first one by default
+            - wait(optional): False to run the broadcast in a thread
+            - name, chunk_size, parse_mode, reply_markup(optional): see Broadcaster
+            
+        Returns: the report of the broadcast, or the Broadcaster if wait is False
+        """
+        from .broadcast import broadcast
+        if token is None:
+            token = next(iter(self.tokens))
+        return broadcast(self.tokens[token]['bot'], chat_ids, message, wait=wait, **kwargs)
             
     def install_accept_all(self):
         cmd = MessageHandler(telegram.ext.filters.Filters.all, generic_processor)
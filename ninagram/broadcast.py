@@ -0,0 +1,202 @@
+"""
+This module contains the broadcast of a message to a large set of chats.
+
+The chat ids are read in chunks from a queryset or an iterator and sent
+through the outbound delivery (see ninagram.delivery) in its BROADCAST lane,
+so the replies to the users still go first and the flood limits of the bot
+are respected. The progress is saved in a Broadcast instance after each
+chunk, a broadcast started again with the same name resumes where it
+stopped. With purge the Broadcast is deleted once done, so a broadcast sent
+again and again under one name (e.g. by an action) resumes after a crash
+without leaving rows behind.
+
+Note that Telegram doesn't allow more than about 30 messages per second to
+different chats: the throughput of a broadcast is the RATE of the delivery,
+not the number of senders.
+"""
+import itertools
+import time
+from threading import Thread, Condition
+from django.db import close_old_connections
+from django.db.models import QuerySet
+from django.utils import timezone
+from loguru import logger
+from .delivery import get_delivery, BROADCAST
+from .metrics import Metrics
+
+
+class Broadcaster:
+    """
+    Send a message to a set of chats.
+
+    Params:
+        - bot: the telegram.Bot sending the message
+        - chat_ids: a queryset or an iterable of chat ids or of instances
+        whose pk is the chat id (Chat, TgUser)
+        - message: the text to send
+        - name(optional): the name of the Broadcast saving the progress
+        - chunk_size(optional): the number of chats read and sent between
+        two checkpoints (default 1000)
+        - parse_mode, reply_markup(optional): passed to sendMessage
+        - purge(optional): True to delete the Broadcast once done, a finished
+        broadcast started again with the same name is then sent again
+    """
+
+    metrics = Metrics("broadcast")
+
+    def __init__(self, bot, chat_ids, message, name=None, chunk_size=1000, parse_mode=None,
+                 reply_markup=None, purge=False):
+        self.bot = bot
+        self.chat_ids = chat_ids
+        self.message = message
+        self.name = name or "broadcast-{}".format(int(time.time() * 1000))
+        self.chunk_size = max(1, int(chunk_size))
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.purge = purge
+
+        self.sent = 0
+        self.failed = 0
+        # the messages sent before a resume
+        self.already_sent = 0
+        # the sends of the current chunk not finished yet
+        self.waiting = 0
+        self.changed = Condition()
+        self.record = None
+        self.started = None
+        self.finished = None
+
+    def get_chunks(self, position):
+        """Yield the lists of chat ids not processed yet"""
+        chat_ids = self.chat_ids
+        if isinstance(chat_ids, QuerySet):
+            # we need a stable order to resume at a position
+            if not chat_ids.ordered:
+                chat_ids = chat_ids.order_by('pk')
+            items = chat_ids[position:].iterator(chunk_size=self.chunk_size)
+        else:
+            items = itertools.islice(iter(chat_ids), position, None)
+
+        while True:
+            chunk = [getattr(item, 'pk', item) for item in itertools.islice(items, self.chunk_size)]
+            if not chunk:
+                return
+            yield chunk
+
+    def on_sent(self, res):
+        with self.changed:
+            self.sent += 1
+            self.waiting -= 1
+            self.changed.notify_all()
+        self.metrics.incr('sent')
+
+    def on_error(self, error):
+        with self.changed:
+            self.failed += 1
+            self.waiting -= 1
+            self.changed.notify_all()
+        self.metrics.incr('failed')
+
+    def send(self, chat_id):
+        return self.bot.send_message(chat_id, self.message, parse_mode=self.parse_mode,
+                                     reply_markup=self.reply_markup)
+
+    def run(self):
+        """
+        Send the message to all the chats not reached yet.
+
+        Returns: the report of the broadcast, see `report`
+        """
+        from .models import Broadcast
+        self.record = Broadcast.objects.get_or_create(name=self.name,
+                                                      defaults={'message': self.message})[0]
+        if self.record.done and self.purge:
+            # the previous run ended before its row was deleted
+            self.record.delete()
+            self.record = Broadcast.objects.create(name=self.name, message=self.message)
+        self.sent = self.record.sent
+        self.failed = self.record.failed
+        self.already_sent = self.sent
+        position = self.record.position
+        self.started = time.time()
+        if self.record.done:
+            logger.info("broadcast {} is already done", self.name)
+            return self.report()
+
+        if position:
+            logger.info("resuming broadcast {} at {}", self.name, position)
+
+        delivery = get_delivery()
+        try:
+            for chunk in self.get_chunks(position):
+                for chat_id in chunk:
+                    with self.changed:
+                        self.waiting += 1
+                    if not delivery.submit(self.bot, lambda chat_id=chat_id: self.send(chat_id),
+                                           chat_id=chat_id, priority=BROADCAST,
+                                           callback=self.on_sent, errback=self.on_error):
+                        # the delivery is shut down, the chunk will be sent again
+                        logger.warning("broadcast {} interrupted at {}", self.name, position)
+                        return self.report()
+
+                # the checkpoint is written once the whole chunk is processed,
+                # a crash sends at most one chunk again
+                with self.changed:
+                    while self.waiting:
+                        self.changed.wait()
+                position += len(chunk)
+                self.checkpoint(position)
+                logger.info("broadcast {}: {} sent, {} failed", self.name, self.sent, self.failed)
+
+            self.checkpoint(position, done=True)
+            if self.purge:
+                Broadcast.objects.filter(pk=self.record.pk).delete()
+        finally:
+            self.finished = time.time()
+            close_old_connections()
+        return self.report()
+
+    def checkpoint(self, position, done=False):
+        from .models import Broadcast
+        # update() skips auto_now, last_update is set here
+        Broadcast.objects.filter(pk=self.record.pk).update(position=position, sent=self.sent,
+                                                           failed=self.failed, done=done,
+                                                           last_update=timezone.now())
+        self.record.position = position
+        self.record.done = done
+
+    def report(self):
+        """
+        Return a dict with the name, the number of sent messages and of
+        failures, the position in the chats, the duration in seconds, the
+        messages sent per second by this run and whether the broadcast is done
+        """
+        end = self.finished or time.time()
+        seconds = end - self.started if self.started else 0
+        return {
+            'name': self.name,
+            'sent': self.sent,
+            'failed': self.failed,
+            'position': self.record.position if self.record else 0,
+            'seconds': seconds,
+            'rate': (self.sent - self.already_sent) / seconds if seconds else 0,
+            'done': bool(self.record and self.record.done),
+        }
+
+
+def broadcast(bot, chat_ids, message, wait=True, **kwargs):
+    """
+    Send a message to a set of chats, see Broadcaster for the arguments.
+
+    Params:
+        - wait: if False the broadcast runs in a thread and the Broadcaster
+        is returned at once, else the report of the broadcast is returned
+    """
+    broadcaster = Broadcaster(bot, chat_ids, message, **kwargs)
+    if wait:
+        return broadcaster.run()
+
+    thread = Thread(target=broadcaster.run, name=broadcaster.name)
+    thread.setDaemon(True)
+    thread.start()
+    return broadcaster
@@ -1,11 +1,17 @@
 from threading import Thread, Lock
-from queue import Queue
+from queue import Queue, Empty, Full
+from collections import OrderedDict
 try:
     from loguru import logger
 except:
     pass
 import time
-from .runtime import Runtime
+from .runtime import Runtime, get_settings
+from .metrics import Metrics
+from .backends.local import NegativeCache
+from .backends.shared import SharedCache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction, close_old_connections
 from django.db.utils import IntegrityError
 
 
@@ -13,24 +19,269 @@ class Saver(Thread):
     """This thread is just there to save model instance asynchronously.
     This allow others parts of the code to not block while writing in the database.
     It helps for bot that handle many users.
+    
+    The queue is drained by batches of NINAGRAM['SAVER_BATCH'] items (default 
+    100). In a batch the saves of the same instance are coalesced, the last 
+    write wins, and everything is written in one transaction. The models with 
+    `bulk_save = True` are written with bulk_create when they are inserted 
+    with a known pk (force_insert) and with bulk_update when they are already 
+    in the database, the others with save().
+    
+    Each Saver has its own bounded queue, see SaverPool.
     """
 
-    queue = Queue()
+    metrics = Metrics("saver")
+    
+    def __init__(self, queue_size=0, batch_size=None, name="saver"):
+        super().__init__(name=name)
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size or get_settings('SAVER_BATCH', 100)
+        self.setDaemon(True)
 
     def run(self):
         while True:
-            instance, kwargs = self.queue.get()
-            try:
-                cached = kwargs.pop('cached', None)
-                instance.save(**kwargs)
+            items = [self.queue.get()]
+            # we take what is already waiting without blocking
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Empty:
+                    break
                 
-                if cached:
-                    Runtime().set_cache(instance.__class__.__name__, instance.id, instance)
-            except IntegrityError:
-                pass
+            started = time.time()
+            try:
+                self.save_batch(items)
             except Exception as e:
                 logger.exception(str(e))
-            self.queue.task_done()
+            finally:
+                for item in items:
+                    self.queue.task_done()
+                    
+            self.metrics.observe('flush_latency', time.time() - started)
+            self.metrics.observe('batch_size', len(items))
+            
+    def coalesce(self, items):
+        """
+        Merge the saves of the same instance.
+        
+        Returns: a list of (instance, kwargs) in the order of their first save
+        """
+        merged = OrderedDict()
+        for instance, kwargs in items:
+            kwargs = dict(kwargs)
+            if instance.pk is not None:
+                key = (instance.__class__, instance.pk)
+            else:
+                key = id(instance)
+                
+            previous = merged.get(key)
+            if previous is not None:
+                self.metrics.incr('coalesced')
+                prev_kwargs = previous[1]
+                # the row must still be inserted if a previous save did it
+                if prev_kwargs.get('force_insert'):
+                    kwargs.pop('force_update', None)
+                    kwargs['force_insert'] = True
+                if prev_kwargs.get('cached'):
+                    kwargs['cached'] = True
+                # both saves must be written, all the fields if one needs them
+                fields = prev_kwargs.get('update_fields'), kwargs.get('update_fields')
+                if None in fields:
+                    kwargs.pop('update_fields', None)
+                else:
+                    kwargs['update_fields'] = list(OrderedDict.fromkeys(
+                        list(fields[0]) + list(fields[1])))
+                    
+            merged[key] = (instance, kwargs)
+            
+        return list(merged.values())
+    
+    def save_batch(self, items):
+        close_old_connections()
+        
+        bulk_inserts = OrderedDict()
+        bulk_updates = OrderedDict()
+        singles = []
+        for instance, kwargs in self.coalesce(items):
+            model = instance.__class__
+            options = set(kwargs) - {'cached', 'force_insert', 'force_update'}
+            bulk = getattr(model, 'bulk_save', False) and not options and instance.pk is not None
+            if bulk and kwargs.get('force_insert'):
+                # a new row whose pk is known
+                bulk_inserts.setdefault(model, []).append((instance, kwargs))
+            elif bulk and not instance._state.adding:
+                # a row read from or written to the database
+                bulk_updates.setdefault(model, []).append((instance, kwargs))
+            else:
+                # save() gets the pk of a new row, or inserts a row it can't update
+                singles.append((instance, kwargs))
+        
+        saved = []
+        with transaction.atomic():
+            for model, group in bulk_inserts.items():
+                saved += self.bulk_write(model, group, insert=True)
+            for model, group in bulk_updates.items():
+                saved += self.bulk_write(model, group, insert=False)
+            for instance, kwargs in singles:
+                if self.save_one(instance, kwargs):
+                    saved.append((instance, kwargs))
+                
+        self.metrics.incr('saved', len(saved))
+        # the caches are updated once the transaction is committed
+        for instance, kwargs in saved:
+            if isinstance(instance, SimpleCache) and (instance.shared_cache or
+                                                      kwargs.get('cached')):
+                # write-through, the others processes see the new instance
+                try:
+                    instance.cache_update(local=kwargs.get('cached'))
+                except Exception as e:
+                    logger.exception(str(e))
+                
+    def bulk_write(self, model, group, insert):
+        """Write a group of instances of a model with one query. If it fails the 
+        instances are saved one by one."""
+        instances = [instance for instance, kwargs in group]
+        for instance in instances:
+            instance.prepare_bulk_save()
+        
+        try:
+            with transaction.atomic():
+                if insert:
+                    model.objects.bulk_create(instances)
+                else:
+                    fields = [field.name for field in model._meta.concrete_fields
+                              if not field.primary_key]
+                    model.objects.bulk_update(instances, fields)
+            return group
+        except IntegrityError:
+            # a row inserted already, the others are written one by one
+            pass
+        except Exception as e:
+            logger.exception(str(e))
+        return [(instance, kwargs) for instance, kwargs in group
+                if self.save_one(instance, kwargs)]
+            
+    def save_one(self, instance, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.pop('cached', None)
+        try:
+            with transaction.atomic():
+                instance.save(**kwargs)
+            return True
+        except IntegrityError:
+            pass
+        except Exception as e:
+            logger.exception(str(e))
+            self.metrics.incr('failed')
+        return False
+    
+    def wait(self, deadline=None):
+        """
+        Wait until all the items of the queue are saved.
+        
+        Params:
+            - deadline: the time.time() after which we stop waiting, None to wait forever
+            
+        Returns: the number of items still waiting
+        """
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                if deadline is None:
+                    self.queue.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.queue.all_tasks_done.wait(remaining)
+            return self.queue.unfinished_tasks
+
+
+class SaverPool:
+    """
+    A pool of Saver threads. The writes are sharded by model and primary key 
+    so the writes of a row are always done by the same Saver, in order.
+    
+    It is configured with the NINAGRAM settings:
+        - SAVER_WORKERS: the number of Saver threads (default 2)
+        - SAVER_QUEUE_SIZE: the maximum number of waiting items per Saver (default 10000)
+        - SAVER_OVERFLOW: "block" to wait for room in a full queue or "drop" to 
+        shed the write (default "block")
+        - SAVER_BATCH: see Saver
+    """
+    
+    def __init__(self, workers=2, queue_size=10000, overflow="block"):
+        if overflow not in ("block", "drop"):
+            raise ValueError("overflow must be block or drop")
+        
+        self.overflow = overflow
+        self.savers = [Saver(queue_size, name="saver-{}".format(i)) 
+                       for i in range(max(1, int(workers)))]
+        for saver in self.savers:
+            saver.start()
+            
+    def get_saver(self, instance):
+        """
+        Return the Saver of an instance. An instance always goes to the same 
+        Saver, so its writes stay in order: the shard of an instance saved 
+        before it has a pk is kept on the instance.
+        """
+        key = getattr(instance, '_saver_shard', None)
+        if key is None:
+            if instance.pk is not None:
+                key = hash((instance.__class__.__name__, instance.pk))
+            else:
+                key = id(instance)
+                instance._saver_shard = key
+        return self.savers[key % len(self.savers)]
+    
+    def put(self, instance, kwargs):
+        """
+        Queue a write.
+        
+        Returns: False if the write was dropped because the queue is full
+        """
+        saver = self.get_saver(instance)
+        if self.overflow == "block":
+            saver.queue.put((instance, kwargs))
+            return True
+        
+        try:
+            saver.queue.put_nowait((instance, kwargs))
+            return True
+        except Full:
+            Saver.metrics.incr('dropped')
+            logger.error("The Saver queue is full, {} not saved", repr(instance))
+            return False
+        
+    def qsize(self):
+        return sum(saver.queue.qsize() for saver in self.savers)
+        
+    def flush(self, timeout=None):
+        """
+        Wait until all the queued writes are done.
+        
+        Params:
+            - timeout: the maximum time to wait in seconds, None to wait forever
+            
+        Returns: True if everything was written
+        """
+        return self.drain(timeout) == 0
+    
+    def drain(self, timeout=None):
+        """
+        Wait until all the queued writes are done or the timeout is over.
+        
+        Returns: the number of writes still waiting
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        return sum(saver.wait(deadline) for saver in self.savers)
+    
+    def stats(self):
+        """Return the queue depth, the flush latency and the counters of the Savers"""
+        res = Saver.metrics.snapshot()
+        res['gauges']['queue_depth'] = self.qsize()
+        res['gauges']['queues'] = [saver.queue.qsize() for saver in self.savers]
+        return res
 
 
 def save_this(instance, **kwargs):
@@ -40,13 +291,63 @@ def save_this(instance, **kwargs):
     Args:
         * instance: the model instance
         * cached(optional): if True the model will be updated in the cache
+        
+    Returns: False if the write was dropped, see SaverPool
+    """
+    return get_saver_pool().put(instance, kwargs)
+
+
+_saver_pool = None
+_saver_pool_lock = Lock()
+
+
+def get_saver_pool():
+    """
+    Return the SaverPool of the process, creating it from the settings at the 
+    first call.
+    """
+    global _saver_pool
+    if _saver_pool is None:
+        with _saver_pool_lock:
+            if _saver_pool is None:
+                _saver_pool = SaverPool(workers=get_settings('SAVER_WORKERS', 2),
+                                        queue_size=get_settings('SAVER_QUEUE_SIZE', 10000),
+                                        overflow=get_settings('SAVER_OVERFLOW', "block"))
+    return _saver_pool
+
+
+_shared_cache = None
+
+
+def get_shared_cache():
+    """
+    Return the SharedCache configured with NINAGRAM['CACHE']['BACKEND'], the 
+    name of a cache in settings.CACHES, or None if there is no shared cache.
+    NINAGRAM['CACHE']['SHARED_TIMEOUT'] sets the lifetime of the entries.
     """
-    Saver.queue.put((instance, kwargs))
+    global _shared_cache
+    if _shared_cache is None:
+        conf = get_settings('CACHE', None) or {}
+        if not conf.get('BACKEND'):
+            return None
+        _shared_cache = SharedCache(conf['BACKEND'], timeout=conf.get('SHARED_TIMEOUT'))
+    return _shared_cache
 
 
-saver = Saver()
-saver.setDaemon(True)
-saver.start()
+_negative_cache = None
+
+
+def get_negative_cache():
+    """
+    Return the NegativeCache of the instances known to be missing. The 
+    lifetime of its entries is NINAGRAM['CACHE']['NEGATIVE_TTL'] (default 5 
+    seconds, 0 to disable it).
+    """
+    global _negative_cache
+    if _negative_cache is None:
+        conf = get_settings('CACHE', None) or {}
+        _negative_cache = NegativeCache(ttl=conf.get('NEGATIVE_TTL', 5))
+    return _negative_cache
 
 
 class SimpleCache:
@@ -54,7 +355,17 @@ class SimpleCache:
     This class implements a simple cache. It should be used as a mixing.
     It is based on the simple and useful Runtime class.
     When there is a cache miss then it loads it from Model manager
+    
+    If a shared cache is configured (see get_shared_cache) it is used as a 
+    second level after the Runtime cache, so the processes of the bot share 
+    a warm cache. The Saver writes the saved instances through to it.
+    
+    Only the models with `shared_cache = True`, those looked up through 
+    cache_get/cache_lookup, are put in the shared cache: the others would 
+    only evict useful entries.
     """
+    
+    shared_cache = False
 
     @classmethod
     def cache_get(cls, pkid):
@@ -72,16 +383,104 @@ class SimpleCache:
         Raise:
             - cls.DoesNotExist: in case of an id not found
         """
+        return cls.cache_lookup(pkid, lambda: cls.objects.get(pk=pkid))
+
+    @classmethod
+    def cache_lookup(cls, pkid, load):
+        """
+        This method looks for the instance in the Runtime cache, then in the 
+        shared cache and at last calls load() to get it.
+        
+        Params:
+            - pkid: the cache key of the instance
+            - load: a callable returning the instance from the database
+        """
+        instance = cls.cache_peek(pkid)
+        if instance is not None:
+            return instance
+        
+        # a missing instance is not looked for again for a few seconds
+        negative = get_negative_cache()
+        if negative.contains(cls.__name__, pkid):
+            raise cls.DoesNotExist("%s %s not found (cached)" % (cls.__name__, pkid))
+        
+        # if there is no result we get from database and cache it
+        try:
+            instance = load()
+        except ObjectDoesNotExist:
+            negative.add(cls.__name__, pkid)
+            raise
+        Runtime().set_cache(cls.__name__, pkid, instance)
+        shared = get_shared_cache() if cls.shared_cache else None
+        if shared is not None:
+            shared.set(cls.__name__, pkid, instance)
+
+        return instance
+    
+    @classmethod
+    def cache_peek(cls, pkid):
+        """
+        This method looks for the instance in the Runtime cache, then in the 
+        shared cache, without touching the database.
+        
+        Return:
+            - instance of the Model or None if it is not cached
+        """
         # we cache the result by their model
         model_name = cls.__name__
         runtime = Runtime()
         instance = runtime.get_cache(model_name, pkid)
-        if instance is None:
-            # if there is no result we get from database and cache it
-            instance = cls.objects.get(pk=pkid)
-            runtime.set_cache(model_name, pkid, instance)
-
+        if instance is not None:
+            return instance
+        
+        shared = get_shared_cache() if cls.shared_cache else None
+        if shared is not None:
+            instance = shared.get(model_name, pkid)
+            if instance is not None:
+                runtime.set_cache(model_name, pkid, instance)
+                
         return instance
+    
+    def cache_key(self):
+        """Return the key of this instance in the cache"""
+        return self.pk
+    
+    def cache_update(self, local=True):
+        """
+        This method puts this instance in the caches.
+        
+        Params:
+            - local: if False only the shared cache is updated
+        """
+        model_name = self.__class__.__name__
+        key = self.cache_key()
+        get_negative_cache().discard(model_name, key)
+        if local:
+            Runtime().set_cache(model_name, key, self)
+            
+        shared = get_shared_cache() if self.shared_cache else None
+        if shared is not None:
+            shared.set(model_name, key, self)
+
+    def cache_delete(self):
+        """
+        This method removes this instance from the Runtime cache and the shared
+        cache, it is loaded from the database at its next lookup.
+        """
+        model_name = self.__class__.__name__
+        key = self.cache_key()
+        Runtime().delete_cache(model_name, key)
+        shared = get_shared_cache() if self.shared_cache else None
+        if shared is not None:
+            shared.delete(model_name, key)
+
+    def prepare_bulk_save(self):
+        """
+        This method is called by the Saver before writing this instance with a
+        bulk query, which doesn't call save(). Models with `bulk_save = True`
+        do here what their save() method does.
+        """
+        pass
 
     def save_after(self, **kwargs):
         """
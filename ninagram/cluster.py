@@ -0,0 +1,338 @@
+"""
+This module contains the multi-process polling mode of runbot (--workers N).
+
+One Python process is bound by the GIL, so the updates are processed by N
+worker processes:
+    - a poller process per token calls getUpdates and sends each update to a
+    worker chosen by its chat id, so the updates of a conversation (and its
+    Runtime data) always go to the same worker
+    - each worker initializes the Bot and processes its updates with its own
+    worker pool, like the webhook does
+    - the supervisor (the runbot process) restarts the processes that die and
+    logs the load of each worker
+
+The updates reach a worker through a pipe that outlives it: the updates
+waiting when a worker is restarted are processed by the new one. A worker
+being the only reader of its pipe, a worker killed while waiting for an
+update doesn't lock it, unlike a multiprocessing.Queue. A poller keeps its
+offset in shared memory, so a restarted poller doesn't fetch the confirmed
+updates again.
+
+Telegram only allows one getUpdates consumer per token, so this mode can't
+be spread over several hosts: use the webhook with the shared deduplication
+(see ninagram.updates) behind a load balancer for that.
+
+The NINAGRAM settings used are:
+    - CLUSTER_POLL_TIMEOUT: the long polling timeout in seconds (default 10)
+    - CLUSTER_REPORT_INTERVAL: the seconds between two load reports (default 60)
+"""
+import multiprocessing
+import signal
+import time
+from threading import Thread
+from django import db
+from django.conf import settings
+from loguru import logger
+
+
+def get_shard(update, workers):
+    """Return the index of the worker processing an update"""
+    chat = update.effective_chat
+    if chat is not None:
+        return abs(chat.id) % workers
+
+    user = update.effective_user
+    if user is not None:
+        return abs(user.id) % workers
+    return update.update_id % workers
+
+
+def handle_signals(stop):
+    """
+    Set the signal handlers of a child process. The supervisor handles SIGINT
+    and SIGTERM for the whole cluster, so a SIGTERM sent to the process group
+    (systemd, docker stop) doesn't kill the children before they drain. A
+    child only exits on SIGTERM once the cluster is stopping, see Cluster.stop.
+    """
+    def on_term(signum, frame):
+        if stop.is_set():
+            raise SystemExit(1)
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, on_term)
+
+
+def run_poller(token, outputs, offset, stop):
+    """
+    Fetch the updates of a token and send them to the workers.
+
+    Params:
+        - token: the token of the bot
+        - outputs: the WorkerOutput of each worker
+        - offset: a shared Value with the next update_id to fetch
+        - stop: an Event set when the cluster stops
+    """
+    from telegram.error import TelegramError, Conflict
+    from .transport import make_bot
+    handle_signals(stop)
+
+    bot = make_bot(token)
+    timeout = settings.NINAGRAM.get('CLUSTER_POLL_TIMEOUT', 10)
+    try:
+        bot.delete_webhook()
+    except TelegramError as e:
+        logger.exception(str(e))
+
+    errors = 0
+    while not stop.is_set():
+        try:
+            updates = bot.get_updates(offset=offset.value or None, timeout=timeout,
+                                      read_latency=5)
+            errors = 0
+        except Conflict as e:
+            logger.error("another process polls the token {}: {}", token.split(':')[0], e)
+            time.sleep(timeout)
+            continue
+        except TelegramError as e:
+            errors += 1
+            logger.warning("polling failed: {}", e)
+            time.sleep(min(2 ** errors, 30))
+            continue
+
+        for update in updates:
+            outputs[get_shard(update, len(outputs))].send((token, update.to_dict()))
+            offset.value = update.update_id + 1
+
+
+def run_worker(index, tokens, reader, processed, stop):
+    """
+    Process the updates of a pipe until it gives None.
+
+    Params:
+        - index: the number of the worker
+        - tokens: the tokens of the bots
+        - reader: the pipe of the updates, (token, update data) tuples
+        - processed: a shared Value counting the updates processed
+        - stop: an Event set when the cluster stops
+    """
+    from telegram import Update
+    from .bot import Bot
+    from .workers import get_pool, update_key
+    handle_signals(stop)
+
+    def count():
+        with processed.get_lock():
+            processed.value += 1
+
+    def process(dispatcher, update):
+        try:
+            dispatcher.process_update(update)
+        finally:
+            count()
+
+    ninabot = Bot(tokens)
+    ninabot.import_states()
+    logger.info("worker {} started", index)
+
+    try:
+        while True:
+            try:
+                item = reader.recv()
+            except (EOFError, OSError) as e:
+                # the pipe is closed, the supervisor is gone
+                logger.warning("worker {} lost its pipe: {!r}", index, e)
+                break
+            except Exception as e:
+                # a message truncated by a killed poller
+                logger.exception(str(e))
+                continue
+
+            if item is None:
+                break
+
+            token, data = item
+            try:
+                bot, dispatcher = ninabot.webhooks[token]
+                update = Update.de_json(data, bot)
+                if not get_pool().submit(process, dispatcher, update, key=update_key(update)):
+                    count()
+            except Exception as e:
+                logger.exception(str(e))
+                count()
+    finally:
+        # the queued updates, the Saver and the Runtime are flushed
+        report = ninabot.stop()
+        logger.info("worker {} stopped: {}", index, report)
+
+
+class WorkerOutput:
+    """
+    The writing end of the pipe of a worker, shared by the pollers.
+
+    Params:
+        - writer: the Connection the updates are sent to
+        - lock: the Lock of the writers
+        - sent: a shared Value counting the updates sent
+    """
+
+    def __init__(self, writer, lock, sent):
+        self.writer = writer
+        self.lock = lock
+        self.sent = sent
+
+    def send(self, item, count=True):
+        with self.lock:
+            self.writer.send(item)
+            if count:
+                self.sent.value += 1
+
+
+class Cluster:
+    """
+    Start and supervise the pollers and the workers.
+
+    Params:
+        - tokens: the tokens of the bots
+        - workers: the number of worker processes
+    """
+
+    def __init__(self, tokens, workers):
+        # the workers must not inherit the threads or the connections of the
+        # supervisor, nothing else than the settings is loaded here
+        self.context = multiprocessing.get_context('fork')
+        self.tokens = list(tokens)
+        self.workers = max(1, int(workers))
+        self.stop_event = self.context.Event()
+        self.readers = []
+        self.outputs = []
+        for i in range(self.workers):
+            reader, writer = self.context.Pipe(duplex=False)
+            self.readers.append(reader)
+            self.outputs.append(WorkerOutput(writer, self.context.Lock(),
+                                             self.context.Value('q', 0)))
+        self.processed = [self.context.Value('q', 0) for i in range(self.workers)]
+        self.offsets = {token: self.context.Value('q', 0) for token in self.tokens}
+        self.pollers = {}
+        self.worker_processes = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def start_poller(self, token):
+        db.connections.close_all()
+        name = "poller-{}".format(token.split(':')[0])
+        process = self.context.Process(target=run_poller, name=name,
+                                       args=(token, self.outputs, self.offsets[token],
+                                             self.stop_event))
+        # a child left running doesn't keep the supervisor from exiting
+        process.daemon = True
+        process.start()
+        self.pollers[token] = process
+
+    def start_worker(self, index):
+        db.connections.close_all()
+        process = self.context.Process(target=run_worker, name="worker-{}".format(index),
+                                       args=(index, self.tokens, self.readers[index],
+                                             self.processed[index], self.stop_event))
+        process.daemon = True
+        process.start()
+        self.worker_processes[index] = process
+
+    def supervise(self):
+        """Restart the processes that died"""
+        for index, process in list(self.worker_processes.items()):
+            if not process.is_alive():
+                logger.error("worker {} died with code {}, restarting it", index, process.exitcode)
+                self.restarts += 1
+                self.start_worker(index)
+
+        for token, process in list(self.pollers.items()):
+            if not process.is_alive():
+                logger.error("poller {} died with code {}, restarting it", process.name,
+                             process.exitcode)
+                self.restarts += 1
+                self.start_poller(token)
+
+    def get_load(self):
+        """Return the number of updates processed and waiting of each worker"""
+        load = []
+        for index in range(self.workers):
+            processed = self.processed[index].value
+            load.append({'worker': index, 'processed': processed,
+                         'waiting': self.outputs[index].sent.value - processed})
+        return load
+
+    def report(self, previous, elapsed):
+        load = self.get_load()
+        for item, before in zip(load, previous):
+            logger.info("worker {worker}: {rate:.1f} updates/s, {waiting} waiting", rate=(
+                item['processed'] - before['processed']) / elapsed if elapsed else 0, **item)
+        return load
+
+    def run(self):
+        """Start the processes and supervise them until SIGINT or SIGTERM"""
+        for index in range(self.workers):
+            self.start_worker(index)
+        for token in self.tokens:
+            self.start_poller(token)
+        logger.info("{} pollers and {} workers started", len(self.tokens), self.workers)
+
+        def on_signal(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+        interval = settings.NINAGRAM.get('CLUSTER_REPORT_INTERVAL', 60)
+        load = self.get_load()
+        last_report = time.time()
+        while not self.stopping:
+            time.sleep(1)
+            self.supervise()
+            if time.time() - last_report >= interval:
+                now = time.time()
+                load = self.report(load, now - last_report)
+                last_report = now
+
+        return self.stop()
+
+    def stop(self, timeout=None):
+        """
+        Stop the pollers, then let the workers process their pipes and stop.
+
+        Params:
+            - timeout: the time in seconds given to the processes (default
+            NINAGRAM['SHUTDOWN_TIMEOUT'] or 30), None in the setting to wait forever
+
+        Returns: the number of processes that had to be terminated
+        """
+        if timeout is None:
+            timeout = settings.NINAGRAM.get('SHUTDOWN_TIMEOUT', 30)
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.time())
+
+        self.stop_event.set()
+        for process in self.pollers.values():
+            process.join(remaining())
+
+        for index, process in self.worker_processes.items():
+            if process.is_alive():
+                # the pipe of a hung worker may be full, we don't wait for the send
+                sender = Thread(target=self.outputs[index].send, args=(None, False))
+                sender.setDaemon(True)
+                sender.start()
+        for process in self.worker_processes.values():
+            process.join(remaining())
+
+        killed = 0
+        for process in list(self.pollers.values()) + list(self.worker_processes.values()):
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+                killed += 1
+        logger.info("cluster stopped, {} restarts, {} processes terminated", self.restarts, killed)
+        return killed
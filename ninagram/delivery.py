@@ -0,0 +1,389 @@
+"""
+This module contains the outbound delivery of the messages.
+
+The calls to the Bot API that send messages are queued and run by a few sender
+threads, so the threads processing the updates never wait on HTTP. The sends
+respect the flood limits of Telegram with token buckets:
+    - one per bot, about 30 messages per second
+    - one per chat, about 1 message per second in a private chat and 20
+    messages per minute in a group
+When Telegram answers 429 (RetryAfter) the bot is paused for the time asked
+and the call is retried.
+
+The calls have a priority: the replies to the users (INTERACTIVE) are sent
+before the broadcasts (BROADCAST) when both are waiting.
+
+The delivery is enabled with the NINAGRAM['DELIVERY'] setting, a dict with the
+optional keys:
+    - RATE, BURST: the messages per second of a bot and the burst allowed (30, 30)
+    - CHAT_RATE, CHAT_BURST: the same for a private chat (1, 3)
+    - GROUP_RATE, GROUP_BURST: the same for a group or a channel (20 / 60, 3)
+    - SENDERS: the number of sender threads (default 4)
+    - MAX_RETRIES: the number of retries of a failing call (default 3)
+"""
+import heapq
+import time
+from collections import deque
+from threading import Thread, Lock, Condition
+from django.conf import settings
+from loguru import logger
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+from .metrics import Metrics
+
+INTERACTIVE = 0
+BROADCAST = 1
+
+PRIORITIES = (INTERACTIVE, BROADCAST)
+
+
+class TokenBucket:
+    """
+    A token bucket implemented as a virtual scheduler (GCRA): instead of
+    counting the tokens it keeps the time at which the bucket will be full
+    again, so a call can reserve its tokens and learn when it may be sent.
+
+    Params:
+        - rate: the tokens added per second
+        - burst: the maximum number of tokens
+    """
+
+    __slots__ = ('interval', 'burst', 'tat')
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.burst = max(1, burst)
+        # the theoretical arrival time, when all the reserved tokens are used
+        self.tat = 0.0
+
+    def reserve(self, now, cost=1):
+        """Take `cost` tokens and return the time at which they can be used"""
+        tat = max(self.tat, now) + cost * self.interval
+        self.tat = tat
+        return max(now, tat - self.burst * self.interval)
+
+    def pause(self, until):
+        """No token is given before `until`"""
+        self.tat = max(self.tat, until + (self.burst - 1) * self.interval)
+
+    def is_idle(self, now):
+        return self.tat <= now
+
+
+class DeliveryJob:
+    """A call to the Bot API waiting to be sent"""
+
+    __slots__ = ('fn', 'token', 'chat_id', 'cost', 'priority', 'callback', 'errback',
+                 'retries', 'created')
+
+    def __init__(self, fn, token, chat_id, cost, priority, callback, errback):
+        self.fn = fn
+        self.token = token
+        self.chat_id = chat_id
+        self.cost = cost
+        self.priority = priority
+        self.callback = callback
+        self.errback = errback
+        self.retries = 0
+        self.created = time.time()
+
+
+class Delivery:
+    """
+    The queue of the outbound calls and its sender threads.
+
+    A job is first delayed until its chat has tokens, then it waits in the lane
+    of its priority. A sender takes the job of the highest priority, waits for
+    the tokens of the bot and runs it.
+
+    The jobs of a chat are sent one at a time, in the order of their submission
+    within a priority: while a job of a chat is being sent or waits for its
+    retry, the next jobs of the chat are parked behind it.
+    """
+
+    def __init__(self, rate=30, burst=30, chat_rate=1, chat_burst=3, group_rate=20 / 60,
+                 group_burst=3, senders=4, max_retries=3, name="delivery"):
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.metrics = Metrics(name)
+
+        # token -> TokenBucket of the bot
+        self.bots = {}
+        # (token, chat_id) -> TokenBucket of the chat
+        self.chats = {}
+        # the jobs ready to be sent, by priority
+        self.lanes = [deque() for priority in PRIORITIES]
+        # the jobs waiting for their chat, a heap of (time, priority, seq, job)
+        self.delayed = []
+        self.seq = 0
+        # (token, chat_id) -> the job of the chat being sent or retried
+        self.busy = {}
+        # (token, chat_id) -> deque of the jobs waiting for the busy one
+        self.parked = {}
+        # the jobs queued or being sent
+        self.pending = 0
+        self.closed = False
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.idle = Condition(self.lock)
+        self.threads = []
+
+        for i in range(max(1, int(senders))):
+            thread = Thread(target=self.run, name="{}-{}".format(name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def get_chat_bucket(self, token, chat_id, now):
+        """Return the bucket of a chat. Must be called with the lock held"""
+        key = (token, chat_id)
+        bucket = self.chats.get(key)
+        if bucket is None:
+            if len(self.chats) > 10000:
+                # we forget the chats whose bucket is full again
+                for old_key in [k for k, b in self.chats.items() if b.is_idle(now)]:
+                    del self.chats[old_key]
+
+            if chat_id is not None and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chats[key] = bucket
+        return bucket
+
+    def submit(self, bot, fn, chat_id=None, cost=1, priority=INTERACTIVE, callback=None,
+               errback=None):
+        """
+        Queue a call to the Bot API.
+
+        Args:
+            * bot: the telegram.Bot used by fn, its limits are applied
+            * fn: a callable without argument doing the call(s)
+            * chat_id(optional): the chat the call sends to
+            * cost(optional): the number of messages sent by fn
+            * priority(optional): INTERACTIVE or BROADCAST
+            * callback(optional): called with the result of fn once sent
+            * errback(optional): called with the exception if fn failed for good
+
+        Returns: False if the delivery is shut down
+        """
+        job = DeliveryJob(fn, bot.token, chat_id, cost, priority, callback, errback)
+        with self.lock:
+            if self.closed:
+                self.metrics.incr('rejected')
+                return False
+
+            self.pending += 1
+            now = time.time()
+            when = now
+            if chat_id is not None:
+                when = self.get_chat_bucket(job.token, chat_id, now).reserve(now, cost)
+            self.schedule(job, when, now)
+            self.metrics.incr('submitted')
+        return True
+
+    def schedule(self, job, when, now):
+        """Put a job in its lane or in the delayed jobs. Must be called with the lock held"""
+        # a job of the chat may be delayed, the next ones must wait behind it
+        if when > now or self.delayed and job.chat_id is not None:
+            self.seq += 1
+            heapq.heappush(self.delayed, (when, job.priority, self.seq, job))
+        else:
+            self.lanes[job.priority].append(job)
+        self.changed.notify_all()
+        self.metrics.gauge('queue_depth', self.pending)
+
+    def next_job(self):
+        """Wait for a job ready to be sent and return it"""
+        with self.lock:
+            while True:
+                now = time.time()
+                while self.delayed and self.delayed[0][0] <= now:
+                    job = heapq.heappop(self.delayed)[3]
+                    self.lanes[job.priority].append(job)
+
+                job = self.pop_ready()
+                if job is not None:
+                    bucket = self.bots.get(job.token)
+                    if bucket is None:
+                        bucket = self.bots[job.token] = TokenBucket(self.rate, self.burst)
+                    return job, bucket.reserve(now, job.cost)
+
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.changed.wait(timeout)
+
+    def pop_ready(self):
+        """
+        Return the ready job of the highest priority whose chat is free, and
+        mark its chat busy. Must be called with the lock held.
+        """
+        for lane in self.lanes:
+            while lane:
+                job = lane.popleft()
+                if job.chat_id is None:
+                    return job
+
+                key = (job.token, job.chat_id)
+                holder = self.busy.get(key)
+                if holder is None or holder is job:
+                    self.busy[key] = job
+                    return job
+
+                # a job of the chat is in flight, this one must wait for it
+                self.parked.setdefault(key, deque()).append(job)
+        return None
+
+    def release(self, job):
+        """Free the chat of a finished job. Must be called with the lock held"""
+        if job.chat_id is None:
+            return
+
+        key = (job.token, job.chat_id)
+        parked = self.parked.get(key)
+        if parked:
+            # the next job of the chat holds it at once and goes first
+            following = parked.popleft()
+            if not parked:
+                del self.parked[key]
+            self.busy[key] = following
+            self.lanes[following.priority].appendleft(following)
+            self.changed.notify_all()
+        else:
+            self.busy.pop(key, None)
+
+    def run(self):
+        while True:
+            job, when = self.next_job()
+            delay = when - time.time()
+            if delay > 0:
+                # the bot has no token left, we wait for ours
+                time.sleep(delay)
+            self.send(job)
+
+    def send(self, job):
+        try:
+            res = job.fn()
+        except RetryAfter as e:
+            logger.warning("flood limit reached, retry after {}s", e.retry_after)
+            self.metrics.incr('flood_waits')
+            with self.lock:
+                until = time.time() + e.retry_after
+                self.bots[job.token].pause(until)
+                if job.chat_id is not None:
+                    self.get_chat_bucket(job.token, job.chat_id, until).pause(until)
+            self.retry(job, e, until)
+            return
+        except BadRequest as e:
+            # the call itself is wrong (chat not found, bad markup...), it would fail again
+            self.fail(job, e)
+            return
+        except (TimedOut, NetworkError) as e:
+            self.retry(job, e, time.time() + 2 ** job.retries)
+            return
+        except Exception as e:
+            self.fail(job, e)
+            return
+
+        self.metrics.incr('sent', job.cost)
+        self.metrics.observe('latency', time.time() - job.created)
+        self.done(job)
+        if job.callback is not None:
+            try:
+                job.callback(res)
+            except Exception as e:
+                logger.exception(str(e))
+
+    def retry(self, job, error, when):
+        if job.retries >= self.max_retries:
+            self.fail(job, error)
+            return
+
+        job.retries += 1
+        self.metrics.incr('retried')
+        # the job keeps its chat busy, the next jobs of the chat can't overtake it
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.delayed, (when, job.priority, self.seq, job))
+            self.changed.notify_all()
+
+    def fail(self, job, error):
+        logger.error("delivery to {} failed: {}", job.chat_id, error)
+        self.metrics.incr('failed')
+        self.done(job)
+        if job.errback is not None:
+            try:
+                job.errback(error)
+            except Exception as e:
+                logger.exception(str(e))
+
+    def done(self, job):
+        with self.lock:
+            self.release(job)
+            self.pending -= 1
+            self.metrics.gauge('queue_depth', self.pending)
+            if not self.pending:
+                self.idle.notify_all()
+
+    def qsize(self):
+        return self.pending
+
+    def shutdown(self, timeout=None):
+        """
+        Stop accepting calls and wait until the queued ones are sent.
+
+        Params:
+            - timeout: the maximum time to wait in seconds, None to wait forever
+
+        Returns: the number of calls not sent when the timeout is over
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            self.closed = True
+            while self.pending:
+                if deadline is None:
+                    self.idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.idle.wait(remaining)
+            return self.pending
+
+    def stats(self):
+        """Return a snapshot of the delivery metrics"""
+        return self.metrics.snapshot()
+
+
+def is_delivery_enabled():
+    """Return True if the messages are sent through the delivery queue"""
+    return bool(getattr(settings, 'NINAGRAM', {}).get('DELIVERY'))
+
+
+_delivery = None
+_delivery_lock = Lock()
+
+
+def get_delivery(create=True):
+    """
+    Return the Delivery of the process, creating it from the settings at the
+    first call. With create False None is returned if it doesn't exist yet.
+    """
+    global _delivery
+    if _delivery is None and create:
+        with _delivery_lock:
+            if _delivery is None:
+                conf = getattr(settings, 'NINAGRAM', {}).get('DELIVERY') or {}
+                if not isinstance(conf, dict):
+                    conf = {}
+                _delivery = Delivery(rate=conf.get('RATE', 30), burst=conf.get('BURST', 30),
+                                     chat_rate=conf.get('CHAT_RATE', 1),
+                                     chat_burst=conf.get('CHAT_BURST', 3),
+                                     group_rate=conf.get('GROUP_RATE', 20 / 60),
+                                     group_burst=conf.get('GROUP_BURST', 3),
+                                     senders=conf.get('SENDERS', 4),
+                                     max_retries=conf.get('MAX_RETRIES', 3))
+    return _delivery
@@ -0,0 +1,99 @@
+import json
+import time
+import telegram
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.test import RequestFactory
+from ninagram.views import handle_webhook, decode_update, load_webhooks, loads
+from ninagram.workers import get_pool
+
+
+class StubDispatcher:
+    """A dispatcher dropping the updates instead of running the bot"""
+
+    def process_update(self, update):
+        pass
+
+
+class Command(BaseCommand):
+    """
+    Measure the requests per second of the webhook with synthetic updates.
+    
+    The updates are given to a stub dispatcher: the real one would write the 
+    fake users, chats and sessions in the database and call the Bot API for 
+    chats that don't exist. --real-dispatcher runs them anyway, against a 
+    throwaway database and a test token only.
+    """
+
+    help = "Measure the requests per second of the webhook"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=10000,
+                            help="the number of updates sent")
+        parser.add_argument('--chats', type=int, default=1000,
+                            help="the number of different chats of the updates")
+        parser.add_argument('--token', default=None,
+                            help="the token of the webhook, the first of NINAGRAM['TOKENS'] by default")
+        parser.add_argument('--ingress-only', action='store_true',
+                            help="only decode the updates, don't queue them")
+        parser.add_argument('--real-dispatcher', action='store_true',
+                            help="process the updates with the bot, it writes in the database "
+                            "and calls the Bot API")
+
+    def make_body(self, i, chats):
+        chat_id = 100000 + i % chats
+        return json.dumps({
+            'update_id': i,
+            'message': {'message_id': i, 'date': int(time.time()), 'text': 'bench {}'.format(i),
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench',
+                                 'username': 'bench{}'.format(chat_id)}},
+        }).encode()
+
+    def handle(self, *args, **options):
+        tokens = settings.NINAGRAM.get('TOKENS') or []
+        token = options['token'] or (tokens[0] if tokens else None)
+        if token is None:
+            raise CommandError("No token to benchmark, set NINAGRAM['TOKENS'] or --token")
+
+        count = options['requests']
+        bodies = [self.make_body(i, options['chats']) for i in range(count)]
+        secret = settings.NINAGRAM.get('WEBHOOK_SECRET')
+        print("JSON decoder: {}.{}".format(loads.__module__, loads.__name__))
+        
+        if options['real_dispatcher']:
+            self.stderr.write("the updates are processed by the bot, {} fake chats are written "
+                              "in the database".format(min(count, options['chats'])))
+        else:
+            load_webhooks({token: (telegram.Bot(token), StubDispatcher())})
+
+        if options['ingress_only']:
+            start = time.time()
+            for body in bodies:
+                decode_update(token, body, secret)
+            elapsed = time.time() - start
+            print("{} updates decoded in {:.2f}s: {:.0f} requests/s".format(
+                count, elapsed, count / elapsed))
+            return
+
+        factory = RequestFactory()
+        headers = {'HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN': secret} if secret else {}
+        requests = [factory.post('/webhook/{}/'.format(token), body,
+                                 content_type='application/json', **headers)
+                    for body in bodies]
+
+        statuses = {}
+        start = time.time()
+        for request in requests:
+            status = handle_webhook(request, token).status_code
+            statuses[status] = statuses.get(status, 0) + 1
+        answered = time.time() - start
+        unfinished = get_pool().shutdown()
+        processed = time.time() - start
+
+        print("{} requests answered in {:.2f}s: {:.0f} requests/s".format(
+            count, answered, count / answered))
+        print("{} updates processed in {:.2f}s: {:.0f} updates/s ({} unfinished)".format(
+            count, processed, count / processed, unfinished))
+        print("statuses: {}".format(statuses))
+        print("pool: {}".format(get_pool().stats()))
@@ -7,9 +7,24 @@ from ninagram.bot import Bot
 class Command(BaseCommand):
     """Start the bot"""
     
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=0,
+                            help="process the updates in N worker processes (polling mode only)")
+        
     def handle(self, *args, **options):
         print("Starting the bot...")
         
+        if options['workers']:
+            mode = (settings.NINAGRAM.get('WORKING_MODE') or '').lower()
+            if mode != "polling":
+                raise CommandError("--workers is only available in polling mode")
+            
+            # the supervisor doesn't load the bot, each worker does, see ninagram.cluster
+            from ninagram.cluster import Cluster
+            killed = Cluster(settings.NINAGRAM['TOKENS'], options['workers']).run()
+            print("Gracefully exit, {} processes terminated".format(killed))
+            return
+        
         try:
             
             tokens = settings.NINAGRAM['TOKENS']
@@ -27,6 +42,12 @@ class Command(BaseCommand):
                 self.ninabot.idle()
         except Exception as e:
             import traceback
-            traceback.print_exc()        
+            traceback.print_exc()
+        finally:
+            # we don't let the queued writes die with the daemon threads
+            if hasattr(self, 'ninabot'):
+                report = self.ninabot.stop()
+                print("{unfinished} updates unfinished, {saved} instances saved, "
+                      "{dropped} dropped, {conversations} conversations flushed".format(**report))
             
         print("Gracefully exit")
@@ -14,6 +14,7 @@ from ninagram.states.base import *
 from ninagram.response import *
 from base.models import *
 from ninagram.models import *
+from ninagram.broadcast import broadcast
 from loguru import logger
 import traceback
 import re
@@ -0,0 +1,70 @@
+"""
+This module contains a tiny in-process metrics registry used by the
+dispatcher, the Saver and the others subsystems to expose their load.
+"""
+from threading import Lock
+
+
+class Metrics:
+    """
+    A thread-safe collection of counters, gauges and timings.
+
+    Timings are summarized as count, total, min and max so they never grow
+    with the number of observations.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, key, value=1):
+        """Increment the counter `key` by value"""
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, key, value):
+        """Set the current value of the gauge `key`"""
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, key, value):
+        """Record one observation (generally a duration in seconds) of `key`"""
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = {'count': 1, 'total': value, 'min': value, 'max': value}
+                return
+
+            timing['count'] += 1
+            timing['total'] += value
+            if value < timing['min']:
+                timing['min'] = value
+            if value > timing['max']:
+                timing['max'] = value
+
+    def snapshot(self):
+        """
+        Return a copy of all the metrics as a dict.
+
+        Returns: a dict with the keys counters, gauges and timings. Each
+        timing has an extra `avg` key.
+        """
+        with self.lock:
+            timings = {}
+            for key, timing in self.timings.items():
+                timings[key] = dict(timing, avg=timing['total'] / timing['count'])
+
+            return {'name': self.name, 'counters': dict(self.counters),
+                    'gauges': dict(self.gauges), 'timings': timings}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+    def __repr__(self):
+        return "<Metrics {}>".format(self.name)
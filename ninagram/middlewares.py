@@ -2,7 +2,11 @@ import re
 import telegram
 import telegram.ext
 from loguru import logger
+from django.db import connection, transaction
+from django.db.utils import IntegrityError
 from .models import Chat, User, Session, Channel, Group, TgUser
+from .metrics import Metrics
+from .cache import get_negative_cache
 import traceback
 
 
@@ -11,6 +15,173 @@ class Database:
     session = None
     user = None
     chat = None
+    
+    # the permission flags of the user and the chat, preloaded by the 
+    # SessionMiddleware so the authorization checks don't touch the models
+    is_staff = False
+    is_superuser = False
+    chat_is_staff = False
+    chat_type = None
+
+
+class SessionResolver:
+    """
+    This class finds the TgUser, the Chat and the Session of an update:
+        - if the three are cached, no query is done at all
+        - else they are fetched together with one joined query
+        - if the session doesn't exist yet, the missing objects are created 
+        in one transaction
+    The instances found are put in the caches.
+    
+    When the database supports it (INSERT ... ON CONFLICT DO NOTHING and 
+    alike) the new objects are created with upserts: a first contact costs
+    the same small number of queries whatever the objects that already exist, 
+    and concurrent first updates of a user don't conflict. A session found 
+    missing is remembered for a few seconds (see get_negative_cache) so the 
+    following updates go straight to the creation.
+    """
+    
+    metrics = Metrics("sessions")
+    
+    def resolve(self, tg_user: telegram.User, tg_chat: telegram.Chat):
+        """
+        Returns: the (TgUser, Chat, Session) of a telegram user in a telegram chat
+        """
+        res = self.from_cache(tg_user.id, tg_chat.id)
+        if res is not None:
+            self.metrics.incr('cached')
+            self.sync(res, tg_user, tg_chat)
+            return res
+        
+        key = Session.make_key(tg_chat.id, tg_user.id)
+        negative = get_negative_cache()
+        res = None
+        if not negative.contains('Session', key):
+            res = self.from_database(tg_user.id, tg_chat.id)
+            
+        if res is not None:
+            self.metrics.incr('loaded')
+        else:
+            negative.add('Session', key)
+            try:
+                if connection.features.supports_ignore_conflicts:
+                    res = self.upsert(tg_user, tg_chat)
+                else:
+                    res = self.create(tg_user, tg_chat)
+                self.metrics.incr('created')
+            except IntegrityError:
+                # another update of the same user created it meanwhile
+                res = self.from_database(tg_user.id, tg_chat.id)
+                if res is None:
+                    raise
+        
+        for instance in res:
+            instance.cache_update()
+            
+        self.sync(res, tg_user, tg_chat)
+        return res
+    
+    def sync(self, res, tg_user: telegram.User, tg_chat: telegram.Chat):
+        """Schedule the writes of the profiles that changed on telegram"""
+        db_user, db_chat, db_session = res
+        try:
+            db_user.sync_profile(tg_user)
+            if db_chat.type != 'private':
+                db_chat.sync_profile(tg_chat.title, tg_chat.username)
+        except Exception as e:
+            logger.exception(str(e))
+    
+    def from_cache(self, user_id, chat_id):
+        db_session = Session.cache_peek(Session.make_key(chat_id, user_id))
+        if db_session is None:
+            return None
+        
+        db_user = TgUser.cache_peek(user_id)
+        db_chat = Chat.cache_peek(chat_id)
+        if db_user is None or db_chat is None:
+            return None
+        return db_user, db_chat, db_session
+    
+    def from_database(self, user_id, chat_id):
+        db_session = Session.objects.select_related('user', 'user__dj', 'user__chat', 'chat')\
+            .filter(user_id=user_id, chat_id=chat_id).first()
+        if db_session is None:
+            return None
+        return db_session.user, db_session.chat, db_session
+    
+    def create(self, tg_user: telegram.User, tg_chat: telegram.Chat):
+        """Create what is missing of the user, the chat and the session"""
+        with transaction.atomic():
+            db_user = TgUser.cache_peek(tg_user.id) or \
+                TgUser.objects.select_related('dj', 'chat').filter(pk=tg_user.id).first()
+            if db_user is None:
+                db_user = self.create_user(tg_user)
+                
+            if tg_chat.id == db_user.chat_id:
+                db_chat = db_user.chat
+            else:
+                db_chat = Chat.cache_peek(tg_chat.id) or Chat.objects.filter(pk=tg_chat.id).first()
+                if db_chat is None:
+                    grp = Group.custom_save(tg_chat.id, tg_chat.title, tg_chat.username,
+                                            is_supergroup=tg_chat.type == "supergroup")
+                    db_chat = grp.chat
+                    
+            db_session = Session.objects.create(chat=db_chat, user=db_user, state="START")
+            
+        return db_user, db_chat, db_session
+    
+    def upsert(self, tg_user: telegram.User, tg_chat: telegram.Chat):
+        """
+        Insert what may be missing of the user, the chat and the session, 
+        ignoring what already exists, then read them with one query.
+        """
+        with transaction.atomic():
+            if TgUser.cache_peek(tg_user.id) is None:
+                dj_user, chat = self.new_user(tg_user)
+                User.objects.bulk_create([dj_user], ignore_conflicts=True)
+                Chat.objects.bulk_create([chat], ignore_conflicts=True)
+                TgUser.objects.bulk_create([TgUser(id=tg_user.id, dj_id=dj_user.id, chat_id=chat.id)],
+                                           ignore_conflicts=True)
+                
+            if tg_chat.id != tg_user.id and Chat.cache_peek(tg_chat.id) is None:
+                chat_type = "supergroup" if tg_chat.type == "supergroup" else "group"
+                Chat.objects.bulk_create([Chat(id=tg_chat.id, title=tg_chat.title, type=chat_type,
+                                               username=tg_chat.username)], ignore_conflicts=True)
+                Group.objects.bulk_create([Group(chat_id=tg_chat.id)], ignore_conflicts=True)
+                
+            Session.objects.bulk_create([Session(chat_id=tg_chat.id, user_id=tg_user.id, state="START")],
+                                        ignore_conflicts=True)
+            
+        return self.from_database(tg_user.id, tg_chat.id)
+    
+    def new_user(self, tg_user: telegram.User):
+        """Return the unsaved django User and private Chat of a telegram user"""
+        first_name = tg_user.first_name if tg_user.first_name != None else ""
+        last_name = tg_user.last_name if tg_user.last_name != None else ""
+        username = tg_user.username if tg_user.username != None else str(tg_user.id)
+        lang = tg_user.language_code
+        
+        dj_user = User(id=tg_user.id, first_name=first_name, last_name=last_name, username=username)
+        chat = Chat(id=tg_user.id, title=username, username=username, type='private')
+        if lang:
+            chat.lang = lang
+        return dj_user, chat
+    
+    def create_user(self, tg_user: telegram.User):
+        dj_user, chat = self.new_user(tg_user)
+        dj_user.save()
+        chat.save()
+        return TgUser.objects.create(id=tg_user.id, dj=dj_user, chat=chat)
+    
+    def stats(self):
+        return self.metrics.snapshot()
+    
+    
+_resolver = SessionResolver()
+
+
+def get_resolver():
+    return _resolver
 
 
 class SessionMiddleware(telegram.ext.Handler):
@@ -20,12 +191,12 @@ class SessionMiddleware(telegram.ext.Handler):
     If the user and/or chat is new then it creates the objects and save them in the database.
     Here are all the steps performed by the SessionMiddleware:
         1. Checks if the update is from a channel, if yes then save the channel and return
-        2. Check if the user exist in the database, else create it. There are 2 type of users as per
-        our models. TgUser represent a telegram User and User is the django User model
-        3. Check if the chat exists in the database, else created it. Determine the type of 
-        the chat. If it is a group then create a group object and saved it to the database.
-        4. Check if there is an existing session if no then create the corresponding one and save it.
-        5. Attache new attribute .db.user, .db.chat and .db.session to the update received
+        2. Get the user, the chat and the session with the SessionResolver: from the 
+        cache or with one query. There are 2 type of users as per our models. TgUser 
+        represent a telegram User and User is the django User model
+        3. If there is no session yet, create the user, the chat and the session that
+        are missing. If the chat is a group then create a group object too.
+        4. Attache new attribute .db.user, .db.chat and .db.session to the update received
     
     Also note that this class (that is a handler) never return True to not stop the Update that was 
     just augmented.
@@ -42,49 +213,20 @@ class SessionMiddleware(telegram.ext.Handler):
                     logger.exception(str(e))
                 return False
 
-            try:
-                # Try to load the TgUser from the cache
-                db_user = TgUser.cache_get(update.effective_user.id)
-                assert db_user != None
-                
-                # TODO: decide whether or not to check for any changes
-            except:
-                first_name = update.effective_user.first_name if update.effective_user.first_name != None else ""
-                last_name = update.effective_user.last_name if update.effective_user.last_name != None else ""
-                username = update.effective_user.username if update.effective_user.username != None else str(
-                    update.effective_user.id)
-                lang = update.effective_user.language_code
-                
-                dj_user = User.objects.create(
-                    id=update.effective_user.id, first_name=first_name, last_name=last_name, username=username)
-                
-                db_user = TgUser.objects.create(id=update.effective_user.id, dj=dj_user)
-                
-                if lang:
-                    db_user.chat.lang = lang
-                    db_user.chat.save()
-
-            try:
-                db_chat = Chat.cache_get(update.effective_chat.id)
-                assert db_chat != None
-            except:
-                is_supergroup = True if update.effective_chat.type == "supergroup" else False
-                grp = Group.custom_save(update.effective_chat.id, update.effective_chat.title,
-                                        update.effective_chat.username, is_supergroup=is_supergroup)
-                db_chat = grp.chat
-
-            try:
-                db_session = Session.cache_get(chat=db_chat, user=db_user)
-                assert db_session is not None
-            except:
-                db_session = Session.objects.create(
-                    chat=db_chat, user=db_user, state="START")
+            db_user, db_chat, db_session = get_resolver().resolve(update.effective_user,
+                                                                   update.effective_chat)
 
-            # we augment the Update instance.
-            update.db = Database
+            # we augment the Update instance. Each update gets its own Database
+            # because updates are processed concurrently.
+            update.db = Database()
             update.db.session = db_session
             update.db.chat = db_chat
             update.db.user = db_user
+            dj_user = db_user.dj
+            update.db.is_staff = dj_user.is_staff
+            update.db.is_superuser = dj_user.is_superuser
+            update.db.chat_is_staff = db_chat.is_staff
+            update.db.chat_type = db_chat.type
             logger.debug("update.db.session {}", update.db.session)
             logger.debug("update.db.chat {}", update.db.chat)
             logger.debug("update.db.user {}", update.db.user)
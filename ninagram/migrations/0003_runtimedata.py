@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ninagram', '0002_auto_20190822_1727'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RuntimeData',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField()),
+                ('chat_id', models.BigIntegerField()),
+                ('data', models.BinaryField()),
+                ('last_update', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('user_id', 'chat_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ninagram', '0003_runtimedata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('message', models.TextField()),
+                ('position', models.BigIntegerField(default=0)),
+                ('sent', models.BigIntegerField(default=0)),
+                ('failed', models.BigIntegerField(default=0)),
+                ('done', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
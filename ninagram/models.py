@@ -1,10 +1,12 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from timezone_field import TimeZoneField
 from django.contrib.auth import get_user_model
 from django.contrib.admin import site
 from django.conf import settings
 from datetime import datetime
-from .cache import SimpleCache
+import hashlib
+from .cache import SimpleCache, save_this
 from .runtime import Runtime
 try:
     from loguru import logger
@@ -17,6 +19,12 @@ AVAIL_LANGS = getattr(settings, "AVAIL_LANGS", ['en'])
 
 User = get_user_model()
 
+
+def fingerprint(*values):
+    """Return a short hash of the telegram profile values of a user or a chat"""
+    data = "\x00".join("" if value is None else str(value) for value in values)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
 # Create your models here.
 
 
@@ -34,6 +42,8 @@ class Chat(models.Model, SimpleCache):
     timezone: the timezone of this group
     lang: the language of this group"""
 
+    shared_cache = True
+
     id = models.IntegerField(unique=True, primary_key=True)
     join_date = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=255, blank=True, null=True)
@@ -45,6 +55,34 @@ class Chat(models.Model, SimpleCache):
 
     def __str__(self):
         return "%s - %s" % (self.id, self.title)
+    
+    def sync_profile(self, title, username):
+        """
+        Update the title and the username of this chat if they changed on 
+        telegram. The fingerprint of the last values seen is kept on the 
+        cached instance so the check costs no query, and the chat is written 
+        by the Saver only when something changed.
+        
+        Returns: True if the chat was changed
+        """
+        fp = fingerprint(title, username)
+        if getattr(self, 'profile_fingerprint', None) == fp:
+            return False
+        
+        self.profile_fingerprint = fp
+        if self.title == title and self.username == username:
+            return False
+        
+        self.title = title
+        self.username = username
+        self.save_after(cached=True)
+        return True
+    
+    @classmethod
+    def cache_get_or_create(cls, chat_id, title, username, type):
+        """Return the chat from the cache, the database or newly created"""
+        return cls.cache_lookup(chat_id, lambda: cls.objects.get_or_create(
+            id=chat_id, defaults={'title': title, 'type': type, 'username': username})[0])
 
 
 class Group(models.Model, SimpleCache):
@@ -53,6 +91,8 @@ class Group(models.Model, SimpleCache):
     
     chat: the corresponding Chat"""
 
+    shared_cache = True
+
     chat = models.OneToOneField(Chat, models.SET_NULL, null=True)
     
     @property
@@ -74,6 +114,19 @@ class Group(models.Model, SimpleCache):
     def __str__(self):
         return self.title
 
+    @classmethod
+    def make_key(cls, chat_id):
+        """Return the cache key of the group of a chat, it is looked up by its chat"""
+        return "chat:%s" % chat_id
+    
+    @classmethod
+    def cache_get(cls, chat_id):
+        return cls.cache_lookup(cls.make_key(chat_id), 
+                                lambda: cls.objects.select_related('chat').get(chat_id=chat_id))
+    
+    def cache_key(self):
+        return self.make_key(self.chat_id)
+
     @classmethod
     def custom_save(cls, chat_id, title, username, is_staff=False, is_supergroup=False):
         if is_supergroup:
@@ -81,20 +134,10 @@ class Group(models.Model, SimpleCache):
         else:
             cat = "group"
 
-        try:
-            chat = Chat.objects.get(pk=chat_id)
-            if chat.title != title:
-                chat.title = title
-                chat.save()
-        except:
-            chat = Chat.objects.create(id=chat_id, title=title, type=cat, username=username)
-
-        try:
-            grp = Group.objects.get(chat=chat)
-        except:
-            grp = Group.objects.create(chat=chat)
-
-        return grp
+        chat = Chat.cache_get_or_create(chat_id, title, username, cat)
+        chat.sync_profile(title, username)
+        return cls.cache_lookup(cls.make_key(chat.id),
+                                lambda: cls.objects.get_or_create(chat=chat)[0])
 
 
 class TgUser(models.Model, SimpleCache):
@@ -107,6 +150,8 @@ class TgUser(models.Model, SimpleCache):
     is_bot: whether or not the user is a bot
     chat: the private chat of the user"""
 
+    shared_cache = True
+
     id = models.IntegerField(primary_key=True)
     dj = models.OneToOneField(User, models.DO_NOTHING, related_name='tg')
     is_bot = models.BooleanField(default=False)
@@ -114,6 +159,12 @@ class TgUser(models.Model, SimpleCache):
 
     def __str__(self):
         return "%s - %s" % (self.id, self.dj.username)
+    
+    @classmethod
+    def cache_get(cls, pkid):
+        """Like SimpleCache.cache_get, the django user and the private chat are
+        fetched with the same query"""
+        return cls.cache_lookup(pkid, lambda: cls.objects.select_related('dj', 'chat').get(pk=pkid))
 
     def save(self, *args, **kwargs):
         """
@@ -124,6 +175,57 @@ class TgUser(models.Model, SimpleCache):
             self.chat = Chat.objects.get_or_create(id=self.id, title=self.dj.username, 
                         username=self.dj.username, type='private')[0]
         super().save(*args, **kwargs)
+        
+    def sync_profile(self, tg_user):
+        """
+        Update the names and the username of this user (and of its private 
+        chat) if they changed on telegram. Like Chat.sync_profile, the check 
+        uses the fingerprint kept on the cached instance and the changes are 
+        written by the Saver.
+        
+        The language of the private chat is part of the fingerprint but it is 
+        not overwritten, it may have been chosen in the bot.
+        
+        Returns: True if the user was changed
+        """
+        username = tg_user.username if tg_user.username != None else str(tg_user.id)
+        first_name = tg_user.first_name if tg_user.first_name != None else ""
+        last_name = tg_user.last_name if tg_user.last_name != None else ""
+        fp = fingerprint(username, first_name, last_name, tg_user.language_code)
+        if getattr(self, 'profile_fingerprint', None) == fp:
+            return False
+        
+        self.profile_fingerprint = fp
+        dj = self.dj
+        if (dj.username, dj.first_name, dj.last_name) == (username, first_name, last_name):
+            return False
+        
+        dj.username = username
+        dj.first_name = first_name
+        dj.last_name = last_name
+        save_this(dj)
+        if self.chat is not None:
+            self.chat.sync_profile(username, username)
+        # the shared cache gets the new profile too
+        self.cache_update()
+        return True
+
+
+def django_user_changed(sender, instance, **kwargs):
+    """
+    Remove from the caches the TgUser of a django user saved or deleted. The
+    SessionMiddleware reads the permission flags (is_staff, is_superuser) on 
+    the cached TgUser, a revoked permission must not stay in the cache. 
+    
+    Note that the Runtime caches of the other processes keep their copy until
+    it is evicted or expires (NINAGRAM['CACHE']['TTL']).
+    """
+    for tg_user in TgUser.objects.filter(dj_id=instance.pk).only('pk'):
+        tg_user.cache_delete()
+        
+        
+post_save.connect(django_user_changed, sender=User, dispatch_uid="ninagram_django_user_saved")
+post_delete.connect(django_user_changed, sender=User, dispatch_uid="ninagram_django_user_deleted")
 
 
 class Channel(models.Model, SimpleCache):
@@ -132,6 +234,8 @@ class Channel(models.Model, SimpleCache):
     
     chat: the chat as Chat, that is a channel"""
 
+    shared_cache = True
+
     chat = models.OneToOneField(Chat, models.SET_NULL, null=True)
     
     @property
@@ -146,21 +250,24 @@ class Channel(models.Model, SimpleCache):
         return self.title
 
     @classmethod
-    def custom_save(cls, chat_id, title, username):
-        try:
-            chat = Chat.objects.get(pk=chat_id)
-            if chat.title != title:
-                chat.title = title
-                chat.save()
-        except:
-            chat = Chat.objects.create(id=chat_id, title=title, type='channel', username=username)
-
-        try:
-            chan = Channel.objects.get(chat=chat)
-        except:
-            chan = Channel.objects.create(chat=chat)
+    def make_key(cls, chat_id):
+        """Return the cache key of the channel of a chat, it is looked up by its chat"""
+        return "chat:%s" % chat_id
+    
+    @classmethod
+    def cache_get(cls, chat_id):
+        return cls.cache_lookup(cls.make_key(chat_id), 
+                                lambda: cls.objects.select_related('chat').get(chat_id=chat_id))
+    
+    def cache_key(self):
+        return self.make_key(self.chat_id)
 
-        return chan
+    @classmethod
+    def custom_save(cls, chat_id, title, username):
+        chat = Chat.cache_get_or_create(chat_id, title, username, 'channel')
+        chat.sync_profile(title, username)
+        return cls.cache_lookup(cls.make_key(chat.id),
+                                lambda: cls.objects.get_or_create(chat=chat)[0])
 
 
 class Session(models.Model, SimpleCache):
@@ -179,6 +286,10 @@ class Session(models.Model, SimpleCache):
     user = models.ForeignKey(TgUser, models.CASCADE)
     chat = models.ForeignKey(Chat, models.SET_NULL, null=True)
 
+    shared_cache = True
+    # the Saver writes the sessions with bulk queries
+    bulk_save = True
+
     class Meta:
         unique_together = ('user', 'chat')
 
@@ -186,21 +297,25 @@ class Session(models.Model, SimpleCache):
         self.last_activity = datetime.utcnow()
         super(Session, self).save(force_insert=force_insert, force_update=force_update,
                                   using=using, update_fields=update_fields)
+        
+    def prepare_bulk_save(self):
+        self.last_activity = datetime.utcnow()
+
+    @classmethod
+    def make_key(cls, chat_id, user_id):
+        """Return the cache key of the session of a user in a chat"""
+        # the separator is needed, (1, 23) and (12, 3) would share a key
+        return "%s:%s" % (chat_id, user_id)
 
     @classmethod
     def cache_get(cls, chat, user):
         # we cache the result by their model
-        model_name = cls.__name__
-        runtime = Runtime()
-        pkid = "%s%s" % (chat.id, user.id)
+        pkid = cls.make_key(chat.id, user.id)
         logger.trace("pkid {}", pkid)
-        instance = runtime.get_cache(model_name, pkid)
-        if instance is None:
-            # if there is no result we get from database and cache it
-            instance = cls.objects.get(chat=chat, user=user)
-            runtime.set_cache(model_name, pkid, instance)
-
-        return instance
+        return cls.cache_lookup(pkid, lambda: cls.objects.get(chat=chat, user=user))
+    
+    def cache_key(self):
+        return self.make_key(self.chat_id, self.user_id)
 
     def __str__(self):
         return "%s - %s" % (self.user.dj.username, self.chat.title)
@@ -234,6 +349,9 @@ class Message(models.Model, SimpleCache):
     edit_date = models.DateTimeField(blank=True, null=True)
     reply_to = models.ForeignKey('self', models.DO_NOTHING, null=True, blank=True)
     
+    # the Saver writes the messages with bulk queries
+    bulk_save = True
+    
     def from_tg_msg(self):
         pass
     
@@ -252,4 +370,53 @@ class Media(models.Model, SimpleCache):
     intern = models.FileField(upload_to='ninagram')
     type = models.CharField(max_length=20)
     desc = models.CharField(max_length=255, null=True, blank=True)
-    message = models.ForeignKey(Message, models.DO_NOTHING, null=True, blank=True)
\ No newline at end of file
+    message = models.ForeignKey(Message, models.DO_NOTHING, null=True, blank=True)
+    
+
+class RuntimeData(models.Model):
+    """
+    This model stores the Runtime data of a conversation when the Runtime 
+    uses the database store (see ninagram.backends.storage).
+    
+    user_id: the telegram user id
+    chat_id: the telegram chat id
+    data: the serialized data of the states of the conversation
+    last_update: the last time the data was written"""
+    
+    user_id = models.BigIntegerField()
+    chat_id = models.BigIntegerField()
+    data = models.BinaryField()
+    last_update = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ('user_id', 'chat_id')
+        
+    def __str__(self):
+        return "%s - %s" % (self.user_id, self.chat_id)
+        
+        
+class Broadcast(models.Model):
+    """
+    This model stores the progress of a broadcast (see ninagram.broadcast) so 
+    that it can resume after a crash.
+    
+    name: the unique name of the broadcast
+    message: the text sent
+    position: the number of chats already processed in the list of chats
+    sent: the number of messages sent
+    failed: the number of chats that couldn't be reached
+    done: True when the whole list of chats is processed
+    created: the creation date
+    last_update: the last checkpoint"""
+    
+    name = models.CharField(max_length=255, unique=True)
+    message = models.TextField()
+    position = models.BigIntegerField(default=0)
+    sent = models.BigIntegerField(default=0)
+    failed = models.BigIntegerField(default=0)
+    done = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    last_update = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return "%s - %s/%s" % (self.name, self.sent, self.position)
@@ -1,6 +1,9 @@
 import telegram
 from loguru import logger
 
+SENT = object()
+"""Marks the calls whose returned message is one of the sent messages"""
+
 
 class MenuResponse:
     """
@@ -20,6 +23,78 @@ class MenuResponse:
         self.auto_delete = auto_delete
         self.dispatcher = dispatcher
         
+    def get_calls(self, update:telegram.Update):
+        """
+        Return the Bot API calls applying this response to the update.
+        
+        Args:
+            * update: `telegram.Update` instance
+            
+        Returns: a list of (function, args, kwargs, message) where message is 
+        what the call adds to the sent messages: SENT for the message returned 
+        by the call, None for nothing or a `telegram.Message`
+        """
+        bot = update.effective_message.bot
+        chatid = update.effective_chat.id
+        
+        # we check if it is a callback_query and we must edit the message
+        if update.callback_query != None and self.edit_inline_callback and \
+           len(self.message) < 4001:
+            return [
+                (update.callback_query.answer, (), {}, None),
+                (bot.edit_message_text, (self.message,), 
+                 dict(chat_id=chatid, message_id=update.callback_query.message.message_id, 
+                      reply_markup=self.markup, parse_mode=self.parse_mode), 
+                 update.callback_query.message),
+            ]
+                    
+        if self.edit:
+            return [(bot.edit_message_text, (self.message,), 
+                     dict(chat_id=chatid, message_id=update.message.message_id, 
+                          reply_markup=self.markup, parse_mode=self.parse_mode), 
+                     update.message)]
+        
+        if self.reply:
+            reply_to_id = update.effective_message.message_id
+        else:
+            reply_to_id = None
+            
+        calls = []
+        message = self.message
+        while len(message) > 4000:
+            calls.append((bot.sendMessage, (chatid, message[:4000]), 
+                          dict(parse_mode=self.parse_mode, reply_markup=self.markup, 
+                               reply_to_message_id=reply_to_id), SENT))
+            message = message[4000:]
+            
+        calls.append((bot.sendMessage, (chatid, message), 
+                      dict(parse_mode=self.parse_mode, reply_markup=self.markup, 
+                           reply_to_message_id=reply_to_id), SENT))
+        return calls
+    
+    def run_calls(self, calls, all_send_msg):
+        """
+        Run the calls returned by get_calls, removing them from the list as 
+        they succeed, so that a failing call can be retried without sending 
+        the previous ones again.
+        """
+        # only the sent messages are deleted, not the edited ones
+        deletable = any(call[3] is SENT for call in calls)
+        while calls:
+            fn, args, kwargs, message = calls[0]
+            res = fn(*args, **kwargs)
+            if message is SENT:
+                all_send_msg.append(res)
+            elif message is not None:
+                all_send_msg.append(message)
+            calls.pop(0)
+            
+        if self.auto_delete and deletable:
+            self.auto_delete = int(self.auto_delete)
+            self.all_send_msg = all_send_msg            
+            self.dispatcher.job_queue.run_once(self.delete, self.auto_delete)
+        return all_send_msg
+        
     def apply(self, update:telegram.Update):
         """
         This method apply this response to the update passed in arguments using the Bot instance passed.
@@ -29,50 +104,53 @@ class MenuResponse:
             * bot: `telegram.Bot` object
         """
         try:
-            bot = update.effective_message.bot
-                        
-            # we check if it is a callback_query and we must edit the message
-            if update.callback_query != None and self.edit_inline_callback and \
-               len(self.message) < 4001:
-                update.callback_query.answer()
-                bot.edit_message_text(self.message, chat_id=update.effective_chat.id,
-                                      message_id=update.callback_query.message.message_id, 
-                                      reply_markup=self.markup, parse_mode=self.parse_mode)
-                return [update.callback_query.message]
-                        
-            if self.edit:
-                bot.edit_message_text(self.message, chat_id=update.effective_chat.id,
-                                                  message_id=update.message.message_id, 
-                                                  reply_markup=self.markup, parse_mode=self.parse_mode)
-                return [update.message]
-                        
-            chatid = update.effective_chat.id
+            return self.run_calls(self.get_calls(update), [])
+        except Exception as e:
+            logger.exception(str(e))
             
-            if self.reply:
-                reply_to_id = update.effective_message.message_id
-            else:
-                reply_to_id = None
-                
-            all_send_msg = []
-            while len(self.message) > 4000:
-                msg = bot.sendMessage(chatid, self.message[:4000], parse_mode=self.parse_mode, 
-                                      reply_markup=self.markup, reply_to_message_id=reply_to_id)
-                
-                self.message = self.message[4000:]
-                all_send_msg.append(msg)
+    def apply_queued(self, update:telegram.Update, callback=None, errback=None):
+        """
+        Queue this response in the outbound delivery (see ninagram.delivery) 
+        instead of sending it, the caller doesn't wait for the Bot API.
         
-            msg = bot.sendMessage(chatid, self.message, parse_mode=self.parse_mode,
-                                  reply_markup=self.markup, reply_to_message_id=reply_to_id)
-            all_send_msg.append(msg)
+        Args:
+            * update: `telegram.Update` instance
+            * callback(optional): called with the list of the sent messages
+            * errback(optional): called with the list of the messages sent 
+            before the response failed for good
+            
+        Returns: False if the response couldn't be queued
+        """
+        from ninagram.delivery import get_delivery, INTERACTIVE
+        try:
+            calls = self.get_calls(update)
+            # the answers of the callback queries are not counted by the flood limits
+            cost = len([call for call in calls if call[3] is not None])
+            all_send_msg = []
             
-            if self.auto_delete:
-                self.auto_delete = int(self.auto_delete)
-                self.all_send_msg = all_send_msg            
-                self.dispatcher.job_queue.run_once(self.delete, self.auto_delete)
-                
-            return all_send_msg
+            def failed(error):
+                if errback is not None:
+                    errback(all_send_msg)
+                    
+            return get_delivery().submit(update.effective_message.bot, 
+                                         lambda: self.run_calls(calls, all_send_msg),
+                                         chat_id=update.effective_chat.id, cost=cost, 
+                                         priority=INTERACTIVE, callback=callback, 
+                                         errback=failed)
         except Exception as e:
             logger.exception(str(e))
+            return False
+
+    async def apply_async(self, update:telegram.Update):
+        """
+        The awaitable version of `apply`, used in asyncio mode. The Bot API calls
+        are blocking so they run in the executor of the event loop.
+        
+        Args:
+            * update: `telegram.Update` instance
+        """
+        from ninagram.aio import run_sync
+        return await run_sync(self.apply, update)
             
     def delete(self, *args, **kwargs):
         for msg in self.all_send_msg:
@@ -3,40 +3,284 @@ try:
 except:
     pass
 import time
+from collections import OrderedDict
+from threading import Thread, RLock
+from .backends.local import LocalCache
+from .backends.storage import get_store
+from .metrics import Metrics
+
+
+def get_settings(name, default=None):
+    """Return the NINAGRAM setting `name` or default if Django is not configured"""
+    try:
+        from django.conf import settings
+        return settings.NINAGRAM.get(name, default)
+    except Exception:
+        return default
+
+
+class RuntimeWorker(Thread):
+    """This thread calls a method of the Runtime periodically. It is used to 
+    remove the idle conversations (sweep) and to write the modified ones in 
+    the store (flush). Both work by small batches so they never hold the 
+    Runtime lock for long."""
+
+    def __init__(self, name, interval, callback):
+        super().__init__(name="runtime-{}".format(name))
+        self.interval = interval
+        self.callback = callback
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                count = self.callback()
+                if count:
+                    logger.debug("{}: {} conversations", self.name, count)
+            except Exception as e:
+                logger.exception(str(e))
 
 
 class Runtime:
+    """The Runtime stores the data of the states (steps, errors, hooks...) by
+    conversation, a conversation being a (user_id, chat_id) couple.
+
+    The memory is bounded with the NINAGRAM['RUNTIME'] setting, a dict with the
+    optional keys:
+        - TTL: the idle time in seconds after which a conversation is removed
+        (default 86400, None to keep them forever)
+        - MAX_CONVERSATIONS: the maximum number of conversations kept in memory,
+        the least recently used ones are evicted first (default 100000)
+        - SWEEP_INTERVAL: the period in seconds of the sweeper thread (default 60)
 
-    __data = {}
+    The conversations can be persisted to survive a restart with the keys:
+        - STORE: "memory" (default, nothing is persisted), "database", "cache"
+        or the dotted path of a store class. See ninagram.backends.storage
+        - STORE_OPTIONS: a dict of arguments for the store class
+        - FLUSH_INTERVAL: the period in seconds of the flusher thread (default 1)
+        - FLUSH_BATCH: the maximum number of conversations written at once (default 200)
+    With a persistent store a conversation is loaded at its first access and
+    the conversations accessed since the last flush are written by batches.
+    TTL and MAX_CONVERSATIONS then only limit what is kept in memory."""
+
+    # (user_id, chat_id) -> {'states': {state_name: {key: value}}, 'last': time},
+    # the least recently used conversations come first
+    __data = OrderedDict()
     __instance = None
-    __cache = {}  # we use this for cache
+    __cache = None  # we use this for cache, see get_cache
+    __lock = RLock()
+    __sweeper = None
+    __flusher = None
+    # the conversations accessed since the last flush, key -> conversation
+    __dirty = OrderedDict()
+    
+    metrics = Metrics("runtime")
 
     def __new__(cls, *args, **kwargs):
         if Runtime.__instance is None:
             Runtime.__instance = object.__new__(cls)
+            conf = get_settings('RUNTIME', None) or {}
+            Runtime.ttl = conf.get('TTL', 86400)
+            Runtime.max_conversations = conf.get('MAX_CONVERSATIONS', 100000)
+            Runtime.sweep_interval = conf.get('SWEEP_INTERVAL', 60)
+            Runtime.store = get_store(conf.get('STORE', 'memory'), **conf.get('STORE_OPTIONS', {}))
+            Runtime.flush_interval = conf.get('FLUSH_INTERVAL', 1)
+            Runtime.flush_batch = conf.get('FLUSH_BATCH', 200)
 
         return Runtime.__instance
 
     def __init__(self, *args, **kwargs):
         pass
+    
+    def is_idle(self, conversation, now):
+        return self.ttl is not None and now - conversation['last'] > self.ttl
+    
+    def get_conversation(self, user_id, chat_id, create=False):
+        """This method return the data of a conversation as a dict state_name -> dict.
+        If the conversation is not found (or idle for too long) it returns None, 
+        or an empty conversation if create is True.
+        With a persistent store, a conversation not in memory is loaded from it."""
+        key = (user_id, chat_id)
+        now = time.time()
+        with self.__lock:
+            conversation = self.__data.get(key)
+            if conversation is not None:
+                if not self.is_idle(conversation, now):
+                    conversation['last'] = now
+                    self.__data.move_to_end(key)
+                    self.touch(key, conversation)
+                    return conversation['states']
+                
+                del self.__data[key]
+                self.metrics.incr('expired')
+                
+            # it may have left the memory before being flushed
+            conversation = self.__dirty.get(key)
+                
+        if conversation is None and self.store.persistent:
+            # the store is read outside the lock. Even an empty conversation is
+            # kept so the store is read once per conversation.
+            states = self.store.load(user_id, chat_id)
+            self.metrics.incr('loaded')
+            conversation = {'states': states if states is not None else {}, 'last': now}
+            
+        if conversation is None:
+            if not create:
+                return None
+            conversation = {'states': {}, 'last': now}
+            
+        with self.__lock:
+            # another thread may have loaded it meanwhile
+            current = self.__data.get(key)
+            if current is not None:
+                conversation = current
+            else:
+                self.__data[key] = conversation
+                
+            conversation['last'] = now
+            self.touch(key, conversation)
+            
+            while self.max_conversations is not None and \
+                  len(self.__data) > self.max_conversations:
+                self.__data.popitem(last=False)
+                self.metrics.incr('evicted')
+            
+            self.start_workers()
+                
+            return conversation['states']
+        
+    def touch(self, key, conversation):
+        """This method mark a conversation to be flushed. As the values can be 
+        modified in place (like hooks), every accessed conversation is flushed.
+        Must be called with the lock held"""
+        if self.store.persistent:
+            self.__dirty[key] = conversation
+            
+    def mark_dirty(self, user_id, chat_id):
+        """This method mark a conversation to be flushed after it was modified, 
+        the flusher may have taken it between its access and the change"""
+        if not self.store.persistent:
+            return
+        key = (user_id, chat_id)
+        with self.__lock:
+            conversation = self.__data.get(key)
+            if conversation is not None:
+                self.touch(key, conversation)
+            
+    def start_workers(self):
+        if self.__sweeper is None and self.ttl is not None:
+            Runtime.__sweeper = RuntimeWorker("sweeper", self.sweep_interval, self.sweep)
+            Runtime.__sweeper.start()
+            
+        if self.__flusher is None and self.store.persistent:
+            Runtime.__flusher = RuntimeWorker("flusher", self.flush_interval, self.flush)
+            Runtime.__flusher.start()
+            
+    def flush(self, batch=None):
+        """This method write the modified conversations in the store, by batches.
+        Returns the number of conversations written"""
+        batch = batch or self.flush_batch
+        written = 0
+        while True:
+            with self.__lock:
+                items = []
+                while self.__dirty and len(items) < batch:
+                    key, conversation = self.__dirty.popitem(last=False)
+                    # we copy the states under the lock, the changes made
+                    # after it mark the conversation dirty again
+                    snapshot = {name: dict(values) 
+                                for name, values in conversation['states'].items()}
+                    items.append((key, conversation, snapshot))
+                    
+            if not items:
+                break
+            
+            data = []
+            for key, conversation, snapshot in items:
+                if not snapshot:
+                    continue
+                try:
+                    data.append((key, self.store.serialize(snapshot)))
+                except RuntimeError:
+                    # a value (like a list of hooks) was modified in place
+                    # while being serialized
+                    with self.__lock:
+                        self.__dirty.setdefault(key, conversation)
+                except Exception as e:
+                    logger.error("conversation {} can't be serialized: {}", key, e)
+                    self.metrics.incr('unserializable')
+                    
+            try:
+                self.store.save_many(data)
+                written += len(data)
+                self.metrics.incr('flushed', len(data))
+            except Exception as e:
+                logger.exception(str(e))
+                # we will retry at the next flush
+                with self.__lock:
+                    for key, conversation, snapshot in items:
+                        self.__dirty.setdefault(key, conversation)
+                break
+            
+            if len(items) < batch:
+                break
+            
+        return written
+        
+    def sweep(self, batch=500):
+        """This method remove the idle conversations. The lock is released 
+        after each batch so the request handling is never blocked for long.
+        Returns the number of conversations removed"""
+        removed = 0
+        while True:
+            count = 0
+            with self.__lock:
+                now = time.time()
+                while self.__data and count < batch:
+                    key, conversation = next(iter(self.__data.items()))
+                    # the conversations are ordered by last access
+                    if not self.is_idle(conversation, now):
+                        break
+                    del self.__data[key]
+                    count += 1
+                    
+            removed += count
+            if count < batch:
+                break
+            
+        if removed:
+            self.metrics.incr('expired', removed)
+        return removed
+    
+    def clear_conversation(self, user_id, chat_id):
+        """This method remove all the data of a conversation"""
+        with self.__lock:
+            self.__data.pop((user_id, chat_id), None)
+            self.__dirty.pop((user_id, chat_id), None)
+        self.store.delete(user_id, chat_id)
+    
+    def stats(self):
+        """This method return the number of conversations, expired and evicted"""
+        res = self.metrics.snapshot()['counters']
+        res['conversations'] = len(self.__data)
+        res['dirty'] = len(self.__dirty)
+        return res
 
     def set(self, user_id, chat_id, state_name, key, value):
         """This method set a value for a key for a certain state
         state_name: name of a State
         key: a string
         value: any value to set to the key"""
-        if user_id not in self.__data:
-            self.__data[user_id] = {}
-
-        if chat_id not in self.__data[user_id]:
-            self.__data[user_id][chat_id] = {}
+        states = self.get_conversation(user_id, chat_id, create=True)
+        
+        if state_name not in states:
+            states[state_name] = {}
 
-        if state_name not in self.__data[user_id][chat_id]:
-            self.__data[user_id][chat_id][state_name] = {}
-
-        self.__data[user_id][chat_id][state_name][key] = value
+        states[state_name][key] = value
+        self.mark_dirty(user_id, chat_id)
         logger.trace("set ::{}::{}::{}::{}::{}", user_id, chat_id,
-                     state_name, key, self.__data[user_id][chat_id][state_name][key])
+                     state_name, key, value)
 
     def get(self, user_id, chat_id, state_name, key, default, insert=False):
         """This method get a value of a key for a certain state
@@ -44,16 +288,15 @@ class Runtime:
         key: a string
         default: the value to return if key not found
         insert: if true, if the key is not found, the key with default as value"""
-        logger.trace("get ::{}::{}", user_id, chat_id, repr(self.__data))
-        #print("%s::get"%self.__class__, user_id, chat_id, repr(self.__data))
-        if (user_id not in self.__data) or (chat_id not in self.__data[user_id]) or (state_name not in self.__data[user_id][chat_id]) or (key not in self.__data[user_id][chat_id][state_name]):
+        states = self.get_conversation(user_id, chat_id)
+        if (states is None) or (state_name not in states) or (key not in states[state_name]):
             if insert == True:
                 self.set(user_id, chat_id, state_name, key, default)
             return default
 
         logger.trace("get ::{}::{}::{}::{}::{}", user_id, chat_id,
-                     state_name, key, self.__data[user_id][chat_id][state_name][key])
-        return self.__data[user_id][chat_id][state_name][key]
+                     state_name, key, states[state_name][key])
+        return states[state_name][key]
 
     def set_error(self, user_id, chat_id, state_name, error):
         """This method set the last error for a state
@@ -105,28 +348,35 @@ class Runtime:
     def clear_return(self, user_id, chat_id, state_name):
         self.set(user_id, chat_id, state_name, 'return', False)
 
+    @property
+    def cache(self):
+        """The LocalCache holding the model instances. It is configured with the
+        NINAGRAM['CACHE'] setting, a dict with the optional keys:
+            - MAX_ENTRIES: the maximum number of instances per model (default 50000)
+            - LIMITS: a dict model name -> maximum number of instances
+            - TTL: the idle time in seconds after which an instance expires"""
+        if Runtime.__cache is None:
+            conf = get_settings('CACHE', None) or {}
+            Runtime.__cache = LocalCache(max_entries=conf.get('MAX_ENTRIES', 50000),
+                                         limits=conf.get('LIMITS'), ttl=conf.get('TTL'))
+        return Runtime.__cache
+
     def get_cache(self, model_name, pkid):
         """This method get a model instance from cache/memory. If the cache is (id not found) then it return None."""
-        if model_name not in self.__cache:
-            self.__cache[model_name] = {}
-            return None
-
-        try:
-            instance = self.__cache[model_name][pkid]['instance']
-            self.__cache[model_name][pkid]['last'] = time.time()
-            return instance
-        except Exception as e:
-            #logger.exception(str(e))
-            return None
+        return self.cache.get(model_name, pkid)
 
     def set_cache(self, model_name, pkid, instance):
-        """This method add a model instance in cache/memory."""
-        if model_name not in self.__cache:
-            self.__cache[model_name] = {}
+        """This method add a model instance in cache/memory.
+        The least recently used instances are evicted when the model is full."""
+        return self.cache.set(model_name, pkid, instance)
+
+    def delete_cache(self, model_name, pkid):
+        """This method remove a model instance from cache/memory."""
+        self.cache.delete(model_name, pkid)
 
-        self.__cache[model_name][pkid] = {
-            'instance': instance, 'last': time.time()}
-        return True
+    def cache_stats(self):
+        """This method return the size, hits, misses and evictions of the cache by model."""
+        return self.cache.stats()
 
 
 if __name__ == "__main__":
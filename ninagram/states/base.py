@@ -14,8 +14,130 @@ import re
 import traceback
 from ninagram.exceptions import *
 from django.template import Template, Context
+from django.utils import translation
+from functools import lru_cache
+from threading import Lock
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # python 3.6, the singleton states are not available
+    ContextVar = None
 
 
+class StateContext:
+    """The data of the update being processed by a state. A state keeps it 
+    apart from its own attributes so that one instance can serve several 
+    updates, see `AbstractState.reuse`.
+    
+    post_step is the step of the menu sent for the update, kept when post 
+    runs once the menu is delivered: the next update of the chat may have 
+    changed the step in the meantime."""
+    
+    __slots__ = ('update', 'dispatcher', 'user_id', 'chat_id', 'text', 'as_hook', 'post_step')
+    
+    def __init__(self, update: telegram.Update=None, dispatcher:Dispatcher=None, as_hook=False):
+        self.update = update
+        self.dispatcher = dispatcher
+        self.user_id = update.effective_user.id if update is not None else None
+        self.chat_id = update.effective_chat.id if update is not None else None
+        # the text is got at the first access, see TextAttribute
+        self.text = None
+        self.as_hook = as_hook
+        self.post_step = None
+        
+        
+class ContextAttribute:
+    """An attribute of a state stored in its StateContext"""
+    
+    def __init__(self, name):
+        self.name = name
+        
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return getattr(instance.get_context(), self.name)
+    
+    def __set__(self, instance, value):
+        setattr(instance.get_context(), self.name, value)
+        
+        
+class TextAttribute(ContextAttribute):
+    """The text of the update, got with `get_text` at the first access"""
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        ctx = instance.get_context()
+        if ctx.text is None and ctx.update is not None:
+            ctx.text = instance.get_text()
+        return ctx.text
+
+
+@lru_cache(maxsize=get_settings('TEMPLATE_CACHE_SIZE', 512))
+def get_template(cls, source, language):
+    """Return the compiled Template of a menu message. The templates are 
+    cached by state class, source and language, the least recently used 
+    ones are dropped past NINAGRAM['TEMPLATE_CACHE_SIZE'] (default 512)."""
+    return Template(source)
+
+
+def parse_target(target):
+    """Split the target of a transition "STATE:step" into (state, step). The 
+    state is "" for the current state and the step is None if there is none
+    or if it is not an int."""
+    parts = target.split(':')
+    step = None
+    if len(parts) > 1:
+        try:
+            step = int(parts[1])
+        except ValueError:
+            pass
+    return parts[0], step
+
+
+class TransitionIndex:
+    """The transitions of a state compiled for the lookups of 
+    `next_from_class_data` and `set_step`:
+        - targets: the transition key -> (state, step)
+        - texts: the case-folded transition key -> (state, step)
+        - commands: the case-folded key of the transitions and inlines -> 
+        (position, state, step). The position keeps the order of the keys, 
+        the first key matching the command or its argument wins.
+    When several keys are equal once case-folded, the first one is kept."""
+    
+    def __init__(self, transitions, inlines):
+        self.transitions = transitions
+        self.inlines = inlines
+        self.targets = {}
+        self.texts = {}
+        self.commands = {}
+        
+        for key, target in transitions.items():
+            parsed = parse_target(target)
+            self.targets[key] = parsed
+            self.texts.setdefault(key.casefold(), parsed)
+            
+        # like dict.update, the inlines replace the transitions of the same key
+        # but keep their position
+        all_trans = dict(transitions)
+        all_trans.update(inlines)
+        for position, (key, target) in enumerate(all_trans.items()):
+            self.commands.setdefault(key.casefold(), (position,) + parse_target(target))
+            
+    def find_command(self, command, arg=''):
+        """Return the (state, step) of the first key matching the command or 
+        its argument, or None"""
+        by_command = self.commands.get(command.casefold())
+        by_arg = self.commands.get(arg.casefold())
+        if by_command is None or (by_arg is not None and by_arg[0] < by_command[0]):
+            by_command = by_arg
+        return by_command[1:] if by_command is not None else None
+
+
+def new_state(cls):
+    """Create an empty state instance, used to unpickle the states"""
+    return cls.__new__(cls)
+
 
 class AbstractState:
     """The mother class of others states"""
@@ -28,7 +150,10 @@ class AbstractState:
     menu_message = ""
     # the menu displaying type inline or bottom
     menu_display = "bottom"
-    # a table (dictionary) of transitions
+    # a table (dictionary) of transitions. The transitions, the inlines, 
+    # no_buttons, pre_item and post_item of the class are compiled when the 
+    # state is registered: they must not be changed afterwards, assign new 
+    # ones to the instance instead
     transitions = {}
 
     # the callback to validate the pass for unlocking
@@ -38,26 +163,114 @@ class AbstractState:
     restore_state = None
     # transitions for commands
     inlines = {}
+    # the transitions without button in the menu
+    no_buttons = ()
+    # the text shown before and after the transitions in their button
+    pre_item = {}
+    post_item = {}
     authorization_instances = {"all":[],
                                1: []}
     
+    # how StateFactory.get_state gets the instances of the state:
+    #   - None: a new instance for each call
+    #   - "singleton": one instance for all the updates, the update data is
+    #   kept in a context variable so it can be used concurrently
+    #   - "pool": instances are taken from a pool of at most `pool_size`
+    #   instances and given back by StateFactory.release
+    # Only states which keep no update data in their own attributes, and that
+    # are not installed as hooks, should be reused. __init__ is only called 
+    # when an instance is created.
+    reuse = None
+    pool_size = 32
+    
     __runtime = Runtime()
     
+    # the data of the update being processed, see StateContext
+    update = ContextAttribute('update')
+    dispatcher = ContextAttribute('dispatcher')
+    user_id = ContextAttribute('user_id')
+    chat_id = ContextAttribute('chat_id')
+    text = TextAttribute('text')
+    # if the state is running as a hook or not
+    as_hook = ContextAttribute('as_hook')
+    post_step = ContextAttribute('post_step')
+    
     def __init__(self, update: telegram.Update, dispatcher:Dispatcher, *args, **kwargs):
         assert len(self.transitions) > 0            
-        self.user_id = update.effective_user.id
-        self.chat_id = update.effective_chat.id
-        self.update = update
-        self.dispatcher = dispatcher
-        self.text = self.get_text()
-        # if the state is running as a hook or not
-        self.as_hook = kwargs.get('as_hook', False)
+        self._ctx = StateContext(update, dispatcher, kwargs.get('as_hook', False))
         
         try:
             super().__init__(*args, **kwargs)
         except:
             super().__init__()
             
+    def get_context(self):
+        """Return the StateContext of the update being processed"""
+        ctx = self.__dict__.get('_ctx')
+        if ctx.__class__ is StateContext:
+            return ctx
+        
+        if ctx is None:
+            ctx = self._ctx = StateContext()
+            return ctx
+        
+        # a singleton, the context is in a context variable
+        current = ctx.get(None)
+        if current is None:
+            current = StateContext()
+            ctx.set(current)
+        return current
+    
+    def bind(self, update: telegram.Update, dispatcher:Dispatcher, as_hook=None):
+        """Attach the state to a new update"""
+        if as_hook is None:
+            as_hook = self.as_hook
+        ctx = StateContext(update, dispatcher, as_hook)
+        
+        current = self.__dict__.get('_ctx')
+        if current is not None and current.__class__ is not StateContext:
+            current.set(ctx)
+        else:
+            self._ctx = ctx
+            
+    def set_context(self, ctx: StateContext):
+        """Restore a StateContext got with get_context, e.g. in another thread"""
+        current = self.__dict__.get('_ctx')
+        if current is not None and current.__class__ is not StateContext:
+            current.set(ctx)
+        else:
+            self._ctx = ctx
+            
+    def __getstate__(self):
+        """The compact form of a state, used when it is stored in the Runtime as
+        a hook and the Runtime is persisted. The update, the dispatcher and the
+        text are not kept, they are set again by `bind_hook`."""
+        state = self.__dict__.copy()
+        state.pop('_ctx', None)
+        state['as_hook'] = self.as_hook
+        return state
+    
+    def __reduce_ex__(self, protocol):
+        # the fields are django Fields too, whose __reduce__ would pickle the
+        # whole __dict__ with the update and the dispatcher. Note that 
+        # copy.deepcopy goes through here too: a deep copy has no context.
+        return (new_state, (self.__class__,), self.__getstate__())
+    
+    def __copy__(self):
+        """copy.copy keeps the context (the update, the dispatcher...) shared 
+        with the copy, only pickle and deepcopy drop it"""
+        clone = new_state(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        return clone
+    
+    def __setstate__(self, state):
+        as_hook = state.pop('as_hook', False)
+        # the states saved before the StateContext kept these attributes
+        for attr in ('update', 'dispatcher', 'text', 'user_id', 'chat_id'):
+            state.pop(attr, None)
+        self.__dict__.update(state)
+        self._ctx = StateContext(as_hook=as_hook)
+            
     def set_run(self, key, value):
         self.__runtime.set(self.user_id, self.chat_id, self.name, key, value)
         
@@ -81,13 +294,12 @@ class AbstractState:
         
     def set_step(self, step):
         if isinstance(step, str):
-            try:
-                if step in self.transitions:
-                    step = int(self.transitions[step].split(':')[1])
-            except:
-                import traceback
-                traceback.print_exc()
-                return
+            target = self.get_transition_index(self.transitions, self.inlines).targets.get(step)
+            if target is not None:
+                if target[1] is None:
+                    logger.error("the transition {} of {} has no step", step, self.name)
+                    return
+                step = target[1]
             
         self.__runtime.set_step(self.user_id, self.chat_id, self.name, step)
         
@@ -115,10 +327,16 @@ class AbstractState:
         self.install_hook_next(instance)
         
     def get_hook_next(self):
-        return self.get_run('hook_next', None)
+        return self.bind_hook(self.get_run('hook_next', None))
     
     def get_hook_menu(self):
-        return self.get_run('hook_menu', None)
+        return self.bind_hook(self.get_run('hook_menu', None))
+    
+    def bind_hook(self, hook):
+        """Attach the current update to a hook got back from the Runtime"""
+        if hook is not None:
+            hook.bind(self.update, self.dispatcher)
+        return hook
     
     def get_hook(self, default=None):
         hook1 = self.get_hook_menu()
@@ -153,32 +371,64 @@ class AbstractState:
     def get_cache(self, model_name, pkid):
         return self.__runtime.get_cache(model_name, pkid)
         
+    @classmethod
+    def get_auth_chains(cls, auth):
+        """Return the authorization chains compiled from `auth`, the 
+        authorization_instances of the class: a dict (method name, step) -> 
+        (chain of "all", chain of the step), a chain being a tuple of the 
+        bound methods of the instances. The steps with instances are in the
+        key (None, "steps"). The chains are built at the first use, the 
+        authorization instances must be set when the class is defined."""
+        chains = cls.__dict__.get('_auth_chains')
+        if chains is None or chains[0] is not auth:
+            steps = frozenset(step for step, instances in auth.items()
+                              if step != "all" and instances)
+            chains = cls._auth_chains = (auth, {(None, "steps"): steps})
+        return chains[1]
+    
+    @staticmethod
+    def compile_auth_chain(auth, method_name, step):
+        all_chain = tuple(getattr(instance, method_name) for instance in auth.get("all", ()))
+        step_chain = tuple(getattr(instance, method_name) for instance in auth.get(step, ()))
+        return all_chain, step_chain
+        
     def validate_access(self, update:telegram.Update, menu=None, group=None):
         """Authorize the current updated to be processed.  
         It searches for authentication classes that will return (True, X)  
         for the update. To do this it start by querying all the instances  
         in `authorization_instances`["all"] then the instances specific  
-        to the current step.
+        to the current step. The instances are compiled in chains, see 
+        `get_auth_chains`.
         Params:
             - menu: True if the caller is `self.menu()`
             - group: True if the update comes from a group"""
         
-        step = self.get_step()
+        auth = self.authorization_instances
+        chains = self.get_auth_chains(auth)
+        
         if menu:
-            method_name = 'menu'
+            method_name = 'menu_group' if group else 'menu'
         else:
-            method_name = 'next'
-        
-        if group:
-            method_name += '_group'
+            method_name = 'next_group' if group else 'next'
+            
+        # the step is only needed if it has its own instances
+        steps = chains[(None, "steps")]
+        step = self.get_step() if steps else None
+        if step not in steps:
+            step = None
             
+        chain = chains.get((method_name, step))
+        if chain is None:
+            chain = chains[(method_name, step)] = self.compile_auth_chain(auth, method_name, step)
+        all_chain, step_chain = chain
+        
         allowed = True
         res = None
                     
         # we search for an instance that will return (True, X)
-        if len(self.authorization_instances["all"]) > 0:
-            for auth_instance in self.authorization_instances["all"]:
-                allowed, res = getattr(auth_instance, method_name)(update)
+        if all_chain:
+            for check in all_chain:
+                allowed, res = check(update)
                 if allowed:
                     break
             else:
@@ -186,12 +436,10 @@ class AbstractState:
                 return (allowed, res)
             
         # we see there is autho instances for this step
-        if step in self.authorization_instances and \
-           len(self.authorization_instances) > 0:
-            for auth_instance in self.authorization_instances[step]:
-                allowed, res = getattr(auth_instance, method_name)(update)
-                if allowed :
-                    break
+        for check in step_chain:
+            allowed, res = check(update)
+            if allowed :
+                break
         
         return (allowed, res)
     
@@ -218,65 +466,11 @@ class AbstractState:
         to get the menu from.
         
         You should not override unless you know what you are doing."""
-        
         if update.effective_chat.type == "group" or update.effective_chat.type == "supergroup":
             return self.next_group(update)
         
-        # check if the update is authorized
-        allowed, res = self.validate_access(update)
-        if not allowed:
-            return res
-        
-        step = self.get_step()
-            
-        try:
-            res = self.pre_next(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)
-                return res              
-        except Exception as e:
-            logger.exception(str(e))
-            
-        step = self.get_step()
-        
-        # we call the the pre step method that must perform various operations
-        try:
-            try:
-                pre_step_method = getattr(self, "pre_step_%d_next" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = pre_step_method(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass
-        except Exception as e:
-            logger.exception(str(e))
-            
-        step = self.get_step()        
-            
-        try:
-            try:
-                step_method = getattr(self, "step_%s_next" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = step_method(update)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))        
-            
-        logger.error("No valid NextResponse returned")
-            
+        return self.dispatch('next', update)
+
     def pre_next(self, update: telegram.Update):
         """This method is called before the user defined next method for the current step.
         Use this method typically to short-circuit the user next method.
@@ -294,62 +488,8 @@ class AbstractState:
         the current step. if found it calls it, if not it calls the default pre_next method.
         Then it calls the user defined method for the current step.
         This method is called only if the message come from a group"""
-        
-        # check if the update is authorized
-        allowed, res = self.validate_access(update, group=True)
-        if not allowed:
-            return res
-        
-        step = self.get_step()
-        
-        # we call the the pre step method that must perform various operations
-        try:
-            res = self.pre_next_group(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except Exception as e:
-            logger.exception(str(e))
-            
-        step = self.get_step()
-            
-        try:
-            try:
-                pre_step_method = getattr(self, "pre_step_%d_next_group" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = pre_step_method(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res            
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))
-            
-        step = self.get_step()
-            
-        try:
-            try:
-                step_method = getattr(self, "step_%s_next_group" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = step_method(update)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))   
-            
-        logger.error("No valid NextResponse returned")
-            
+        return self.dispatch('next_group', update)
+
     def pre_next_group(self, update: telegram.Update):
         """This method is called before the user defined next method for the current step.
         Use this method typically to short-circuit the user next method.
@@ -375,68 +515,11 @@ class AbstractState:
         loads the default pre_menu method.
         Then it calls the user implementation of menu method for the current step.
         If the telegram chat type is group or supergroup it reroutes the call to menu_group()"""
-        
         if update.effective_chat.type == "group" or update.effective_chat.type == "supergroup":
             return self.menu_group(update)
         
-        # check if the update is authorized
-        allowed, res = self.validate_access(update, menu=True)
-        if not allowed:
-            return res
-        
-        step = self.get_step()        
-                
-        # we call the the pre step method that must perform various operations
-        try:
-            res = self.pre_menu(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except AttributeError:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))
-        
-        step = self.get_step()
-        
-        # we call the the pre step method that must perform various operations
-        try:
-            try:
-                pre_step_method = getattr(self, "pre_step_%d_menu" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = pre_step_method(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass                
-        except Exception as e:
-            logger.exception(str(e))
-        
-        step = self.get_step()        
-        
-        try:
-            try:
-                step_method = getattr(self, "step_%s_menu" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = step_method(update)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res        
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))        
-        
-        logger.error("Can't get a valid MenuResponse")
-            
+        return self.dispatch('menu', update)
+
     def pre_menu(self, update: telegram.Update):
         """This method is executed before the call of the user menu step method.
         But this is called if the user has not defined a pre_menu method for a the current step
@@ -451,66 +534,8 @@ class AbstractState:
         If the user has not defined a custom method for the step then it 
         loads the default pre_menu method.
         Then it calls the user implementation of menu method for the current step"""
-        
-        # check if the update is authorized
-        allowed, res = self.validate_access(update, menu=True, group=True)
-        if not allowed:
-            return res
-        
-        step = self.get_step()
-        logger.info("step {}", step)
-        
-        # we call the the pre step method that must perform various operations
-        try:
-            res = self.pre_menu_group(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except Exception as e:
-            logger.exception(str(e))
-    
-        step = self.get_step()
-        logger.info("step {}", step)
-    
-        # we call the the pre step method that must perform various operations
-        try:
-            try:
-                pre_step_method = getattr(self, "pre_step_%d_menu_group" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = pre_step_method(update)
-            if res and res.force_return == True:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res 
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))
-    
-        step = self.get_step()  
-    
-        try:
-            try:
-                step_method = getattr(self, "step_%s_menu_group" % step)
-            except:
-                logger.error("not found")
-                raise StepNotFoundException
-            
-            res = step_method(update)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass
-        except Exception as e:
-            logger.exception(str(e))        
-    
-        logger.error("Can't get the menu")     
-            
+        return self.dispatch('menu_group', update)
+
     def pre_menu_group(self, update: telegram.Update):
         """This method is executed before the call of the user menu step method and 
         only if the telegram chat type is a group or a supergroup.
@@ -522,56 +547,11 @@ class AbstractState:
         
     def post(self, update: telegram.Update, tg_message:telegram.Message):
         """This method must be called after the menu has been sent to perfom various actions"""
-        
         if update.effective_chat.type == "group" or update.effective_chat.type == "supergroup":
             return self.post_group(update, tg_message)
         
-        step = self.get_step()        
-                
-        # we call the the pre step method that must perform various operations
-        try:
-            res = self.pre_post(update, tg_message)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res                
-        except Exception as e:
-            logger.exception(str(e))
-            
-                
-        # we call the the pre step method that must perform various operations
-        try:
-            try:
-                pre_step_method = getattr(self, "pre_step_%d_post" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = pre_step_method(update, tg_message)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))
-                
-        try:
-            try:
-                step_method = getattr(self, "step_%s_post" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = step_method(update, tg_message)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))        
-        
+        return self.dispatch('post', update, tg_message)
+
     def pre_post(self, update: telegram.Update, tg_message:telegram.Message):
         """This method is called before the user defined next method for the current step.
         Use this method typically to short-circuit the user next method.
@@ -581,52 +561,8 @@ class AbstractState:
     
     def post_group(self, update: telegram.Update, tg_message:telegram.Message):
         """This is called by `post_menu` if the current chat is a group"""
-        
-        step = self.get_step()        
-                
-        # we call the the pre step method that must perform various operations
-        try:
-            res = self.pre_post_group(update, tg_message)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except Exception as e:
-            logger.exception(str(e))
-        
-        # we call the the pre step method that must perform various operations
-        try:
-            try:
-                pre_step_method = getattr(self, "pre_step_%d_post_group" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = pre_step_method(update, tg_message)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))
-    
-        try:
-            try:
-                step_method = getattr(self, "step_%s_post_group" % step)
-            except:
-                raise StepNotFoundException
-            
-            res = step_method(update, tg_message)
-            if res:
-                if self.as_hook:
-                    return self.return_as_hook(res)                
-                return res
-        except StepNotFoundException:
-            pass        
-        except Exception as e:
-            logger.exception(str(e))        
-            
+        return self.dispatch('post_group', update, tg_message)
+
     def return_as_hook(self, res, value=None):
         from ninagram.response import InputResponse
         if isinstance(res, InputResponse):
@@ -639,9 +575,169 @@ class AbstractState:
         Use this method typically to short-circuit the user next method.
         If you want to move to another intra-state(step) just call self.set_step(yr_step) 
         and to go to an extern state just return the state name as a string"""
-        pass    
+        pass
+
+    @classmethod
+    def get_dispatch_table(cls):
+        """Return the dispatch table of the class, see `compile_dispatch`"""
+        # each class has its own table, the one of the parent class doesn't
+        # know the methods added by the subclass
+        table = cls.__dict__.get('_dispatch')
+        if table is None:
+            table = compile_dispatch(cls)
+        return table
+    
+    def dispatch(self, method, update: telegram.Update, *args):
+        """This method runs the call chain of `next`, `menu`, `post` and their 
+        group variants:
+            - it checks that the update is authorized (except for post)
+            - it calls pre_<method>, for example pre_next
+            - it calls the method of the current step pre_step_<step>_<method> if it exists
+            - it calls the method of the current step step_<step>_<method> if it exists
+        The pre methods stop the chain by returning a response with force_return
+        (any response for post). The step methods are found in the dispatch 
+        table of the class.
+        Params:
+            - method: "next", "menu", "post" or their group variant like "next_group"
+            - args: the extra arguments of the method (tg_message for post)"""
+        pre, pre_steps, steps = self.get_dispatch_table()[method]
+        post = method.startswith('post')
         
+        if not post:
+            # check if the update is authorized
+            allowed, res = self.validate_access(update, menu=method.startswith('menu'), 
+                                                group=method.endswith('_group'))
+            if not allowed:
+                return res
+            
+        # post uses the step of the menu that was sent
+        step = self.post_step if post and self.post_step is not None else self.get_step()
         
+        # we call the the pre method that must perform various operations
+        try:
+            res = pre(self, update, *args)
+            if res and (post or res.force_return == True):
+                if self.as_hook:
+                    return self.return_as_hook(res)
+                return res
+        except Exception as e:
+            logger.exception(str(e))
+            
+        if not post:
+            step = self.get_step()
+            
+        # pre step methods only exist for int steps
+        pre_step_method = pre_steps.get(step) if step.__class__ is int else None
+        if pre_step_method is not None:
+            try:
+                res = pre_step_method(self, update, *args)
+                if res and (post or res.force_return == True):
+                    if self.as_hook:
+                        return self.return_as_hook(res)
+                    return res
+            except Exception as e:
+                logger.exception(str(e))
+                
+        if not post:
+            step = self.get_step()
+            
+        step_method = steps.get(step)
+        if step_method is not None:
+            try:
+                res = step_method(self, update, *args)
+                if res:
+                    if self.as_hook:
+                        return self.return_as_hook(res)
+                    return res
+            except Exception as e:
+                logger.exception(str(e))
+                
+        if not post:
+            logger.error("No valid response returned by {} for the step {}", method, step)
+
+    async def next_async(self, update: telegram.Update):
+        """The awaitable version of `next`, used in asyncio mode.
+        Step methods defined with `async def` are awaited, the others run in
+        the executor of the event loop. If the state overrides `next` then the
+        override is called."""
+        return await self.run_async('next', update)
+
+    async def menu_async(self, update: telegram.Update):
+        """The awaitable version of `menu`, see `next_async`"""
+        return await self.run_async('menu', update)
+
+    async def post_async(self, update: telegram.Update, tg_message:telegram.Message):
+        """The awaitable version of `post`, see `next_async`"""
+        return await self.run_async('post', update, tg_message)
+
+    async def run_async(self, phase, update: telegram.Update, *args):
+        """This method follows the same call chain as `next`, `menu` and `post`
+        (and their group variants) but awaits the coroutine methods.
+        Params:
+            - phase: "next", "menu" or "post"
+            - args: the extra arguments of the phase (tg_message for post)"""
+        from ninagram.aio import call_maybe_async, run_sync
+
+        cls = type(self)
+        if getattr(cls, phase) is not getattr(AbstractState, phase):
+            return await call_maybe_async(getattr(self, phase), update, *args)
+
+        group = update.effective_chat.type == "group" or update.effective_chat.type == "supergroup"
+        method = phase + '_group' if group else phase
+        if group and getattr(cls, method) is not getattr(AbstractState, method):
+            return await call_maybe_async(getattr(self, method), update, *args)
+
+        # post methods are not authorized and don't need to force the return
+        if phase != 'post':
+            allowed, res = await run_sync(self.validate_access, update,
+                                          menu=phase == 'menu', group=group)
+            if not allowed:
+                return res
+
+        def must_return(res):
+            return res and (phase == 'post' or res.force_return == True)
+
+        # post uses the step of the menu that was sent
+        if phase == 'post' and self.post_step is not None:
+            step = self.post_step
+        else:
+            # the step is read from the Runtime, whose store may be the database
+            step = await run_sync(self.get_step)
+
+        try:
+            res = await call_maybe_async(getattr(self, 'pre_' + method), update, *args)
+            if must_return(res):
+                if self.as_hook:
+                    return self.return_as_hook(res)
+                return res
+        except Exception as e:
+            logger.exception(str(e))
+
+        pre, pre_steps, steps = self.get_dispatch_table()[method]
+        for prefix, table in (("pre_step_", pre_steps), ("step_", steps)):
+            if phase != 'post':
+                step = await run_sync(self.get_step)
+
+            # like in the synchronous chain pre step methods only exist for int steps
+            if prefix == "pre_step_" and step.__class__ is not int:
+                continue
+
+            step_method = table.get(step)
+            if step_method is None:
+                continue
+
+            try:
+                res = await call_maybe_async(step_method.__get__(self), update, *args)
+                if (prefix == "step_" and res) or must_return(res):
+                    if self.as_hook:
+                        return self.return_as_hook(res)
+                    return res
+            except Exception as e:
+                logger.exception(str(e))
+
+        logger.error("No valid response returned by {} for the step {}", method, step)
+
+
     def default_context(self, update: telegram.Update):
         """Return the default context"""
         ctx = {'username':update.effective_user.username, 'first_name':update.effective_user.first_name,
@@ -650,9 +746,49 @@ class AbstractState:
             ctx['group_username'] = update.effective_chat.username
         return ctx
         
+    @classmethod
+    def get_keyboard_rows(cls, transitions, no_buttons, pre_item, post_item, menu_type):
+        """Return the rows of buttons of the transitions for a menu type. The 
+        rows of the class data are built once per class and menu type, those 
+        of the data assigned to an instance are built at each call."""
+        is_class_data = (transitions is cls.transitions and no_buttons is cls.no_buttons and 
+                         pre_item is cls.pre_item and post_item is cls.post_item)
+        keyboards = cls.__dict__.get('_keyboards')
+        if keyboards is None:
+            keyboards = cls._keyboards = {}
+        
+        cached = keyboards.get(menu_type)
+        if is_class_data and cached is not None:
+            return cached
+        
+        replies = []
+        buttons = []
+        for state in transitions:
+            if state in no_buttons:
+                continue
+            
+            pre = pre_item[state] if state in pre_item else ''
+            post = post_item[state] if state in post_item else ''
+            state_shown = pre+state+post
+            if menu_type == "inline":
+                buttons.append(InlineKeyboardButton(state_shown, callback_data=state))
+            else:
+                buttons.append(KeyboardButton(state_shown))
+            
+            if len(buttons) == 2:
+                replies.append(tuple(buttons))
+                buttons = []
+        if(len(buttons) > 0):
+            replies.append(tuple(buttons))
+            
+        replies = tuple(replies)
+        if is_class_data:
+            keyboards[menu_type] = replies
+        return replies
+        
     def menu_from_class_data(self, update: telegram.Update, msg=None):
         msg = msg if msg != None else self.menu_message
-        tpl = Template(msg)
+        tpl = get_template(self.__class__, msg, translation.get_language())
         ctx = self.default_context(update)
             
         context = Context(ctx)
@@ -663,35 +799,10 @@ class AbstractState:
         else:
             menu_type = self.menu_display
             
-        if menu_type == "inline":
-            ClassButton = InlineKeyboardButton
-            ClassKeyboard = InlineKeyboardMarkup
-        else:
-            ClassButton = KeyboardButton
-            ClassKeyboard = ReplyKeyboardMarkup
-            
-        replies = []
-        buttons = []
-        i = 0
-        for state in self.transitions:
-            if state in self.no_buttons:
-                continue
-            
-            pre = self.pre_item[state] if state in self.pre_item else ''
-            post = self.post_item[state] if state in self.post_item else ''
-            state_shown = pre+state+post
-            if menu_type == "inline":
-                buttons.append(InlineKeyboardButton(state_shown, callback_data=state))
-            else:
-                buttons.append(KeyboardButton(state_shown))
-            i += 1
-            
-            if i == 2:
-                replies.append(copy(buttons))
-                buttons.clear()
-                i = 0
-        if(len(buttons) > 0):
-            replies.append(copy(buttons))
+        rows = self.get_keyboard_rows(self.transitions, self.no_buttons, self.pre_item, 
+                                      self.post_item, menu_type)
+        # the rows are shared by the renders, the keyboard gets its own lists
+        replies = [list(row) for row in rows]
         logger.trace("replies :: {}", repr(replies))
                 
         if menu_type == "inline":
@@ -702,7 +813,22 @@ class AbstractState:
         logger.debug("{}", message)
         return message, kbd
     
+    @classmethod
+    def get_transition_index(cls, transitions, inlines):
+        """Return the TransitionIndex of the transitions and the inlines. The 
+        index of the class data is built once and kept on the class, the 
+        transitions assigned to an instance are indexed at each call."""
+        index = cls.__dict__.get('_transition_index')
+        if index is not None and index.transitions is transitions and index.inlines is inlines:
+            return index
+        
+        index = TransitionIndex(transitions, inlines)
+        if transitions is cls.transitions and inlines is cls.inlines:
+            cls._transition_index = index
+        return index
+    
     def next_from_class_data(self, update: telegram.Update):
+        index = self.get_transition_index(self.transitions, self.inlines)
         
         if getattr(update.message, 'command', None):
             logger.debug("update.message.command {}", update.message.command)
@@ -719,44 +845,24 @@ class AbstractState:
             arg = ''
             
         if is_command:
-            all_trans = copy(self.transitions)
-            all_trans.update(self.inlines)
-            step = None
-            for key, state in all_trans.items():
-                if key.upper() == update.message.command.upper() or key.upper() == arg.upper():
-                    splitten = state.split(':')
-                    nx_state = splitten[0] if len(splitten[0])>0 else self.name
-                    if len(splitten)>1:
-                        try:
-                            step = int(splitten[1])
-                        except:
-                            step = None
-                        
-                    logger.debug("I return {} and {}", nx_state, step)
-                    return NextResponse(nx_state, step=step, force_return=True)
-            else:
-                if update.message.command.upper() == self.name:
-                    return NextResponse(self.name, force_return=True)                
-                
-                return None
+            command = update.message.command
+            target = index.find_command(command, arg)
+            if target is not None:
+                nx_state, step = target
+                nx_state = nx_state or self.name
+                logger.debug("I return {} and {}", nx_state, step)
+                return NextResponse(nx_state, step=step, force_return=True)
+            
+            if command.upper() == self.name:
+                return NextResponse(self.name, force_return=True)
+            return None
         else:
             text = self.get_text()
-            if text:                    
-                step = None
-                for key, state in self.transitions.items():
-                    if key.upper() == text.upper():
-                        splitten = state.split(':')
-                        try:
-                            nx_state = splitten[0] if splitten[0] else self.name
-                            if len(splitten)>1:
-                                try:
-                                    step = int(splitten[1])
-                                except:
-                                    step = None
-                        except Exception as e:
-                            logger.exception(str(e))
-                            
-                        return NextResponse(nx_state, step=step, force_return=True)
+            if text:
+                target = index.texts.get(text.casefold())
+                if target is not None:
+                    nx_state, step = target
+                    return NextResponse(nx_state or self.name, step=step, force_return=True)
             else:
                 return None
             
@@ -920,6 +1026,12 @@ class StateFactory:
     
     fallback_cls = None
     
+    # the instances of the states reused as singleton, class -> instance
+    singletons = {}
+    # the free instances of the pooled states, class -> list of instances
+    pools = {}
+    lock = Lock()
+    
     @staticmethod
     def set_fallback_class(cls):
         StateFactory.fallback_cls = cls
@@ -933,14 +1045,63 @@ class StateFactory:
         
         if name in StateFactory.states_class:
             cls = StateFactory.states_class[name]
-            state = cls(update, dispatcher, *args, **kwargs)            
         else:
             if StateFactory.fallback_cls is not None:
-                state = StateFactory.fallback_cls
+                cls = StateFactory.fallback_cls
             else:
                 raise StateException("State not found and no fallback State set")
             
-        return state
+        if cls.reuse is None:
+            return cls(update, dispatcher, *args, **kwargs)
+        return StateFactory.get_reused(cls, update, dispatcher, *args, **kwargs)
+    
+    @staticmethod
+    def get_reused(cls, update, dispatcher, *args, **kwargs):
+        """Return an instance of a state class that is reused, see AbstractState.reuse"""
+        as_hook = kwargs.get('as_hook', False)
+        
+        if cls.reuse == "singleton" and ContextVar is not None:
+            state = StateFactory.singletons.get(cls)
+            if state is None:
+                with StateFactory.lock:
+                    state = StateFactory.singletons.get(cls)
+                    if state is None:
+                        state = cls(update, dispatcher, *args, **kwargs)
+                        # from now the update data is kept by context
+                        var = ContextVar("state-%s" % cls.name)
+                        var.set(state._ctx)
+                        state._ctx = var
+                        StateFactory.singletons[cls] = state
+                        return state
+            state.bind(update, dispatcher, as_hook)
+            return state
+        
+        if cls.reuse == "pool":
+            with StateFactory.lock:
+                pool = StateFactory.pools.get(cls)
+                state = pool.pop() if pool else None
+            if state is not None:
+                state.bind(update, dispatcher, as_hook)
+                return state
+            
+        return cls(update, dispatcher, *args, **kwargs)
+    
+    @staticmethod
+    def release(*states):
+        """Give the pooled states back to their pool once the update is processed"""
+        seen = set()
+        for state in states:
+            if state is None or id(state) in seen or state.reuse != "pool":
+                continue
+            seen.add(id(state))
+            
+            cls = state.__class__
+            # the update is not kept alive by the pool
+            state.bind(None, None, False)
+            with StateFactory.lock:
+                pool = StateFactory.pools.setdefault(cls, [])
+                if len(pool) < cls.pool_size and not any(item is state for item in pool):
+                    pool.append(state)
     
     @staticmethod
     def add_state(name: str, cls):
@@ -949,8 +1110,58 @@ class StateFactory:
             logger.debug("{} state registered as {}", name, cls)
 
 
+STEP_METHOD_RGX = re.compile(r"^(pre_step|step)_(.+?)_(next|menu|post)(_group)?$")
+
+DISPATCH_METHODS = ('next', 'next_group', 'menu', 'menu_group', 'post', 'post_group')
+
+
+def compile_dispatch(cls):
+    """
+    Build the dispatch table of a state class, used by `AbstractState.dispatch`.
+    It maps each method ("next", "menu_group"...) to a tuple 
+    (pre method, {step: pre step method}, {step: step method}) of functions
+    of the class, so that finding the method of a step is a dict lookup. The 
+    steps found in the names of the methods are keyed by their str value 
+    and, for the int ones, by their int value too.
+    
+    The table is stored on the class. It is built when the class is
+    registered or else at its first use.
+    """
+    table = {}
+    for method in DISPATCH_METHODS:
+        table[method] = (getattr(cls, 'pre_' + method), {}, {})
+        
+    for name in dir(cls):
+        res = STEP_METHOD_RGX.match(name)
+        if res is None:
+            continue
+        
+        func = getattr(cls, name, None)
+        if not callable(func):
+            continue
+        
+        prefix, step, method, group = res.groups()
+        pre, pre_steps, steps = table[method + (group or '')]
+        keys = [step]
+        if step.isdigit() and str(int(step)) == step:
+            keys.append(int(step))
+            
+        for key in keys:
+            if prefix == 'pre_step':
+                pre_steps[key] = func
+            else:
+                steps[key] = func
+                
+    cls._dispatch = table
+    return table
+
+
 def register_state(cls):
     StateFactory.add_state(cls.name, cls)
+    compile_dispatch(cls)
+    # the class data is complete, e.g. the transitions added by register_step
+    cls._keyboards = {}
+    cls._transition_index = TransitionIndex(cls.transitions, cls.inlines)
     
     def wrapper(cls):
         StateFactory.add_state(name, cls)
@@ -1,28 +1,40 @@
 """This module contains function for handling sending actions"""
+import zlib
 from django.utils.safestring import mark_safe
 
+
+def get_broadcast_name(action:dict):
+    """Return the name of the broadcasts of an action, the same at each run of 
+    the bot so that a broadcast interrupted by a crash resumes"""
+    if action.get('name'):
+        return action['name']
+    key = "{}:{}".format(action.get('id'), action.get('message'))
+    return "action-{:08x}".format(zlib.crc32(key.encode('utf-8')))
+
+
 def action_send_message(action:dict):
     message = action.get('message')
     id = action.get('id')
+    name = get_broadcast_name(action)
     
     if isinstance(id, str) or isinstance(id, int):
         if id == 'admins':
             res = """# send message to admins
-        for user in User.objects.filter(is_superuser=True):
-            self.dispatcher.bot.send_message(user.tg.id, _("{}"))""".format(message)
+        broadcast(self.dispatcher.bot, TgUser.objects.filter(dj__is_superuser=True), 
+                  _("{}"), wait=False, name="{}", purge=True)""".format(message, name)
         elif id == "staff":
             res = """# send message to staff
-        for user in User.objects.filter(is_staff=True):
-            self.dispatcher.bot.send_message(user.tg.id, _("{}"))""".format(message)
+        broadcast(self.dispatcher.bot, TgUser.objects.filter(dj__is_staff=True), 
+                  _("{}"), wait=False, name="{}", purge=True)""".format(message, name)
         elif isinstance(id, int) or id.isnumeric():
             res = """# sending message to f{id}
-        self.dispatch.bot.send_message({id}, _("{message}"))""".format(id=id, message=message)
+        self.dispatcher.bot.send_message({id}, _("{message}"))""".format(id=id, message=message)
             
         return mark_safe(res)
     elif isinstance(id, list):
         res = """# send message to those chat id
-        for chat_id in ({chat_ids}):
-            self.dispatcher.bot.send_message(chat_id, _("{message}"))"""\
-            .format(message=message, chat_ids=', '.join([str(item) for item in id]))
+        broadcast(self.dispatcher.bot, ({chat_ids},), _("{message}"), wait=False, 
+                  name="{name}", purge=True)"""\
+            .format(message=message, name=name, chat_ids=', '.join([str(item) for item in id]))
         
         return mark_safe(res)
@@ -0,0 +1,35 @@
+"""
+The settings of the tests of ninagram, run them with:
+
+    python runtests.py
+    python -m pytest
+"""
+SECRET_KEY = 'ninagram-tests'
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'ninagram',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+ROOT_URLCONF = 'ninagram.urls'
+
+USE_TZ = False
+
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'APP_DIRS': True,
+}]
+
+NINAGRAM = {
+    'TOKENS': ['123:abc'],
+    'STATES_MODULES': [],
+    'WORKING_MODE': 'polling',
+}
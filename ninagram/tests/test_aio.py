@@ -0,0 +1,63 @@
+import asyncio
+import threading
+from django.test import SimpleTestCase
+from ninagram.aio import AsyncRunner, run_sync
+from ninagram.workers import REJECT, DROP_OLDEST
+
+
+class AsyncRunnerTest(SimpleTestCase):
+
+    def test_lanes_keep_the_submission_order(self):
+        runner = AsyncRunner(workers=2, name="test-aio")
+        done = []
+
+        async def job(lane, i):
+            await asyncio.sleep(0.001 * ((i * 7) % 3))
+            done.append((lane, i))
+
+        for i in range(20):
+            for lane in range(3):
+                runner.submit(job, lane, i, key=lane)
+        self.assertEqual(runner.shutdown(timeout=10), 0)
+        for lane in range(3):
+            self.assertEqual([i for l, i in done if l == lane], list(range(20)))
+
+    def make_full_runner(self, overflow):
+        runner = AsyncRunner(workers=1, queue_size=2, overflow=overflow, name="test-aio-full")
+        release = threading.Event()
+
+        async def hold(i):
+            await run_sync(release.wait)
+
+        return runner, release, hold
+
+    def test_reject(self):
+        runner, release, hold = self.make_full_runner(REJECT)
+        rejected = []
+        futures = [runner.submit(hold, i, key='lane', on_reject=rejected.append) for i in range(3)]
+        release.set()
+        self.assertIsNone(futures[2])
+        self.assertEqual(rejected, [2])
+        self.assertEqual(runner.shutdown(timeout=5), 0)
+
+    def test_drop_oldest_cancels_a_waiting_coroutine(self):
+        runner, release, hold = self.make_full_runner(DROP_OLDEST)
+        dropped = []
+        runner.submit(hold, 0, key='lane', on_reject=dropped.append)
+        runner.submit(hold, 1, key='lane', on_reject=dropped.append)
+        runner.submit(hold, 2, key='lane', on_reject=dropped.append)
+        release.set()
+        self.assertEqual(runner.shutdown(timeout=5), 0)
+        # the first one may have started already, the second waits for the lane
+        self.assertIn(dropped, ([0], [1]))
+
+    def test_shutdown_refuses_the_new_coroutines(self):
+        runner = AsyncRunner(workers=1, name="test-aio-closed")
+        runner.shutdown(timeout=5)
+        rejected = []
+
+        async def job():
+            pass
+
+        self.assertIsNone(runner.submit(job, on_reject=lambda: rejected.append(1)))
+        self.assertEqual(rejected, [1])
@@ -0,0 +1,146 @@
+import copy
+import pickle
+from types import SimpleNamespace
+from unittest import mock
+from django.test import SimpleTestCase
+from telegram.error import BadRequest
+from ninagram.bot import post_messages, generic_processor
+from ninagram.delivery import Delivery
+from ninagram.response import MenuResponse, NextResponse
+from ninagram.states.base import State
+
+
+def make_update(user_id=1, chat_id=1):
+    message = SimpleNamespace(text="hi", message_id=1, bot=None)
+    return SimpleNamespace(message=message, effective_message=message, callback_query=None,
+                           effective_user=SimpleNamespace(id=user_id),
+                           effective_chat=SimpleNamespace(id=chat_id, type="private"))
+
+
+class PostState(State):
+    name = "TEST_POST"
+    transitions = {'go': ':1'}
+
+    def step_1_post(self, update, msg):
+        self.posted.append((1, msg))
+
+    def step_2_post(self, update, msg):
+        self.posted.append((2, msg))
+
+
+class PostMessagesTest(SimpleTestCase):
+
+    def test_post_uses_the_step_of_the_menu_sent(self):
+        update = make_update(user_id=901, chat_id=901)
+        state = PostState(update, None)
+        state.posted = []
+        state.set_step(1)
+        state.post_step = state.get_step()
+        # the next update of the chat moves to the step 2 before the post
+        state.set_step(2)
+        post_messages(update, state, ['msg'], contexts=((state, state.get_context()),))
+        self.assertEqual(state.posted, [(1, 'msg')])
+
+
+class ApplyQueuedTest(SimpleTestCase):
+
+    def setUp(self):
+        self.delivery = Delivery(chat_rate=1000, chat_burst=1000, name="test-apply")
+        patcher = mock.patch('ninagram.delivery.get_delivery', lambda: self.delivery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.delivery.shutdown(timeout=5)
+
+    def test_errback_gets_the_messages_sent(self):
+        update = make_update()
+        calls = []
+
+        def send_message(chat_id, text, **kwargs):
+            calls.append(text)
+            if len(calls) > 1:
+                raise BadRequest("message is too long")
+            return text
+
+        update.effective_message.bot = SimpleNamespace(token="123:test",
+                                                       sendMessage=send_message)
+        sent, failed = [], []
+        self.assertTrue(MenuResponse("a" * 5000).apply_queued(update, callback=sent.append,
+                                                             errback=failed.append))
+        self.assertEqual(self.delivery.shutdown(timeout=5), 0)
+        self.assertEqual(sent, [])
+        self.assertEqual(failed, [["a" * 4000]])
+
+
+class FakeState:
+    restore_state = None
+
+    def __init__(self, name, fail_next=False, fail_menu=False, fail_apply=False):
+        self.name = name
+        self.fail_next = fail_next
+        self.fail_menu = fail_menu
+        self.fail_apply = fail_apply
+
+    def next(self, update):
+        if self.fail_next:
+            raise ValueError("next failed")
+        return NextResponse("NEXT")
+
+    def menu(self, update):
+        if self.fail_menu:
+            raise ValueError("menu failed")
+        resp = mock.Mock(spec=['apply'])
+        if self.fail_apply:
+            resp.apply.side_effect = ValueError("apply failed")
+        else:
+            resp.apply.return_value = []
+        return resp
+
+    def get_step(self):
+        return 1
+
+    def post(self, update, msg):
+        pass
+
+
+class GenericProcessorTest(SimpleTestCase):
+
+    def run_update(self, **states):
+        """Process an update with the FakeStates named PREV, NEXT and START,
+        returns the release calls"""
+        released = []
+        update = make_update()
+        update.db = SimpleNamespace(session=SimpleNamespace(state="PREV", save_after=lambda **kw: None),
+                                    chat=SimpleNamespace(lang="en"))
+        pool = SimpleNamespace(submit=lambda fn, *args, key=None, on_reject=None: fn(*args))
+        with mock.patch('ninagram.bot.get_state', lambda name, *args, **kwargs: states[name]), \
+             mock.patch('ninagram.bot.get_pool', lambda: pool), \
+             mock.patch('ninagram.bot.is_delivery_enabled', lambda: False), \
+             mock.patch('ninagram.bot.StateFactory.release', lambda *items: released.append(items)):
+            generic_processor(update, None)
+        # the release of no state does nothing
+        return [items for items in released if items]
+
+    def test_the_states_are_released_when_next_fails(self):
+        prev = FakeState("PREV", fail_next=True)
+        self.assertEqual(self.run_update(PREV=prev), [(prev,)])
+
+    def test_the_states_are_released_once_when_apply_fails(self):
+        prev, state = FakeState("PREV"), FakeState("NEXT", fail_apply=True)
+        self.assertEqual(self.run_update(PREV=prev, NEXT=state), [(state, prev, state)])
+
+    def test_the_states_are_released_when_the_fallback_fails(self):
+        prev, state = FakeState("PREV"), FakeState("NEXT", fail_menu=True)
+        start = FakeState("START", fail_menu=True)
+        self.assertEqual(self.run_update(PREV=prev, NEXT=state, START=start),
+                         [(prev, state, start)])
+
+
+class StateCopyTest(SimpleTestCase):
+
+    def test_copy_keeps_the_context_and_pickle_drops_it(self):
+        update = make_update(user_id=902, chat_id=902)
+        state = PostState(update, None)
+        self.assertIs(copy.copy(state).update, update)
+        self.assertIsNone(pickle.loads(pickle.dumps(state)).update)
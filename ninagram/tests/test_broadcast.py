@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+from django.test import TransactionTestCase, SimpleTestCase
+from ninagram import delivery
+from ninagram.broadcast import broadcast
+from ninagram.models import Broadcast
+from ninagram.templatetags.actions.sending import get_broadcast_name, action_send_message
+
+
+class Bot:
+    token = "123:test"
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+        return SimpleNamespace(chat_id=chat_id)
+
+
+class BroadcastTest(TransactionTestCase):
+
+    def setUp(self):
+        self.previous = delivery._delivery
+        delivery._delivery = delivery.Delivery(rate=10000, burst=10000, chat_rate=10000,
+                                               chat_burst=10000, senders=4, name="test-broadcast")
+
+    def tearDown(self):
+        delivery._delivery.shutdown(timeout=5)
+        delivery._delivery = self.previous
+
+    def test_a_finished_broadcast_is_not_sent_again(self):
+        bot = Bot()
+        broadcast(bot, range(1, 11), "hi", name="kept", chunk_size=3)
+        report = broadcast(bot, range(1, 11), "hi", name="kept", chunk_size=3)
+        self.assertEqual(len(bot.sent), 10)
+        self.assertTrue(report['done'])
+        self.assertTrue(Broadcast.objects.filter(name="kept").exists())
+
+    def test_purge_deletes_the_row_and_sends_again(self):
+        bot = Bot()
+        report = broadcast(bot, range(1, 11), "hi", name="purged", chunk_size=3, purge=True)
+        self.assertTrue(report['done'])
+        self.assertFalse(Broadcast.objects.filter(name="purged").exists())
+        broadcast(bot, range(1, 11), "hi", name="purged", chunk_size=3, purge=True)
+        self.assertEqual(len(bot.sent), 20)
+        self.assertFalse(Broadcast.objects.exists())
+
+    def test_purge_resumes_an_interrupted_broadcast(self):
+        Broadcast.objects.create(name="resumed", message="hi", position=7)
+        bot = Bot()
+        broadcast(bot, range(1, 11), "hi", name="resumed", chunk_size=3, purge=True)
+        self.assertEqual(sorted(bot.sent), [8, 9, 10])
+        self.assertFalse(Broadcast.objects.exists())
+
+
+class SendActionTest(SimpleTestCase):
+
+    def test_the_name_is_stable(self):
+        action = {'id': 'admins', 'message': 'hello'}
+        self.assertEqual(get_broadcast_name(action), get_broadcast_name(dict(action)))
+        self.assertNotEqual(get_broadcast_name(action),
+                            get_broadcast_name({'id': 'staff', 'message': 'hello'}))
+        self.assertEqual(get_broadcast_name({'name': 'welcome', 'id': 'staff'}), 'welcome')
+
+    def test_the_generated_call_is_named_and_purged(self):
+        action = {'id': [1, 2], 'message': 'hello'}
+        code = str(action_send_message(action))
+        self.assertIn('name="{}"'.format(get_broadcast_name(action)), code)
+        self.assertIn('purge=True', code)
@@ -0,0 +1,113 @@
+from django.test import SimpleTestCase, TransactionTestCase
+from ninagram.cache import Saver, SaverPool
+from django.contrib.auth.models import User
+from ninagram.models import Chat, Session, TgUser, Group, Channel
+
+
+class SaverCoalesceTest(SimpleTestCase):
+
+    def test_last_write_wins(self):
+        first = Chat(id=1, type="private", title="first")
+        last = Chat(id=1, type="private", title="last")
+        other = Chat(id=2, type="private", title="other")
+        merged = Saver().coalesce([(first, {}), (other, {}), (last, {})])
+        # in the order of the first save of each row
+        self.assertEqual([instance for instance, kwargs in merged], [last, other])
+
+    def test_insert_and_cached_are_kept(self):
+        first = Chat(id=1, type="private")
+        last = Chat(id=1, type="private")
+        merged = Saver().coalesce([(first, {'force_insert': True, 'cached': True}),
+                                   (last, {'force_update': True})])
+        self.assertEqual(merged, [(last, {'force_insert': True, 'cached': True})])
+
+    def test_update_fields_are_merged(self):
+        chat = Chat(id=1, type="private")
+        merged = Saver().coalesce([(chat, {'update_fields': ['title']}),
+                                   (chat, {'update_fields': ['username', 'title']})])
+        self.assertEqual(merged[0][1], {'update_fields': ['title', 'username']})
+        merged = Saver().coalesce([(chat, {'update_fields': ['title']}), (chat, {})])
+        self.assertEqual(merged[0][1], {})
+        merged = Saver().coalesce([(chat, {}), (chat, {'update_fields': ['title']})])
+        self.assertEqual(merged[0][1], {})
+
+    def test_new_instances_are_not_merged(self):
+        first = Chat(type="private", title="a")
+        second = Chat(type="private", title="b")
+        merged = Saver().coalesce([(first, {}), (second, {}), (first, {})])
+        self.assertEqual([instance for instance, kwargs in merged], [first, second])
+
+
+class SaverBatchTest(TransactionTestCase):
+
+    def test_the_last_save_of_a_row_is_written(self):
+        items = [(Chat(id=i % 5, type="private", title=str(i)), {}) for i in range(20)]
+        Saver().save_batch(items)
+        titles = dict(Chat.objects.values_list('id', 'title'))
+        self.assertEqual(titles, {i: str(15 + i) for i in range(5)})
+
+    def make_session(self, **kwargs):
+        chat = Chat.objects.create(id=10, type="private")
+        dj = User.objects.create(username="saver_test")
+        user = TgUser.objects.create(id=10, dj=dj, chat=chat)
+        return Session(user=user, chat=chat, **kwargs)
+
+    def test_new_bulk_rows_are_inserted(self):
+        # bulk_save models without pk or not in the database yet
+        session = self.make_session(state="A")
+        Saver().save_batch([(session, {})])
+        self.assertIsNotNone(session.pk)
+        session.state = "B"
+        Saver().save_batch([(session, {'force_update': True})])
+        self.assertEqual(Session.objects.get(pk=session.pk).state, "B")
+
+        Session.objects.all().delete()
+        missing = Session(pk=session.pk, user=session.user, chat=session.chat, state="C")
+        Saver().save_batch([(missing, {})])
+        self.assertEqual(Session.objects.get(pk=session.pk).state, "C")
+
+
+class SaverPoolTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pool = SaverPool(workers=4)
+
+    def test_a_row_always_goes_to_the_same_saver(self):
+        saver = self.pool.get_saver(Chat(id=7))
+        for i in range(10):
+            self.assertIs(self.pool.get_saver(Chat(id=7, title=str(i))), saver)
+
+    def test_an_instance_keeps_its_saver_once_it_has_a_pk(self):
+        for i in range(10):
+            chat = Chat(type="private")
+            saver = self.pool.get_saver(chat)
+            chat.id = 100 + i
+            self.assertIs(self.pool.get_saver(chat), saver)
+
+
+class GroupCacheTest(TransactionTestCase):
+
+    def tearDown(self):
+        # the database is emptied after each test, the caches too
+        for model, key in ((Group, Group.make_key(-100)), (Channel, Channel.make_key(-100)),
+                           (Chat, -100)):
+            instance = model.cache_peek(key)
+            if instance is not None:
+                instance.cache_delete()
+
+    def test_one_key_per_group(self):
+        group = Group.custom_save(-100, "nina", None)
+        self.assertEqual(group.cache_key(), Group.make_key(-100))
+        self.assertIs(Group.cache_peek(Group.make_key(-100)), group)
+        self.assertIs(Group.cache_get(-100), group)
+        group.cache_delete()
+        self.assertIsNone(Group.cache_peek(Group.make_key(-100)))
+        self.assertEqual(Group.cache_get(-100).pk, group.pk)
+
+    def test_one_key_per_channel(self):
+        channel = Channel.custom_save(-100, "nina", None)
+        channel.cache_update()
+        self.assertIs(Channel.cache_peek(Channel.make_key(-100)), channel)
+        self.assertIsNone(Channel.cache_peek(channel.pk))
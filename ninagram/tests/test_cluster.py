@@ -0,0 +1,25 @@
+import multiprocessing
+from unittest import mock
+from django.test import SimpleTestCase
+from ninagram import cluster
+
+
+class RunWorkerTest(SimpleTestCase):
+
+    def run_worker(self, reader):
+        processed = multiprocessing.Value('q', 0)
+        with mock.patch.object(cluster, 'handle_signals'), \
+                mock.patch('ninagram.bot.Bot') as Bot:
+            cluster.run_worker(0, ['123:abc'], reader, processed, multiprocessing.Event())
+        return Bot.return_value
+
+    def test_closed_pipe_stops_the_worker(self):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        writer.close()
+        self.assertTrue(self.run_worker(reader).stop.called)
+
+    def test_bad_message_is_skipped(self):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        writer.send_bytes(b'not a pickle')
+        writer.send(None)
+        self.assertTrue(self.run_worker(reader).stop.called)
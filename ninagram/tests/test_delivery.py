@@ -0,0 +1,71 @@
+import random
+import time
+from threading import Lock
+from types import SimpleNamespace
+from django.test import SimpleTestCase
+from telegram.error import NetworkError, BadRequest
+from ninagram.delivery import Delivery, TokenBucket
+
+BOT = SimpleNamespace(token="123:test")
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = 1000.0
+        self.assertEqual([bucket.reserve(now) for i in range(3)], [now] * 3)
+        self.assertAlmostEqual(bucket.reserve(now), now + 0.5)
+        self.assertAlmostEqual(bucket.reserve(now), now + 1)
+
+
+class DeliveryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.delivery = Delivery(rate=10000, burst=10000, chat_rate=10000, chat_burst=10000,
+                                 senders=8, max_retries=3, name="test-delivery")
+
+    def tearDown(self):
+        self.delivery.shutdown(timeout=5)
+
+    def test_the_jobs_of_a_chat_are_sent_in_order(self):
+        lock = Lock()
+        sent = {}
+        failed_once = set()
+
+        def send(chat_id, i):
+            time.sleep(random.random() / 1000)
+            # every third job fails once and is retried
+            if i % 3 == 0 and (chat_id, i) not in failed_once:
+                failed_once.add((chat_id, i))
+                raise NetworkError("try again")
+            with lock:
+                sent.setdefault(chat_id, []).append(i)
+
+        for i in range(12):
+            for chat_id in range(4):
+                self.assertTrue(self.delivery.submit(
+                    BOT, lambda chat_id=chat_id, i=i: send(chat_id, i), chat_id=chat_id))
+
+        self.assertEqual(self.delivery.shutdown(timeout=30), 0)
+        for chat_id in range(4):
+            self.assertEqual(sent[chat_id], list(range(12)))
+
+    def test_a_bad_request_is_not_retried(self):
+        calls = []
+        errors = []
+
+        def send():
+            calls.append(1)
+            raise BadRequest("chat not found")
+
+        self.delivery.submit(BOT, send, chat_id=1, errback=errors.append)
+        self.delivery.submit(BOT, lambda: 'ok', chat_id=1, callback=errors.append)
+        self.assertEqual(self.delivery.shutdown(timeout=5), 0)
+        self.assertEqual(len(calls), 1)
+        self.assertIsInstance(errors[0], BadRequest)
+        self.assertEqual(errors[1], 'ok')
+
+    def test_a_closed_delivery_refuses_the_jobs(self):
+        self.delivery.shutdown(timeout=5)
+        self.assertFalse(self.delivery.submit(BOT, lambda: None, chat_id=1))
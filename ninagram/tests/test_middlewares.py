@@ -0,0 +1,49 @@
+import telegram
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from ninagram.middlewares import SessionMiddleware
+from ninagram.models import Chat, Session, TgUser
+
+USER_ID = 4242
+
+
+class SessionMiddlewareTest(TransactionTestCase):
+
+    def setUp(self):
+        self.dj = User.objects.create(id=USER_ID, username="nina", first_name="Nina")
+        chat = Chat.objects.create(id=USER_ID, title="nina", username="nina", type="private")
+        self.tg_user = TgUser.objects.create(id=USER_ID, dj=self.dj, chat=chat)
+        Session.objects.create(user=self.tg_user, chat=chat, state="START")
+        self.middleware = SessionMiddleware(lambda update, dispatcher: None)
+
+    def tearDown(self):
+        for model, key in ((TgUser, USER_ID), (Chat, USER_ID),
+                           (Session, Session.make_key(USER_ID, USER_ID))):
+            instance = model.cache_peek(key)
+            if instance is not None:
+                instance.cache_delete()
+
+    def make_update(self):
+        user = telegram.User(USER_ID, "Nina", False, username="nina")
+        chat = telegram.Chat(USER_ID, "private")
+        message = telegram.Message(1, user, None, chat, text="hi")
+        return telegram.Update(1, message=message)
+
+    def test_the_flags_are_read_without_a_query(self):
+        self.middleware.check_update(self.make_update())
+        update = self.make_update()
+        with self.assertNumQueries(0):
+            self.middleware.check_update(update)
+        self.assertFalse(update.db.is_staff)
+
+    def test_a_changed_django_user_leaves_the_cache(self):
+        self.middleware.check_update(self.make_update())
+        self.assertIsNotNone(TgUser.cache_peek(USER_ID))
+
+        self.dj.is_staff = True
+        self.dj.save()
+        self.assertIsNone(TgUser.cache_peek(USER_ID))
+
+        update = self.make_update()
+        self.middleware.check_update(update)
+        self.assertTrue(update.db.is_staff)
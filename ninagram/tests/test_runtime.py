@@ -0,0 +1,66 @@
+from django.test import SimpleTestCase
+from ninagram.backends.storage import PersistentStore
+from ninagram.runtime import Runtime
+
+
+class FakeStore(PersistentStore):
+
+    def __init__(self):
+        self.saved = {}
+        self.on_serialize = None
+
+    def serialize(self, states):
+        if self.on_serialize is not None:
+            on_serialize, self.on_serialize = self.on_serialize, None
+            on_serialize()
+        return super().serialize(states)
+
+    def load_data(self, user_id, chat_id):
+        return self.saved.get((user_id, chat_id))
+
+    def save_many(self, items):
+        self.saved.update(items)
+
+    def delete(self, user_id, chat_id):
+        self.saved.pop((user_id, chat_id), None)
+
+
+class RuntimeFlushTest(SimpleTestCase):
+
+    def setUp(self):
+        self.runtime = Runtime()
+        self.previous = Runtime.store, Runtime._Runtime__flusher
+        Runtime.store = FakeStore()
+        # the test flushes by itself
+        Runtime._Runtime__flusher = object()
+
+    def tearDown(self):
+        self.runtime.clear_conversation(-1, -1)
+        Runtime.store, Runtime._Runtime__flusher = self.previous
+
+    def saved(self):
+        return Runtime.store.load(-1, -1)
+
+    def test_a_change_made_during_the_flush_is_flushed_next(self):
+        self.runtime.set(-1, -1, "FORM", "step", 1)
+        # the change happens after the conversation is taken by the flusher
+        Runtime.store.on_serialize = lambda: self.runtime.set(-1, -1, "FORM", "step", 2)
+        self.runtime.flush()
+        self.assertEqual(self.saved()["FORM"]["step"], 1)
+        self.runtime.flush()
+        self.assertEqual(self.saved()["FORM"]["step"], 2)
+
+    def test_the_flush_writes_a_snapshot(self):
+        self.runtime.set(-1, -1, "FORM", "step", 1)
+        Runtime.store.on_serialize = lambda: self.runtime.set(-1, -1, "OTHER", "step", 1)
+        # adding a state while serializing doesn't break the flush
+        self.assertEqual(self.runtime.flush(), 1)
+        self.assertNotIn("OTHER", self.saved())
+
+    def test_a_store_must_implement_the_writes(self):
+        class IncompleteStore(PersistentStore):
+            def load_data(self, user_id, chat_id):
+                return None
+
+        with self.assertRaises(TypeError):
+            IncompleteStore()
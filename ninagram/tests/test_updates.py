@@ -0,0 +1,60 @@
+import threading
+import time
+from types import SimpleNamespace
+from django.test import SimpleTestCase
+from ninagram.updates import UpdateDedup, UpdateReorderer
+
+TOKEN = "123:abc"
+
+class UpdateDedupTest(SimpleTestCase):
+
+    def test_window_and_max_entries(self):
+        dedup = UpdateDedup(window=60, max_entries=2)
+        self.assertTrue(dedup.is_new(TOKEN, 1))
+        self.assertFalse(dedup.is_new(TOKEN, 1))
+        self.assertTrue(dedup.is_new("456:other", 1))
+        # the oldest update_id is forgotten past max_entries
+        self.assertTrue(dedup.is_new(TOKEN, 2))
+        self.assertTrue(dedup.is_new(TOKEN, 1))
+
+    def test_disabled(self):
+        dedup = UpdateDedup(window=0)
+        self.assertTrue(dedup.is_new(TOKEN, 1))
+        self.assertTrue(dedup.is_new(TOKEN, 1))
+
+
+class UpdateReordererTest(SimpleTestCase):
+
+    def test_updates_of_a_chat_are_released_in_order(self):
+        released = []
+        done = threading.Event()
+
+        def release(key, update):
+            released.append((key, update.update_id))
+            if len(released) == 6:
+                done.set()
+
+        reorderer = UpdateReorderer(0.05, release)
+        for update_id in (3, 1, 2):
+            for key in ('a', 'b'):
+                reorderer.push(key, SimpleNamespace(update_id=update_id))
+        self.assertTrue(done.wait(5))
+        for key in ('a', 'b'):
+            self.assertEqual([i for k, i in released if k == key], [1, 2, 3])
+
+    def test_late_update_is_released_at_once(self):
+        released = []
+        reorderer = UpdateReorderer(0.01, lambda key, update: released.append(update.update_id))
+        reorderer.push('a', SimpleNamespace(update_id=5))
+        deadline = time.time() + 5
+        while not released and time.time() < deadline:
+            time.sleep(0.01)
+        reorderer.push('a', SimpleNamespace(update_id=4))
+        self.assertEqual(released, [5, 4])
+
+    def test_one_thread_for_all_the_chats(self):
+        reorderer = UpdateReorderer(10, lambda key, update: None)
+        before = threading.active_count()
+        for key in range(50):
+            reorderer.push(key, SimpleNamespace(update_id=1))
+        self.assertEqual(threading.active_count(), before + 1)
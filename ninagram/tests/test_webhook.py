@@ -0,0 +1,94 @@
+import json
+from unittest import mock
+import telegram
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from ninagram import views
+from ninagram.updates import UpdateDedup
+
+TOKEN = "123:abc"
+
+
+def make_body(update_id, chat_id=7):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': 'hi',
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'a'}},
+    }).encode()
+
+
+class CheckSecretTest(SimpleTestCase):
+
+    @override_settings(NINAGRAM={'WEBHOOK_SECRET': 's3cret'})
+    def test_secret(self):
+        self.assertTrue(views.check_secret('s3cret'))
+        self.assertFalse(views.check_secret('wrong'))
+        self.assertFalse(views.check_secret(None))
+        # a header that is not ASCII is refused, not an error
+        self.assertFalse(views.check_secret('café'))
+
+    @override_settings(NINAGRAM={})
+    def test_no_secret(self):
+        self.assertTrue(views.check_secret(None))
+
+
+@override_settings(NINAGRAM={'WEBHOOK_SECRET': 's3cret'})
+class EnqueueUpdateTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dispatcher = mock.Mock()
+        self.pool = mock.Mock()
+        self.pool.submit.return_value = True
+        self.dedup = UpdateDedup(window=60)
+        webhooks = {TOKEN: (telegram.Bot(TOKEN), self.dispatcher)}
+        for name, value in (('get_webhooks', lambda: webhooks), ('get_pool', lambda: self.pool),
+                            ('get_dedup', lambda: self.dedup), ('get_reorderer', lambda: None)):
+            patcher = mock.patch.object(views, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_statuses(self):
+        self.assertEqual(views.enqueue_update("456:other", make_body(1), 's3cret'), 404)
+        self.assertEqual(views.enqueue_update(TOKEN, make_body(1), 'wrong'), 403)
+        self.assertEqual(views.enqueue_update(TOKEN, b'not json', 's3cret'), 400)
+        self.assertEqual(views.enqueue_update(TOKEN, make_body(1), 's3cret'), 200)
+
+    def test_update_queued_in_the_lane_of_its_chat(self):
+        views.enqueue_update(TOKEN, make_body(1, chat_id=42), 's3cret')
+        args, kwargs = self.pool.submit.call_args
+        self.assertEqual(args[0], self.dispatcher.process_update)
+        self.assertEqual(args[1].update_id, 1)
+        self.assertEqual(kwargs['key'], (42, 42))
+
+    def test_duplicates_are_ignored(self):
+        for i in range(3):
+            self.assertEqual(views.enqueue_update(TOKEN, make_body(5), 's3cret'), 200)
+        self.assertEqual(views.enqueue_update(TOKEN, make_body(6), 's3cret'), 200)
+        self.assertEqual(self.pool.submit.call_count, 2)
+
+    def test_refused_update_is_accepted_again(self):
+        self.pool.submit.return_value = False
+        self.assertEqual(views.enqueue_update(TOKEN, make_body(9), 's3cret'), 503)
+        self.pool.submit.return_value = True
+        self.assertEqual(views.enqueue_update(TOKEN, make_body(9), 's3cret'), 200)
+        self.assertEqual(self.pool.submit.call_count, 2)
+
+
+
+class LoadWebhooksTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(views, '_webhooks', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_the_map_loaded_is_used(self):
+        webhooks = {TOKEN: (telegram.Bot(TOKEN), mock.Mock())}
+        views.load_webhooks(webhooks)
+        self.assertIs(views.get_webhooks(), webhooks)
+
+    @override_settings(NINAGRAM={'TOKENS': []})
+    def test_no_token_is_a_configuration_error(self):
+        with self.assertRaises(ImproperlyConfigured):
+            views.load_webhooks()
@@ -0,0 +1,83 @@
+import random
+import time
+from threading import Lock
+from django.test import SimpleTestCase
+from ninagram.workers import WorkerPool, REJECT
+
+
+class WorkerPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(workers=4, queue_size=1000, name="test-workers")
+
+    def tearDown(self):
+        self.pool.shutdown(timeout=5)
+
+    def test_lanes_keep_the_submission_order(self):
+        lock = Lock()
+        done = {}
+        running = set()
+        overlaps = []
+
+        def job(lane, i):
+            with lock:
+                if lane in running:
+                    overlaps.append(lane)
+                running.add(lane)
+            time.sleep(random.random() / 1000)
+            with lock:
+                running.discard(lane)
+                done.setdefault(lane, []).append(i)
+
+        for i in range(50):
+            for lane in range(5):
+                self.assertTrue(self.pool.submit(job, lane, i, key=lane))
+
+        self.assertEqual(self.pool.shutdown(timeout=10), 0)
+        self.assertEqual(overlaps, [])
+        for lane in range(5):
+            self.assertEqual(done[lane], list(range(50)))
+
+    def test_same_lane_submit_runs_inline(self):
+        order = []
+
+        def inner():
+            order.append('inner')
+
+        def outer():
+            self.pool.submit(inner, key='lane')
+            order.append('outer')
+
+        self.pool.submit(outer, key='lane')
+        self.pool.shutdown(timeout=5)
+        self.assertEqual(order, ['inner', 'outer'])
+
+    def test_reject_calls_on_reject(self):
+        pool = WorkerPool(workers=1, queue_size=1, overflow=REJECT, name="test-reject")
+        rejected = []
+        lock = Lock()
+        lock.acquire()
+        try:
+            pool.submit(lock.acquire)
+            # the worker may not have taken the first job yet
+            results = [pool.submit(time.sleep, 0, on_reject=rejected.append) for i in range(3)]
+        finally:
+            lock.release()
+        self.assertIn(False, results)
+        self.assertEqual(len(rejected), results.count(False))
+        pool.shutdown(timeout=5)
+
+    def test_forced_job_is_queued_in_a_full_queue(self):
+        pool = WorkerPool(workers=1, queue_size=1, name="test-force")
+        lock = Lock()
+        lock.acquire()
+        done = []
+        try:
+            pool.submit(lock.acquire)
+            pool.submit(time.sleep, 0)
+            # the queue is full, a blocking pool would wait here forever
+            self.assertTrue(pool.submit(done.append, 1, force=True))
+        finally:
+            lock.release()
+        pool.shutdown(timeout=5)
+        self.assertEqual(done, [1])
@@ -0,0 +1,81 @@
+"""
+This module contains the HTTP transport used by the bots to call the Bot API.
+
+Each token gets its own `telegram.Bot` with a connection pool sized for the
+threads that send through it (the worker pool, the delivery senders and the
+threads of the Updater), so the connections are kept alive and reused instead
+of being discarded when the pool is full and opened again with a new TLS
+handshake.
+
+The transport is configured with the NINAGRAM['HTTP'] setting, a dict with
+the optional keys:
+    - POOL_SIZE: the number of connections kept per token (by default
+    WORKERS + the delivery SENDERS + 8)
+    - CONNECT_TIMEOUT, READ_TIMEOUT: in seconds (5 and 5)
+    - PROXY_URL, PROXY_KWARGS: the proxy of the requests
+    - HTTP2: not supported by the urllib3 vendored by python-telegram-bot, a
+    warning is logged and HTTP/1.1 keep-alive is used
+
+The latency of the requests is recorded by API method in the "http" metrics.
+"""
+import time
+import telegram
+from django.conf import settings
+from loguru import logger
+from telegram.error import TelegramError
+from telegram.utils.request import Request
+from .metrics import Metrics
+
+
+class MeteredRequest(Request):
+    """A telegram Request recording the latency and the errors of each API method"""
+
+    metrics = Metrics("http")
+
+    def post(self, url, data, timeout=None):
+        return self.measure(url, super().post, url, data, timeout=timeout)
+
+    def get(self, url, timeout=None):
+        return self.measure(url, super().get, url, timeout=timeout)
+
+    def measure(self, url, fn, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        except TelegramError as e:
+            self.metrics.incr("errors.{}".format(method))
+            raise
+        finally:
+            self.metrics.incr("requests.{}".format(method))
+            self.metrics.observe("latency.{}".format(method), time.time() - start)
+
+
+def get_pool_size(conf):
+    """Return the number of connections needed by a token"""
+    ninagram = getattr(settings, 'NINAGRAM', {})
+    size = ninagram.get('WORKERS', 8)
+    delivery = ninagram.get('DELIVERY')
+    if delivery:
+        size += delivery.get('SENDERS', 4) if isinstance(delivery, dict) else 4
+    # the Updater needs 4 workers + the dispatcher, the poller, the job queue
+    # and the main thread
+    return conf.get('POOL_SIZE', size + 8)
+
+
+def get_request():
+    """Return a new MeteredRequest configured from the settings"""
+    conf = getattr(settings, 'NINAGRAM', {}).get('HTTP') or {}
+    if conf.get('HTTP2'):
+        logger.warning("HTTP/2 is not supported by the Bot API client, using HTTP/1.1 keep-alive")
+
+    return MeteredRequest(con_pool_size=get_pool_size(conf),
+                          proxy_url=conf.get('PROXY_URL'),
+                          urllib3_proxy_kwargs=conf.get('PROXY_KWARGS'),
+                          connect_timeout=conf.get('CONNECT_TIMEOUT', 5.0),
+                          read_timeout=conf.get('READ_TIMEOUT', 5.0))
+
+
+def make_bot(token):
+    """Return a telegram.Bot for the token with its own connection pool"""
+    return telegram.Bot(token, request=get_request())
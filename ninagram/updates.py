@@ -0,0 +1,203 @@
+"""
+This module contains the deduplication and the ordering of the webhook updates.
+
+Telegram sends an update again when the webhook doesn't answer in time, so
+the webhook remembers the update_id of each bot for a while and ignores the
+updates already received: a retry costs a lookup instead of a second run of
+the states. With a shared cache (NINAGRAM['CACHE']['BACKEND']) the processes
+serving the webhook share the update_ids.
+
+The updates of a chat may also arrive out of order when Telegram retries. The
+optional reordering holds the updates of a chat for a short delay and queues
+them by update_id.
+
+They are configured with NINAGRAM['UPDATES'], a dict with the optional keys:
+    - DEDUP_WINDOW: the seconds an update_id is remembered, 0 to disable the
+    deduplication (default 600)
+    - DEDUP_MAX_ENTRIES: the update_ids kept in memory (default 100000)
+    - DEDUP_SHARED: True to share the update_ids in the shared cache (default False)
+    - REORDER_DELAY: the seconds the updates of a chat are held to be
+    reordered, 0 to disable the reordering (default 0)
+"""
+import heapq
+import time
+from collections import OrderedDict
+from threading import Lock, Condition, Thread
+from django.conf import settings
+from loguru import logger
+from .metrics import Metrics
+
+
+class UpdateDedup:
+    """
+    A time-windowed index of the update_ids received by each bot.
+
+    Params:
+        - window: the seconds an update_id is remembered
+        - max_entries: the maximum number of update_ids kept in memory, the
+        oldest ones are forgotten first
+        - shared(optional): a SharedCache recording the update_ids for all
+        the processes
+    """
+
+    metrics = Metrics("dedup")
+
+    def __init__(self, window=600, max_entries=100000, shared=None):
+        self.window = window
+        self.max_entries = max_entries
+        self.shared = shared
+        self.lock = Lock()
+        # (token, update_id) -> expiration time, the oldest entries come first
+        self.entries = OrderedDict()
+
+    def is_new(self, token, update_id):
+        """Record the update and return True if it wasn't received in the window"""
+        if not self.window:
+            return True
+
+        key = (token, update_id)
+        now = time.time()
+        with self.lock:
+            # the entries all live `window` seconds so the expired ones are first
+            while self.entries:
+                oldest, expire = next(iter(self.entries.items()))
+                if expire > now and len(self.entries) < self.max_entries:
+                    break
+                del self.entries[oldest]
+
+            if key in self.entries:
+                self.metrics.incr('duplicates')
+                return False
+            self.entries[key] = now + self.window
+
+        if self.shared is not None:
+            try:
+                if not self.shared.mark('update', "{}:{}".format(token.split(':')[0], update_id),
+                                        self.window):
+                    self.metrics.incr('duplicates')
+                    return False
+            except Exception as e:
+                # without the shared cache we still know our own updates
+                logger.exception(str(e))
+
+        self.metrics.incr('updates')
+        return True
+
+    def forget(self, token, update_id):
+        """Forget an update that couldn't be processed, so that its retry is accepted"""
+        with self.lock:
+            self.entries.pop((token, update_id), None)
+
+        if self.shared is not None:
+            try:
+                self.shared.unmark('update', "{}:{}".format(token.split(':')[0], update_id))
+            except Exception as e:
+                logger.exception(str(e))
+
+
+class UpdateReorderer:
+    """
+    Hold the updates of a chat for `delay` seconds and release them by
+    update_id. An update arriving after a more recent one of its chat was
+    released is released at once. One thread releases the chats when their
+    delay is over.
+
+    Params:
+        - delay: the seconds the first update of a chat waits for the others
+        - release: called with each update and its chat key, in order
+    """
+
+    metrics = Metrics("reorder")
+
+    def __init__(self, delay, release):
+        self.delay = delay
+        self.release = release
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        # chat key -> heap of (update_id, seq, update)
+        self.pending = {}
+        # the chats to release, a heap of (time, seq, chat key)
+        self.deadlines = []
+        self.thread = None
+        # chat key -> the last update_id released
+        self.released = OrderedDict()
+        self.seq = 0
+
+    def push(self, key, update):
+        with self.lock:
+            last = self.released.get(key)
+            if last is not None and update.update_id < last:
+                self.metrics.incr('late')
+                late = True
+            else:
+                late = False
+                self.seq += 1
+                heap = self.pending.get(key)
+                if heap is None:
+                    heap = self.pending[key] = []
+                    heapq.heappush(self.deadlines, (time.time() + self.delay, self.seq, key))
+                    self.start()
+                    self.changed.notify()
+                heapq.heappush(heap, (update.update_id, self.seq, update))
+
+        if late:
+            self.release(key, update)
+
+    def start(self):
+        """Start the releasing thread. Must be called with the lock held"""
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name="update-reorderer")
+            self.thread.setDaemon(True)
+            self.thread.start()
+            
+    def run(self):
+        while True:
+            with self.lock:
+                while True:
+                    now = time.time()
+                    if self.deadlines and self.deadlines[0][0] <= now:
+                        key = heapq.heappop(self.deadlines)[2]
+                        break
+                    self.changed.wait(self.deadlines[0][0] - now if self.deadlines else None)
+            self.flush(key)
+
+    def flush(self, key):
+        with self.lock:
+            heap = self.pending.pop(key, [])
+            updates = [heapq.heappop(heap)[2] for i in range(len(heap))]
+            if updates:
+                self.released[key] = updates[-1].update_id
+                self.released.move_to_end(key)
+                while len(self.released) > 100000:
+                    self.released.popitem(last=False)
+
+        if len(updates) > 1:
+            self.metrics.incr('batches')
+        for update in updates:
+            try:
+                self.release(key, update)
+            except Exception as e:
+                logger.exception(str(e))
+
+
+def get_updates_settings():
+    return getattr(settings, 'NINAGRAM', {}).get('UPDATES') or {}
+
+
+_dedup = None
+_dedup_lock = Lock()
+
+
+def get_dedup():
+    """Return the UpdateDedup of the process, created from the settings at the first call"""
+    global _dedup
+    if _dedup is None:
+        with _dedup_lock:
+            if _dedup is None:
+                from .cache import get_shared_cache
+                conf = get_updates_settings()
+                shared = get_shared_cache() if conf.get('DEDUP_SHARED') else None
+                _dedup = UpdateDedup(window=conf.get('DEDUP_WINDOW', 600),
+                                     max_entries=conf.get('DEDUP_MAX_ENTRIES', 100000),
+                                     shared=shared)
+    return _dedup
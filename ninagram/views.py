@@ -1,32 +1,179 @@
 """
 This module defines views to handle telegram update via webhook
+
+The webhook only checks the update and queues it in the worker pool, in the
+lane of its conversation, then answers at once: Telegram doesn't wait for the
+middlewares and the states. If the pool refuses the update the view answers
+503 and Telegram sends it again later. The updates received twice are
+ignored and those of a chat can be reordered, see ninagram.updates.
+
+When NINAGRAM['WEBHOOK_SECRET'] is set, it is given to Telegram with the
+webhook url and the requests without the same X-Telegram-Bot-Api-Secret-Token
+header are refused. The updates are decoded with orjson when it is installed.
+
+The token -> (bot, dispatcher) map of the webhook is built at startup by
+load_webhooks: the app does it with AUTO_LAUNCH, the ASGI application when it
+is created. Otherwise the first request builds it.
 """
 from django.views.decorators.csrf import csrf_exempt
 from ninagram.bot import Bot
+from ninagram.workers import get_pool, update_key
+from ninagram.updates import get_dedup, get_updates_settings, UpdateReorderer
 from telegram import Update
+from threading import Lock
+import hmac
 import json
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse
 from loguru import logger
 
-@csrf_exempt
-def handle_webhook(request, token):
-    if token not in settings.NINAGRAM["TOKENS"]:
-        return
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+_bot_lock = Lock()
+
+_webhooks = None
+
+
+def load_webhooks(webhooks=None):
+    """
+    Build the token -> (bot, dispatcher) map of the webhook.
     
-    try:
-        try:
-            data = json.loads(request.body)
-        except:
-            data = json.loads(request.body.decode())
-                    
-        ninabot = Bot(settings.NINAGRAM["TOKENS"])
-        bot = ninabot.tokens[token]['bot']
-        dispatcher = ninabot.tokens[token]['dispatcher']
-        update = Update.de_json(data, bot)            
+    Args:
+        * webhooks(optional): the map to use, the one of the Bot by default
         
-        dispatcher.process_update(update)
+    Returns: the map
+    """
+    global _webhooks
+    if webhooks is None:
+        tokens = settings.NINAGRAM.get("TOKENS")
+        if not tokens:
+            raise ImproperlyConfigured("NINAGRAM['TOKENS'] is required by the webhook")
+        with _bot_lock:
+            webhooks = Bot(tokens).webhooks
+    _webhooks = webhooks
+    return webhooks
+
+
+def get_webhooks():
+    """Return the token -> (bot, dispatcher) map of the webhook, see load_webhooks"""
+    webhooks = _webhooks
+    if webhooks is None:
+        logger.warning("the webhook map is built by the first request, see load_webhooks")
+        webhooks = load_webhooks()
+    return webhooks
+
+
+def check_secret(secret):
+    """Return True if the secret token header of a request is the expected one"""
+    expected = settings.NINAGRAM.get('WEBHOOK_SECRET')
+    if not expected:
+        return True
+    if secret is None:
+        return False
+    # compare_digest refuses the str that are not ASCII, the bytes of any header 
+    # give 403 not 500
+    return hmac.compare_digest(secret.encode('utf-8'), expected.encode('utf-8'))
+
+
+def decode_update(token, body, secret=None):
+    """
+    Check and decode a webhook update.
+
+    Args:
+        * token: the token of the bot in the webhook url
+        * body: the bytes of the request body
+        * secret(optional): the X-Telegram-Bot-Api-Secret-Token header
+
+    Returns: a tuple (HTTP status, update, dispatcher), the update and the
+    dispatcher are None if the status is not 200
+    """
+    webhook = get_webhooks().get(token)
+    if webhook is None:
+        return 404, None, None
+
+    if not check_secret(secret):
+        return 403, None, None
+
+    bot, dispatcher = webhook
+    try:
+        update = Update.de_json(loads(body), bot)
     except Exception as e:
         logger.exception(str(e))
-        
-    return HttpResponse("OK")
+        return 400, None, None
+
+    if update is None:
+        return 400, None, None
+    return 200, update, dispatcher
+
+
+def enqueue_update(token, body, secret=None):
+    """
+    Decode a webhook update and queue it in the worker pool.
+
+    Args:
+        * token: the token of the bot in the webhook url
+        * body: the bytes of the request body
+        * secret(optional): the X-Telegram-Bot-Api-Secret-Token header
+
+    Returns: the HTTP status of the answer to Telegram
+    """
+    status, update, dispatcher = decode_update(token, body, secret)
+    if status != 200:
+        return status
+
+    dedup = get_dedup()
+    if not dedup.is_new(token, update.update_id):
+        # a retry of Telegram, the update is already processed or queued
+        return 200
+
+    key = update_key(update)
+    reorderer = get_reorderer()
+    if reorderer is not None and key is not None:
+        reorderer.push((token, key), update)
+        return 200
+
+    # generic_processor submits to the same lane so it runs in this job
+    if not get_pool().submit(dispatcher.process_update, update, key=key):
+        dedup.forget(token, update.update_id)
+        return 503
+    return 200
+
+
+def queue_update(key, update):
+    """Queue an update released by the UpdateReorderer in the worker pool"""
+    token, lane = key
+    dispatcher = get_webhooks()[token][1]
+    if not get_pool().submit(dispatcher.process_update, update, key=lane):
+        # Telegram got its answer already, the update is lost
+        logger.warning("the update {} was refused by the worker pool", update.update_id)
+        get_dedup().forget(token, update.update_id)
+
+
+_reorderer = None
+
+
+def get_reorderer():
+    """Return the UpdateReorderer of the webhook, None if the reordering is disabled"""
+    global _reorderer
+    if _reorderer is None:
+        delay = get_updates_settings().get('REORDER_DELAY', 0)
+        if not delay:
+            return None
+        with _bot_lock:
+            if _reorderer is None:
+                _reorderer = UpdateReorderer(delay, queue_update)
+    return _reorderer
+
+
+@csrf_exempt
+def handle_webhook(request, token):
+    status = enqueue_update(token, request.body,
+                            request.META.get('HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN'))
+    if status == 200:
+        return HttpResponse("OK")
+    return HttpResponse(status=status)
@@ -0,0 +1,309 @@
+"""
+This module contains the worker pool used to process the updates.
+
+Instead of starting a thread per update, `generic_processor` submits its work
+to a fixed number of worker threads fed by a bounded queue. When the queue is
+full the overflow policy decides what happens:
+    - block: the caller waits until there is room in the queue
+    - drop-oldest: the oldest waiting update is dropped
+    - reject: the new update is refused and its `on_reject` callback is called
+
+The pool is configured with the NINAGRAM settings:
+    - WORKERS: the number of worker threads (default 8)
+    - WORKERS_QUEUE_SIZE: the maximum number of waiting updates (default 1000)
+    - WORKERS_OVERFLOW: one of "block", "drop-oldest" or "reject" (default "block")
+
+Updates of the same (chat_id, user_id) are run in order in the same lane so
+two quick messages of a user can't race on its Session and Runtime data.
+"""
+import time
+from collections import deque
+from threading import Thread, Lock, Condition, local
+from django.conf import settings
+from loguru import logger
+from .metrics import Metrics
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+REJECT = "reject"
+
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, REJECT)
+
+
+class Job:
+    """A unit of work waiting in the pool"""
+
+    __slots__ = ('fn', 'args', 'kwargs', 'on_reject', 'created')
+
+    def __init__(self, fn, args, kwargs, on_reject=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.on_reject = on_reject
+        self.created = time.time()
+
+    def reject(self):
+        if self.on_reject is None:
+            return
+
+        try:
+            self.on_reject(*self.args)
+        except Exception as e:
+            logger.exception(str(e))
+
+
+class WorkerPool:
+    """
+    A fixed size pool of threads consuming a bounded queue of jobs.
+
+    Jobs submitted with a `key` run in lanes: the jobs of a lane run strictly
+    one after the other and in the submission order, while the jobs of
+    different lanes run in parallel on all the workers. A lane only exists
+    while it has jobs waiting or running so idle keys cost nothing.
+
+    Params:
+        - workers: the number of threads
+        - queue_size: the maximum number of jobs waiting to be run
+        - overflow: the overflow policy, see OVERFLOW_POLICIES
+    """
+
+    def __init__(self, workers=8, queue_size=1000, overflow=BLOCK, name="workers"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(', '.join(OVERFLOW_POLICIES)))
+
+        self.workers = max(1, int(workers))
+        self.queue_size = max(1, int(queue_size))
+        self.overflow = overflow
+        self.name = name
+        self.metrics = Metrics(name)
+        # the entries ready to be picked by a worker: a Job or a lane key
+        self.ready = deque()
+        # the active lanes, key -> deque of waiting jobs
+        self.lanes = {}
+        self.pending = 0
+        # the number of jobs being run
+        self.running = 0
+        self.closed = False
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+        self.idle = Condition(self.lock)
+        # the lane of the job run by the current worker thread
+        self.current = local()
+        self.threads = []
+
+        for i in range(self.workers):
+            thread = Thread(target=self.run, name="{}-{}".format(name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fn, *args, key=None, on_reject=None, force=False, **kwargs):
+        """
+        Submit fn(*args, **kwargs) to the pool.
+
+        Args:
+            * fn: the callable to run
+            * key(optional): the lane of the job. Jobs with the same key run in order
+            * on_reject(optional): called with *args if the job is refused or dropped
+            * force(optional): queue the job even if the queue is full, for the
+            rest of the work of an update already accepted: the caller never waits
+
+        A job submitted from a worker running the same lane is run at once:
+        it would wait for the job submitting it anyway, and could block it
+        forever on a full queue.
+
+        Returns: True if the job was queued, False if it was rejected
+        """
+        if key is not None and getattr(self.current, 'key', None) == key:
+            self.metrics.incr('inline')
+            fn(*args, **kwargs)
+            return True
+
+        job = Job(fn, args, kwargs, on_reject)
+        dropped = None
+
+        with self.lock:
+            if self.closed:
+                # the pool is shutting down, see shutdown
+                self.metrics.incr('rejected')
+                dropped = job
+            elif self.pending >= self.queue_size and not force:
+                if self.overflow == REJECT:
+                    self.metrics.incr('rejected')
+                    dropped = job
+                elif self.overflow == DROP_OLDEST:
+                    dropped = self.drop_oldest()
+                    self.metrics.incr('dropped')
+                else:
+                    while self.pending >= self.queue_size and not self.closed:
+                        self.not_full.wait()
+                    if self.closed:
+                        self.metrics.incr('rejected')
+                        dropped = job
+
+            if dropped is not job:
+                self.push(job, key)
+                self.metrics.incr('submitted')
+
+        if dropped is not None:
+            # the callback may talk to telegram so we call it outside the lock
+            logger.warning("{} queue is full, an update was refused", self.name)
+            dropped.reject()
+
+        return dropped is not job
+
+    def push(self, job, key):
+        """Queue a job. Must be called with the lock held"""
+        if key is None:
+            self.ready.append(job)
+            self.not_empty.notify()
+        else:
+            lane = self.lanes.get(key)
+            if lane is None:
+                # the lane is new so it is ready at once
+                self.lanes[key] = deque((job,))
+                self.ready.append(key)
+                self.not_empty.notify()
+            else:
+                # the lane is waiting or running, the job will be run after the others
+                lane.append(job)
+
+        self.pending += 1
+        self.metrics.gauge('queue_depth', self.pending)
+        self.metrics.gauge('lanes', len(self.lanes))
+
+    def drop_oldest(self):
+        """
+        Remove and return the job that waits for the longest time. Must be
+        called with the lock held.
+        """
+        if self.ready:
+            entry = self.ready.popleft()
+            if isinstance(entry, Job):
+                job = entry
+            else:
+                lane = self.lanes[entry]
+                job = lane.popleft()
+                if lane:
+                    # the lane keeps its place in the ready queue
+                    self.ready.appendleft(entry)
+                else:
+                    del self.lanes[entry]
+        else:
+            # all the waiting jobs are behind a running job of their lane
+            for lane in self.lanes.values():
+                if lane:
+                    job = lane.popleft()
+                    break
+
+        self.pending -= 1
+        return job
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.ready:
+                    self.not_empty.wait()
+
+                entry = self.ready.popleft()
+                if isinstance(entry, Job):
+                    key, job = None, entry
+                else:
+                    key, job = entry, self.lanes[entry].popleft()
+
+                self.pending -= 1
+                self.running += 1
+                self.metrics.gauge('queue_depth', self.pending)
+                self.not_full.notify()
+
+            started = time.time()
+            self.metrics.observe('wait_time', started - job.created)
+            self.current.key = key
+            try:
+                job.fn(*job.args, **job.kwargs)
+                self.metrics.incr('completed')
+            except Exception as e:
+                self.metrics.incr('failed')
+                logger.exception(str(e))
+            finally:
+                self.current.key = None
+            self.metrics.observe('run_time', time.time() - started)
+
+            with self.lock:
+                self.running -= 1
+                if key is not None:
+                    if self.lanes[key]:
+                        # the next job of the lane can now be run
+                        self.ready.append(key)
+                        self.not_empty.notify()
+                    else:
+                        del self.lanes[key]
+                    self.metrics.gauge('lanes', len(self.lanes))
+                if not self.pending and not self.running:
+                    self.idle.notify_all()
+
+    def shutdown(self, timeout=None):
+        """
+        Stop accepting jobs and wait until the queued and running jobs are done.
+        The jobs submitted from now on are rejected.
+
+        Params:
+            - timeout: the maximum time to wait in seconds, None to wait forever
+
+        Returns: the number of jobs not done when the timeout is over
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            self.closed = True
+            # the callers blocked on a full queue are released
+            self.not_full.notify_all()
+            while self.pending or self.running:
+                if deadline is None:
+                    self.idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.idle.wait(remaining)
+            return self.pending + self.running
+
+    def qsize(self):
+        return self.pending
+
+    def stats(self):
+        """Return a snapshot of the pool metrics"""
+        return self.metrics.snapshot()
+
+
+def update_key(update):
+    """
+    Return the lane key of an update: the (chat_id, user_id) couple. Updates
+    without chat nor user share no lane.
+    """
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat is None and user is None:
+        return None
+
+    return (chat.id if chat is not None else None, user.id if user is not None else None)
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """
+    Return the worker pool of the process, creating it from the settings at the
+    first call.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                conf = getattr(settings, 'NINAGRAM', {})
+                _pool = WorkerPool(workers=conf.get('WORKERS', 8),
+                                   queue_size=conf.get('WORKERS_QUEUE_SIZE', 1000),
+                                   overflow=conf.get('WORKERS_OVERFLOW', BLOCK))
+    return _pool
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+"""Run the tests of ninagram with the Django test runner"""
+import os
+import sys
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ninagram.tests.settings')
+    django.setup()
+    runner = get_runner(settings)()
+    failures = runner.run_tests(sys.argv[1:] or ['ninagram.tests'])
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main()